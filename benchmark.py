@@ -0,0 +1,2549 @@
+"""
+Load tests for the chat server.
+
+Each scenario starts server.py in a subprocess with the requested engine,
+drives it with headless protocol clients (no PyQt or PyAudio needed) and
+prints the results.
+
+    python benchmark.py idle --clients 1000 --engines threaded asyncio
+    python benchmark.py slow --clients 50 --voice-frames 2000
+    python benchmark.py fanout --room-sizes 10 100 1000
+    python benchmark.py codecs --listeners 50
+    python benchmark.py cluster --nodes 3 --clients-per-node 20
+    python benchmark.py churn --clients 500
+    python benchmark.py history --messages 100000
+    python benchmark.py load --clients 2000 --rooms 40 --json new.json
+    python benchmark.py load --clients 2000 --rooms 40 --server-workers 4
+    python benchmark.py compare old.json new.json
+    python benchmark.py metrics --clients 500
+    python benchmark.py mixer --talkers 1 2 4 8
+    python benchmark.py parser --recv-sizes 4096 65536
+    python benchmark.py vad --noise-db -60 -45
+    python benchmark.py media --loss 0 0.02 0.05
+    python benchmark.py chat --rates 100 1000 5000
+    python benchmark.py flood --listeners 20
+    python benchmark.py reconnect --listeners 20 --cuts 5 --outage 0.5
+    python benchmark.py startup --runs 10
+"""
+import argparse
+import asyncio
+import base64
+import json
+import math
+import os
+import random
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+CLUSTER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cluster.py')
+BENCH_HOST = '127.0.0.1'
+# Room of the load test when it is not split into several
+DEFAULT_LOAD_ROOM = 'lobby'
+# Seconds a load test client holds the floor after a talk request
+TALK_REQUEST_HOLD = 0.1
+# Generator CPU use above which its latency figures are suspect
+GENERATOR_BUSY_PCT = 90
+# Metrics checked by `compare`: (path in a load result, label, higher is better)
+LOAD_METRICS = [
+    (('chat', 'per_s'), 'chat deliveries/s', True),
+    (('chat', 'p50_ms'), 'chat p50 ms', False),
+    (('chat', 'p99_ms'), 'chat p99 ms', False),
+    (('chat', 'p999_ms'), 'chat p999 ms', False),
+    (('voice', 'per_s'), 'voice frames/s', True),
+    (('voice', 'p50_ms'), 'voice p50 ms', False),
+    (('voice', 'p99_ms'), 'voice p99 ms', False),
+    (('voice', 'p999_ms'), 'voice p999 ms', False),
+    (('server_cpu_pct',), 'server CPU %', False),
+    (('server_rss_peak_kib',), 'server peak RSS KiB', False),
+]
+
+
+def free_port():
+    """
+    Ask the OS for a currently unused TCP port on the loopback interface.
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind((BENCH_HOST, 0))
+        return s.getsockname()[1]
+
+def process_tree(pid):
+    """
+    A process and all its descendants, e.g. a server's workers (Linux only).
+    """
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                ppid = int(f.read().rpartition(')')[2].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    tree, pending = [], [pid]
+    while pending:
+        current = pending.pop()
+        tree.append(current)
+        pending.extend(children.get(current, ()))
+    return tree
+
+def process_stats(pid):
+    """
+    Return (rss_kib, threads) for a process and its descendants, read from
+    /proc (Linux only).
+    """
+    rss, threads = 0, 0
+    for member in process_tree(pid):
+        try:
+            with open(f"/proc/{member}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        rss += int(line.split()[1])
+                    elif line.startswith("Threads:"):
+                        threads += int(line.split()[1])
+        except OSError:
+            if member == pid:
+                raise
+    return rss, threads
+
+def wait_for_port(proc, port, name):
+    """
+    Wait until a freshly launched process accepts connections on `port`.
+    """
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection((BENCH_HOST, port), timeout=0.5):
+                return proc
+        except OSError:
+            time.sleep(0.05)
+    proc.kill()
+    raise RuntimeError(f"{name} did not start on port {port}")
+
+def start_server_process(engine, port, extra_args=(), script=SERVER_SCRIPT, rate_limits=False):
+    """
+    Launch server.py (or another build's, at `script`) with the given
+    engine and wait until it accepts connections. Per-client rate limits
+    are off unless asked for, as most scenarios send from one client far
+    faster than a user would; with `rate_limits` no flag is passed, which
+    also suits older builds.
+    """
+    if not rate_limits:
+        extra_args = ['--no-rate-limits', *extra_args]
+    proc = subprocess.Popen(
+        [sys.executable, script, '--engine', engine, '--host', BENCH_HOST, '--port', str(port), *extra_args],
+        stdout=subprocess.DEVNULL,
+    )
+    return wait_for_port(proc, port, f"{engine} server")
+
+def start_hub_process(port):
+    """
+    Launch the cluster bus hub and wait until it accepts nodes.
+    """
+    proc = subprocess.Popen(
+        [sys.executable, CLUSTER_SCRIPT, '--host', BENCH_HOST, '--port', str(port)],
+        stdout=subprocess.DEVNULL,
+    )
+    return wait_for_port(proc, port, "bus hub")
+
+async def drain(reader):
+    """
+    Read and discard everything the server sends until the connection closes.
+    """
+    try:
+        while await reader.read(65536):
+            pass
+    except ConnectionError:
+        pass
+
+async def open_clients(port, count, prefix="bench"):
+    """
+    Connect `count` clients, register a nickname for each and keep draining them.
+    Returns a list of (reader, writer, drain_task).
+    """
+    conns = []
+    for i in range(count):
+        reader, writer = await asyncio.open_connection(BENCH_HOST, port)
+        writer.write(f"{prefix}{i}\n".encode('utf-8'))
+        conns.append((reader, writer, asyncio.ensure_future(drain(reader))))
+    return conns
+
+async def close_clients(conns):
+    for _, writer, task in conns:
+        writer.close()
+    await asyncio.gather(*(task for _, _, task in conns), return_exceptions=True)
+
+async def wait_for_line(reader, prefix, timeout=60):
+    """
+    Read lines from `reader` until one starts with `prefix`.
+    """
+    async def scan():
+        while True:
+            line = await reader.readline()
+            if not line:
+                raise ConnectionError("server closed the connection")
+            if line.startswith(prefix):
+                return line
+    return await asyncio.wait_for(scan(), timeout)
+
+async def idle_scenario(port, pid, clients, settle):
+    """
+    Hold `clients` idle connections, then time one chat message reaching all of them.
+    """
+    base_rss, base_threads = process_stats(pid)
+    start = time.perf_counter()
+    conns = await open_clients(port, clients)
+    connect_time = time.perf_counter() - start
+
+    # Let join notifications drain before sampling memory
+    await asyncio.sleep(settle)
+    rss, threads = process_stats(pid)
+
+    # Probe broadcast latency: a fresh listener measures one MSG fan-out
+    probe_reader, probe_writer = await asyncio.open_connection(BENCH_HOST, port)
+    probe_writer.write(b"probe\n")
+    await wait_for_line(probe_reader, b"USERLIST:")
+    sent = time.perf_counter()
+    probe_writer.write(b"MSG:ping\n")
+    await wait_for_line(probe_reader, b"MSG:probe: ping")
+    broadcast_time = time.perf_counter() - sent
+    probe_writer.close()
+
+    await close_clients(conns)
+    return {
+        'clients': clients,
+        'connect_s': connect_time,
+        'rss_kib': rss,
+        'rss_per_client_kib': (rss - base_rss) / clients if clients else 0.0,
+        'threads': threads,
+        'base_threads': base_threads,
+        'broadcast_ms': broadcast_time * 1000,
+    }
+
+def run_idle(args):
+    results = {}
+    for engine in args.engines:
+        port = free_port()
+        proc = start_server_process(engine, port)
+        try:
+            results[engine] = asyncio.run(idle_scenario(port, proc.pid, args.clients, args.settle))
+        finally:
+            proc.kill()
+            proc.wait()
+
+    print(f"{'engine':<10} {'clients':>8} {'connect s':>10} {'RSS MiB':>9} {'KiB/client':>11} {'threads':>8} {'bcast ms':>9}")
+    for engine, r in results.items():
+        print(f"{engine:<10} {r['clients']:>8} {r['connect_s']:>10.2f} {r['rss_kib'] / 1024:>9.1f} "
+              f"{r['rss_per_client_kib']:>11.1f} {r['threads']:>8} {r['broadcast_ms']:>9.1f}")
+    return results
+
+async def slow_scenario(port, clients, voice_frames):
+    """
+    Stream voice while one connected client never reads, and time chat
+    delivery to everyone else. Without per-client queues the stalled
+    socket would block the whole room once its kernel buffers fill.
+    """
+    conns = await open_clients(port, clients)
+    stalled_reader, stalled_writer = await asyncio.open_connection(BENCH_HOST, port)
+    stalled_writer.write(b"stalled\n")  # never read from again
+
+    talker_reader, talker_writer = await asyncio.open_connection(BENCH_HOST, port)
+    talker_writer.write(b"talker\n")
+    await wait_for_line(talker_reader, b"USERLIST:")
+    drain_task = asyncio.ensure_future(drain(talker_reader))
+
+    frame = b"VOICE:" + b"A" * 2732 + b"\n"  # size of one base64 1024-frame PCM chunk
+    for _ in range(voice_frames):
+        talker_writer.write(frame)
+    await talker_writer.drain()
+
+    # A fresh listener times one message across the congested room
+    probe_reader, probe_writer = await asyncio.open_connection(BENCH_HOST, port)
+    probe_writer.write(b"probe\n")
+    await wait_for_line(probe_reader, b"USERLIST:")
+    sent = time.perf_counter()
+    probe_writer.write(b"MSG:ping\n")
+    await wait_for_line(probe_reader, b"MSG:probe: ping")
+    latency = time.perf_counter() - sent
+
+    for w in (probe_writer, talker_writer, stalled_writer):
+        w.close()
+    drain_task.cancel()
+    await close_clients(conns)
+    return {'clients': clients, 'voice_frames': voice_frames, 'msg_latency_ms': latency * 1000}
+
+def run_slow(args):
+    results = {}
+    for engine in args.engines:
+        port = free_port()
+        proc = start_server_process(engine, port)
+        try:
+            results[engine] = asyncio.run(slow_scenario(port, args.clients, args.voice_frames))
+        finally:
+            proc.kill()
+            proc.wait()
+
+    print(f"{'engine':<10} {'clients':>8} {'voice frames':>13} {'msg latency ms':>15}")
+    for engine, r in results.items():
+        print(f"{engine:<10} {r['clients']:>8} {r['voice_frames']:>13} {r['msg_latency_ms']:>15.1f}")
+    return results
+
+def null_connection(binary):
+    """
+    A server Connection with an unbounded queue and no socket, for
+    measuring broadcast() in-process.
+    """
+    import server
+    from sendqueue import SendQueue
+
+    class NullConnection(server.Connection):
+        def close(self):
+            pass
+
+    conn = NullConnection(('bench', 0))
+    conn.binary = binary
+    conn.queue = SendQueue(max_bytes=1 << 40, max_messages=1 << 30, disconnect_bytes=1 << 40)
+    return conn
+
+def naive_broadcast(conns, audio):
+    """
+    Serialize the voice chunk separately for every recipient, as broadcast()
+    used to. Kept as the baseline for the fanout microbenchmark.
+    """
+    from protocol import voice_frame
+    for conn in conns:
+        if conn.binary:
+            data = voice_frame(0, audio)
+        else:
+            data = b"VOICE:" + base64.b64encode(audio) + b"\n"
+        conn.queue.put(data, True)
+
+def run_fanout(args):
+    """
+    Time broadcast() of one voice chunk to rooms of growing size, half text
+    and half binary clients, against per-recipient serialization.
+    """
+    import server
+
+    audio = os.urandom(args.payload)
+    rows = []
+    for size in args.room_sizes:
+        conns = [null_connection(binary=i % 2 == 0) for i in range(size)]
+        for i, conn in enumerate(conns):
+            room = server.add_client(conn, f"bench{i}", room_name='fanout')
+
+        start = time.perf_counter()
+        for _ in range(args.broadcasts):
+            out = server.Outgoing(audio=audio, codec=0)
+            out.line()
+            out.frame()
+        encode = (time.perf_counter() - start) / args.broadcasts
+
+        start = time.perf_counter()
+        for _ in range(args.broadcasts):
+            server.broadcast(room, server.Outgoing(audio=audio, codec=0))
+        shared = (time.perf_counter() - start) / args.broadcasts
+        for conn in conns:
+            conn.queue.pop_batch()
+
+        start = time.perf_counter()
+        for _ in range(args.broadcasts):
+            naive_broadcast(conns, audio)
+        naive = (time.perf_counter() - start) / args.broadcasts
+
+        for conn in conns:
+            server.discard_client(conn)
+        rows.append((size, encode, shared, naive))
+
+    print(f"{'room':>6} {'encode us/bcast':>16} {'shared us/bcast':>16} {'ns/recipient':>13} "
+          f"{'naive us/bcast':>15} {'ns/recipient':>13}")
+    for size, encode, shared, naive in rows:
+        print(f"{size:>6} {encode * 1e6:>16.1f} {shared * 1e6:>16.1f} {shared / size * 1e9:>13.0f} "
+              f"{naive * 1e6:>15.1f} {naive / size * 1e9:>13.0f}")
+    return rows
+
+def synthetic_voice(sample_rate, seconds):
+    """
+    Speech-like test signal: a few harmonics with a slow amplitude envelope,
+    as 16-bit native-endian PCM.
+    """
+    from array import array
+    samples = array('h')
+    for i in range(int(sample_rate * seconds)):
+        t = i / sample_rate
+        envelope = 0.5 + 0.5 * math.sin(2 * math.pi * 3 * t)
+        value = sum(math.sin(2 * math.pi * f * t) / n for n, f in enumerate((180, 360, 720, 1400), 1))
+        samples.append(int(6000 * envelope * value))
+    return samples.tobytes()
+
+def run_codecs(args):
+    """
+    Server egress for one second of voice per listener with each available
+    codec, against the original base64 text protocol.
+    """
+    from codec import available_codecs, create_codec
+    from protocol import voice_frame
+
+    pcm = create_codec('pcm')
+    audio = synthetic_voice(pcm.sample_rate, 1.0)
+    step = pcm.frame_bytes
+    legacy = sum(len(b"VOICE:" + base64.b64encode(audio[i:i + step]) + b"\n") for i in range(0, len(audio), step))
+
+    rows = [('text/base64 pcm', legacy)]
+    for name in available_codecs():
+        codec = create_codec(name)
+        audio = synthetic_voice(codec.sample_rate, 1.0)
+        step = codec.frame_bytes
+        wire = sum(len(voice_frame(codec.codec_id, codec.encode(audio[i:i + step])))
+                   for i in range(0, len(audio) - step + 1, step))
+        rows.append((name, wire))
+
+    print(f"{'codec':<16} {'KB/s per listener':>18} {f'KB/s x{args.listeners}':>14} {'vs text':>8}")
+    for name, wire in rows:
+        print(f"{name:<16} {wire / 1000:>18.1f} {wire * args.listeners / 1000:>14.1f} {legacy / wire:>7.1f}x")
+    return rows
+
+def check_local_bus(nodes, messages):
+    """
+    Exercise the in-process bus: every node publishes numbered messages
+    and asks for the same talk floor at once. Returns (ordered, exclusive).
+    """
+    from cluster import LocalHub
+
+    hub = LocalHub()
+    received = {f"node{i}": [] for i in range(nodes)}
+    buses = [hub.connect(node, events.append) for node, events in received.items()]
+
+    def run(bus):
+        for k in range(messages):
+            bus.publish({'type': 'text', 'room': 'lobby', 'text': f"{bus.node}:{k}"})
+        bus.publish({'type': 'floor-request', 'room': 'lobby', 'user': bus.node})
+
+    threads = [threading.Thread(target=run, args=(bus,)) for bus in buses]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    deadline = time.monotonic() + 10
+    while (time.monotonic() < deadline and
+           any(sum(e['type'] == 'text' for e in events) < (nodes - 1) * messages for events in received.values())):
+        time.sleep(0.01)
+    for bus in buses:
+        bus.close()
+
+    ordered = True
+    for node, events in received.items():
+        for origin in received:
+            if origin != node:
+                seen = [e['text'] for e in events if e['type'] == 'text' and e['text'].startswith(origin + ':')]
+                ordered &= seen == [f"{origin}:{k}" for k in range(messages)]
+    grants = [[e['user'] for e in events if e['type'] == 'floor-granted'] for events in received.values()]
+    busy = sum(e['type'] == 'floor-busy' for events in received.values() for e in events)
+    exclusive = all(len(g) == 1 and g == grants[0] for g in grants) and busy == nodes - 1
+    return ordered, exclusive
+
+async def record_lines(reader, inbox):
+    """
+    Append every line the server sends to `inbox` until the connection closes.
+    """
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            inbox.append(line.decode('utf-8').rstrip('\n'))
+    except ConnectionError:
+        pass
+
+async def wait_until(check, timeout):
+    """
+    Poll `check` until it returns True. Returns False on timeout.
+    """
+    deadline = time.monotonic() + timeout
+    while not check():
+        if time.monotonic() > deadline:
+            return False
+        await asyncio.sleep(0.01)
+    return True
+
+def last_userlist(inbox):
+    for line in reversed(inbox):
+        if line.startswith("USERLIST:"):
+            return set(line[len("USERLIST:"):].split(','))
+    return set()
+
+async def cluster_scenario(ports, clients_per_node, messages, voice_frames, timeout):
+    """
+    Connect clients to every node and check, across nodes: the user list,
+    delivery and per-sender order of chat, talk floor exclusivity, voice
+    relay and floor release.
+    """
+    inboxes, writers, tasks = {}, {}, []
+    for n, port in enumerate(ports):
+        for i in range(clients_per_node):
+            nick = f"n{n}c{i}"
+            reader, writer = await asyncio.open_connection(BENCH_HOST, port)
+            writer.write(f"{nick}\n".encode('utf-8'))
+            inboxes[nick] = []
+            writers[nick] = writer
+            tasks.append(asyncio.ensure_future(record_lines(reader, inboxes[nick])))
+    everyone = set(inboxes)
+    result = {'nodes': len(ports), 'clients': len(everyone)}
+
+    start = time.perf_counter()
+    result['presence'] = await wait_until(
+        lambda: all(last_userlist(inbox) == everyone for inbox in inboxes.values()), timeout)
+    result['presence_ms'] = (time.perf_counter() - start) * 1000
+
+    def since(marks, prefix):
+        return {nick: [line for line in inbox[marks[nick]:] if line.startswith(prefix)]
+                for nick, inbox in inboxes.items()}
+
+    # Every client sends numbered messages; everyone must get all of them in order
+    marks = {nick: len(inbox) for nick, inbox in inboxes.items()}
+    start = time.perf_counter()
+    for k in range(messages):
+        for nick, writer in writers.items():
+            writer.write(f"MSG:{k}\n".encode('utf-8'))
+    expected = len(everyone) * messages
+    result['delivered'] = await wait_until(
+        lambda: all(len(lines) >= expected for lines in since(marks, "MSG:").values()), timeout)
+    elapsed = time.perf_counter() - start
+    result['msgs_per_s'] = expected * len(everyone) / elapsed
+    ordered = True
+    for lines in since(marks, "MSG:").values():
+        per_sender = {}
+        for line in lines:
+            sender, _, text = line[len("MSG:"):].partition(': ')
+            per_sender.setdefault(sender, []).append(int(text))
+        ordered &= all(seq == list(range(messages)) for seq in per_sender.values())
+    result['ordered'] = result['delivered'] and ordered
+
+    # Everyone asks for the floor at once; exactly one may get it, cluster-wide
+    marks = {nick: len(inbox) for nick, inbox in inboxes.items()}
+    for nick, writer in writers.items():
+        writer.write(f"STATUS:START:{nick}\n".encode('utf-8'))
+
+    def floor_settled():
+        busy = sum(len(lines) for lines in since(marks, "STATUS:BUSY").values())
+        return busy == len(everyone) - 1 and all(since(marks, "STATUS:START").values())
+    settled = await wait_until(floor_settled, timeout)
+    await asyncio.sleep(0.2)  # let any second grant show up
+    starts = {line for lines in since(marks, "STATUS:START").values() for line in lines}
+    result['exclusive'] = settled and len(starts) == 1
+    talker = starts.pop()[len("STATUS:START:"):] if len(starts) == 1 else next(iter(everyone))
+
+    # The talker's voice reaches every node
+    marks = {nick: len(inbox) for nick, inbox in inboxes.items()}
+    frame = b"VOICE:" + base64.b64encode(bytes(2048)) + b"\n"
+    for _ in range(voice_frames):
+        writers[talker].write(frame)
+    result['voice'] = await wait_until(
+        lambda: all(len(lines) >= voice_frames for lines in since(marks, "VOICE:").values()), timeout)
+
+    marks = {nick: len(inbox) for nick, inbox in inboxes.items()}
+    writers[talker].write(f"STATUS:STOP:{talker}\n".encode('utf-8'))
+    result['released'] = await wait_until(
+        lambda: all(f"STATUS:STOP:{talker}" in lines for lines in since(marks, "STATUS:STOP").values()), timeout)
+
+    for writer in writers.values():
+        writer.close()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return result
+
+def run_cluster(args):
+    """
+    Check the bus in-process, then run N server nodes joined through a bus
+    hub on localhost and check delivery, ordering and the talk floor.
+    Exits with status 1 if any check fails.
+    """
+    ordered, exclusive = check_local_bus(args.nodes, args.messages)
+    print(f"local bus: {args.nodes} nodes, ordering {'ok' if ordered else 'FAILED'}, "
+          f"floor {'exclusive' if exclusive else 'NOT exclusive'}")
+
+    hub_port = free_port()
+    procs = [start_hub_process(hub_port)]
+    try:
+        ports = []
+        for i in range(args.nodes):
+            port = free_port()
+            engine = args.engines[i % len(args.engines)]
+            procs.append(start_server_process(engine, port, (
+                '--cluster', f"{BENCH_HOST}:{hub_port}", '--node-id', f"node{i}")))
+            ports.append(port)
+        result = asyncio.run(cluster_scenario(ports, args.clients_per_node, args.messages,
+                                              args.voice_frames, args.timeout))
+    finally:
+        for proc in procs:
+            proc.kill()
+            proc.wait()
+
+    checks = ('presence', 'delivered', 'ordered', 'exclusive', 'voice', 'released')
+    print(f"cluster: {result['nodes']} nodes ({', '.join(args.engines)}), {result['clients']} clients")
+    print(f"  user lists converged in {result['presence_ms']:.0f} ms, "
+          f"chat delivered at {result['msgs_per_s']:.0f} msgs/s")
+    for check in checks:
+        print(f"  {check:<10} {'ok' if result[check] else 'FAILED'}")
+    if not (ordered and exclusive and all(result[check] for check in checks)):
+        sys.exit(1)
+    return result
+
+async def follow_presence(reader, model, counters, binary):
+    """
+    Keep `model` current from USERLIST or PRESENCE messages and count
+    them and the bytes they take, until the connection closes.
+    """
+    from protocol import FRAME_TEXT, PRESENCE_PREFIX, FrameDecoder
+
+    def apply(message, size):
+        if message.startswith(PRESENCE_PREFIX):
+            counters['bytes'] += size
+            counters['messages'] += 1
+            model.apply(message)
+        elif message.startswith("USERLIST:"):
+            counters['bytes'] += size
+            counters['messages'] += 1
+            model.reset(message[len("USERLIST:"):].split(','))
+
+    try:
+        if binary:
+            await reader.readline()  # HELLO reply
+            decoder = FrameDecoder()
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                for frame_type, payload in decoder.feed(data):
+                    if frame_type == FRAME_TEXT:
+                        apply(str(payload, 'utf-8'), len(payload.obj))
+        else:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                apply(line.decode('utf-8').rstrip('\n'), len(line))
+    except ConnectionError:
+        pass
+
+async def churn_scenario(port, clients, deltas, timeout):
+    """
+    Connect `clients` clients back to back, as after a network blip, and
+    measure the presence traffic until every client sees everyone.
+    Delta clients negotiate the current binary protocol like client.py.
+    """
+    from presence import PresenceModel
+    from protocol import hello_line
+
+    models, writers, tasks = [], [], []
+    counters = []
+    start = time.perf_counter()
+    for i in range(clients):
+        reader, writer = await asyncio.open_connection(BENCH_HOST, port)
+        if deltas:
+            writer.write(hello_line(f"churn{i}", ['pcm']))
+        else:
+            writer.write(f"churn{i}\n".encode('utf-8'))
+        model = PresenceModel()
+        models.append(model)
+        writers.append(writer)
+        counters.append({'bytes': 0, 'messages': 0})
+        tasks.append(asyncio.ensure_future(follow_presence(reader, model, counters[-1], deltas)))
+    converged = await wait_until(lambda: all(len(model) == clients for model in models), timeout)
+    elapsed = time.perf_counter() - start
+    for writer in writers:
+        writer.close()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return {'clients': clients, 'converged': converged, 'seconds': elapsed,
+            'presence_bytes': sum(counter['bytes'] for counter in counters),
+            'most_messages': max(counter['messages'] for counter in counters)}
+
+def run_churn(args):
+    """
+    Compare full USERLIST rebroadcasts with PRESENCE deltas for a wave of
+    joins. Either way a client is told of each join once, so none of the
+    n clients should get more than n presence messages.
+    """
+    rows = []
+    extra = ['--workers', str(args.server_workers)] if args.server_workers > 1 else []
+    for engine in args.engines:
+        for deltas in (False, True):
+            port = free_port()
+            proc = start_server_process(engine, port, extra)
+            try:
+                result = asyncio.run(churn_scenario(port, args.clients, deltas, args.timeout))
+            finally:
+                proc.kill()
+                proc.wait()
+            rows.append((engine, 'deltas' if deltas else 'userlist', result))
+
+    if extra:
+        print(f"server with {args.server_workers} workers")
+    print(f"{'engine':<10} {'presence':<9} {'clients':>8} {'presence KiB':>13} {'bytes/client':>13} "
+          f"{'most msgs':>10} {'converge s':>11}")
+    for engine, mode, r in rows:
+        converge = f"{r['seconds']:.2f}" if r['converged'] else 'timeout'
+        print(f"{engine:<10} {mode:<9} {r['clients']:>8} {r['presence_bytes'] / 1024:>13.1f} "
+              f"{r['presence_bytes'] / r['clients']:>13.0f} {r['most_messages']:>10} {converge:>11}")
+    return rows
+
+async def history_scenario(port, messages, probes):
+    """
+    Store `messages` chat messages, then fetch them all as one backlog
+    while two other clients time live chat between them.
+    """
+    writer_reader, writer_writer = await asyncio.open_connection(BENCH_HOST, port)
+    writer_writer.write(b"writer\n")
+    start = time.perf_counter()
+    for i in range(messages):
+        writer_writer.write(b"MSG:history message %d\n" % i)
+        if i % 1000 == 999:
+            await writer_writer.drain()
+    await wait_for_line(writer_reader, b"MSG:writer: history message %d\n" % (messages - 1))
+    store_time = time.perf_counter() - start
+    drain_task = asyncio.ensure_future(drain(writer_reader))
+
+    talker_reader, talker_writer = await asyncio.open_connection(BENCH_HOST, port)
+    talker_writer.write(b"talker\n")
+    talker_task = asyncio.ensure_future(drain(talker_reader))
+    listener_reader, listener_writer = await asyncio.open_connection(BENCH_HOST, port)
+    listener_writer.write(b"listener\n")
+    await wait_for_line(listener_reader, b"USERLIST:")
+
+    async def probe_live():
+        latencies = []
+        for i in range(probes):
+            sent = time.perf_counter()
+            talker_writer.write(b"MSG:probe %d\n" % i)
+            await wait_for_line(listener_reader, b"MSG:talker: probe %d\n" % i)
+            latencies.append(time.perf_counter() - sent)
+            await asyncio.sleep(0.005)
+        return latencies
+
+    fetch_reader, fetch_writer = await asyncio.open_connection(BENCH_HOST, port)
+    fetch_writer.write(b"fetcher\n")
+    await wait_for_line(fetch_reader, b"USERLIST:")
+    probe_task = asyncio.ensure_future(probe_live())
+    start = time.perf_counter()
+    fetch_writer.write(b"HISTORY:SINCE:0\n")
+    entries = received = 0
+    pending = b""
+    done = False
+    while not done:
+        data = await fetch_reader.read(65536)
+        if not data:
+            break
+        *lines, pending = (pending + data).split(b"\n")
+        for line in lines:
+            if line.startswith(b"HISTORY:END:"):
+                done = True
+            elif line.startswith(b"HISTORY:"):
+                entries += 1
+                received += len(line) + 1
+        await asyncio.sleep(0)  # read() does not yield while data is buffered; let the probes run
+    replay_time = time.perf_counter() - start
+    latencies = sorted(await probe_task)
+
+    for w in (writer_writer, talker_writer, listener_writer, fetch_writer):
+        w.close()
+    drain_task.cancel()
+    talker_task.cancel()
+    return {
+        'messages': messages,
+        'store_per_s': messages / store_time,
+        'entries': entries,
+        'replay_s': replay_time,
+        'replay_mib_per_s': received / replay_time / (1024 * 1024),
+        'live_p50_ms': latencies[len(latencies) // 2] * 1000,
+        'live_max_ms': latencies[-1] * 1000,
+    }
+
+def run_history(args):
+    """
+    Measure history appends, a full backlog replay, and live chat latency during the replay.
+    """
+    results = {}
+    for engine in args.engines:
+        port = free_port()
+        with tempfile.TemporaryDirectory() as directory:
+            proc = start_server_process(engine, port, ['--history-dir', directory])
+            try:
+                results[engine] = asyncio.run(history_scenario(port, args.messages, args.probes))
+            finally:
+                proc.kill()
+                proc.wait()
+
+    print(f"{'engine':<10} {'messages':>9} {'stored/s':>9} {'replayed':>9} {'replay s':>9} {'MiB/s':>7} "
+          f"{'live p50 ms':>12} {'live max ms':>12}")
+    for engine, r in results.items():
+        print(f"{engine:<10} {r['messages']:>9} {r['store_per_s']:>9.0f} {r['entries']:>9} {r['replay_s']:>9.2f} "
+              f"{r['replay_mib_per_s']:>7.1f} {r['live_p50_ms']:>12.1f} {r['live_max_ms']:>12.1f}")
+    return results
+
+def process_cpu_seconds(pid):
+    """
+    User plus system CPU time used so far by a process and its live
+    descendants, from /proc (Linux only).
+    """
+    ticks = 0
+    for member in process_tree(pid):
+        try:
+            with open(f"/proc/{member}/stat") as f:
+                fields = f.read().rpartition(')')[2].split()
+        except OSError:
+            if member == pid:
+                raise
+            continue
+        ticks += int(fields[11]) + int(fields[12])
+    return ticks / os.sysconf('SC_CLK_TCK')
+
+def raise_open_files_limit():
+    """
+    Lift the soft limit on open files to the hard limit, for this process
+    and the servers it starts; thousands of clients need as many sockets.
+    """
+    import resource
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+def percentile(values, fraction):
+    """
+    Nearest-rank percentile of an already sorted sequence.
+    """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def latency_summary(latencies_us, sent, seconds):
+    """
+    Delivery rate and latency percentiles in milliseconds.
+    """
+    values = sorted(latencies_us)
+    return {
+        'sent': sent,
+        'delivered': len(values),
+        'per_s': len(values) / seconds,
+        'p50_ms': percentile(values, 0.5) / 1000,
+        'p99_ms': percentile(values, 0.99) / 1000,
+        'p999_ms': percentile(values, 0.999) / 1000,
+        'max_ms': (values[-1] if values else 0) / 1000,
+    }
+
+def load_room(index, rooms):
+    return DEFAULT_LOAD_ROOM if rooms == 1 else f"load{index % rooms}"
+
+async def load_client(index, port, config, start_at, stop_at, stats):
+    """
+    One simulated user. It sends chat (and, as one of the first `talkers`
+    clients, a voice stream; otherwise the odd talk request) at the
+    configured rates between start_at and stop_at, and times every chat
+    message and voice frame it receives from the send timestamp (in
+    monotonic nanoseconds, comparable across processes) inside it.
+    """
+    from protocol import FRAME_TEXT, FRAME_VOICE, VOICE_HEADER, FrameDecoder, hello_line, text_frame, voice_frame
+
+    nickname = f"load{index}"
+    binary = config['protocol'] == 'binary' or (config['protocol'] == 'mixed' and index % 2 == 0)
+    talker = index < config['talkers']
+    reader, writer = await asyncio.open_connection(BENCH_HOST, port)
+    if binary:
+        writer.write(hello_line(nickname, ['pcm']))
+        await reader.readline()
+    else:
+        writer.write(f"{nickname}\n".encode('utf-8'))
+
+    def send(message):
+        writer.write(text_frame(message) if binary else f"{message}\n".encode('utf-8'))
+
+    def on_text(message):
+        if message.startswith(b"MSG:"):
+            sent = message.partition(b": ")[2].partition(b" ")[0]
+            if sent.isdigit():
+                stats['chat_latency'].append((time.monotonic_ns() - int(sent)) // 1000)
+        elif message.startswith(b"STATUS:BUSY"):
+            stats['busy'] += 1
+
+    async def receive():
+        try:
+            if binary:
+                decoder = FrameDecoder()
+                while True:
+                    data = await reader.read(65536)
+                    if not data:
+                        break
+                    for frame_type, payload in decoder.feed(data):
+                        if frame_type == FRAME_VOICE:
+                            sent = int.from_bytes(payload[VOICE_HEADER.size:VOICE_HEADER.size + 8], 'big')
+                            stats['voice_latency'].append((time.monotonic_ns() - sent) // 1000)
+                        elif frame_type == FRAME_TEXT:
+                            on_text(bytes(payload))
+            else:
+                while True:
+                    line = await reader.readline()
+                    if not line:
+                        break
+                    if line.startswith(b"VOICE:"):
+                        sent = int.from_bytes(base64.b64decode(line[6:18])[:8], 'big')
+                        stats['voice_latency'].append((time.monotonic_ns() - sent) // 1000)
+                    else:
+                        on_text(line)
+        except (ConnectionError, ValueError):
+            pass
+
+    async def every(rate, action):
+        # Fixed rate from a random phase, so clients do not fire in lockstep
+        if rate <= 0:
+            return
+        interval = 1 / rate
+        next_at = start_at + random.random() * interval
+        while next_at < stop_at:
+            await asyncio.sleep(next_at - time.monotonic())
+            await action()
+            next_at += interval
+
+    async def chat():
+        send(f"MSG:{time.monotonic_ns()} {config['padding']}")
+        stats['chat_sent'][index % config['rooms']] += 1
+        await writer.drain()
+
+    async def talk_request():
+        send(f"STATUS:START:{nickname}")
+        stats['status_sent'] += 1
+        await asyncio.sleep(TALK_REQUEST_HOLD)
+        send(f"STATUS:STOP:{nickname}")
+        await writer.drain()
+
+    filler = bytes(config['voice_bytes'] - 8)
+    seq = 0
+
+    async def speak():
+        nonlocal seq
+        audio = time.monotonic_ns().to_bytes(8, 'big') + filler
+        if binary:
+            writer.write(voice_frame(0, audio, seq, seq * len(audio) // 2))
+        else:
+            writer.write(b"VOICE:" + base64.b64encode(audio) + b"\n")
+        seq += 1
+        stats['voice_sent'][index % config['rooms']] += 1
+        await writer.drain()
+
+    receiver = asyncio.ensure_future(receive())
+    if config['rooms'] > 1:
+        send(f"ROOM:JOIN:{load_room(index, config['rooms'])}")
+    if talker:
+        send(f"STATUS:START:{nickname}")  # holds the room's floor for the whole run
+    stats['connected'] += 1
+    await asyncio.sleep(max(0.0, start_at - time.monotonic()))
+
+    actions = [every(config['msg_rate'], chat)]
+    if talker:
+        actions.append(every(config['voice_fps'], speak))
+    else:
+        actions.append(every(config['status_rate'], talk_request))
+    await asyncio.gather(*actions)
+    await asyncio.sleep(max(0.0, stop_at + config['drain'] - time.monotonic()))
+    writer.close()
+    await asyncio.gather(receiver, return_exceptions=True)
+
+async def load_clients(port, indices, config, start_at, stop_at):
+    from array import array
+    stats = {
+        'connected': 0, 'errors': 0, 'busy': 0, 'status_sent': 0,
+        'chat_sent': [0] * config['rooms'], 'voice_sent': [0] * config['rooms'],
+        'chat_latency': array('q'), 'voice_latency': array('q'),
+    }
+    cpu_start = time.process_time()
+
+    async def run(index):
+        try:
+            await load_client(index, port, config, start_at, stop_at, stats)
+        except OSError:
+            stats['errors'] += 1
+
+    # Connect gradually over the ramp-up instead of in one burst
+    tasks = []
+    ramp = max(0.0, start_at - time.monotonic() - 1)
+    for index in indices:
+        tasks.append(asyncio.ensure_future(run(index)))
+        await asyncio.sleep(ramp / len(indices))
+    await asyncio.gather(*tasks)
+    stats['cpu_s'] = time.process_time() - cpu_start
+    return stats
+
+def load_worker(port, indices, config, start_at, stop_at):
+    """
+    Entry point of a load generator process.
+    """
+    return asyncio.run(load_clients(port, indices, config, start_at, stop_at))
+
+def sample_server(pid, stop, samples):
+    """
+    Record the server's peak RSS until `stop` is set.
+    """
+    while not stop.wait(0.25):
+        try:
+            rss, threads = process_stats(pid)
+        except OSError:
+            break
+        samples['rss_peak_kib'] = max(samples.get('rss_peak_kib', 0), rss)
+        samples['threads_peak'] = max(samples.get('threads_peak', 0), threads)
+
+def load_scenario(port, pid, config):
+    """
+    Drive one running server with `clients` simulated users spread over
+    `workers` generator processes and summarize what they measured.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    clients, workers = config['clients'], config['workers']
+    start_at = time.monotonic() + config['ramp']
+    stop_at = start_at + config['duration']
+    stop = threading.Event()
+    samples = {}
+    sampler = threading.Thread(target=sample_server, args=(pid, stop, samples), daemon=True)
+    sampler.start()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(load_worker, port, list(range(w, clients, workers)), config, start_at, stop_at)
+                   for w in range(workers)]
+        time.sleep(max(0.0, start_at - time.monotonic()))
+        cpu_start = process_cpu_seconds(pid)
+        time.sleep(max(0.0, stop_at - time.monotonic()))
+        cpu_used = process_cpu_seconds(pid) - cpu_start
+        results = [future.result() for future in futures]
+    stop.set()
+    sampler.join()
+
+    from array import array
+    chat_latency, voice_latency = array('q'), array('q')
+    chat_sent = [0] * config['rooms']
+    voice_sent = [0] * config['rooms']
+    for stats in results:
+        chat_latency.extend(stats['chat_latency'])
+        voice_latency.extend(stats['voice_latency'])
+        chat_sent = [a + b for a, b in zip(chat_sent, stats['chat_sent'])]
+        voice_sent = [a + b for a, b in zip(voice_sent, stats['voice_sent'])]
+    members = [len(range(room, clients, config['rooms'])) for room in range(config['rooms'])]
+    seconds = config['duration'] + config['drain']
+    chat = latency_summary(chat_latency, sum(chat_sent), seconds)
+    # The server echoes chat and voice to their sender as well
+    chat['expected'] = sum(sent * size for sent, size in zip(chat_sent, members))
+    voice = latency_summary(voice_latency, sum(voice_sent), seconds)
+    voice['expected'] = sum(sent * size for sent, size in zip(voice_sent, members))
+    return {
+        'connected': sum(stats['connected'] for stats in results),
+        'errors': sum(stats['errors'] for stats in results),
+        'chat': chat,
+        'voice': voice,
+        'status': {'sent': sum(stats['status_sent'] for stats in results),
+                   'busy': sum(stats['busy'] for stats in results)},
+        'server_cpu_pct': cpu_used / config['duration'] * 100,
+        'server_rss_peak_kib': samples.get('rss_peak_kib', 0),
+        'server_threads_peak': samples.get('threads_peak', 0),
+        'generator_cpu_pct': sum(stats['cpu_s'] for stats in results) / (config['ramp'] + seconds) / workers * 100,
+    }
+
+def script_revision(path):
+    """
+    Git revision of the checkout holding `path`, or None.
+    """
+    try:
+        return subprocess.run(['git', '-C', os.path.dirname(os.path.abspath(path)), 'describe', '--always', '--dirty'],
+                              capture_output=True, text=True, check=True).stdout.strip() or None
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_load(args):
+    """
+    Load test one server build with a configurable mix of chat, talk
+    requests and voice, per engine. Prints a summary and optionally writes
+    machine-readable results for `compare`.
+    """
+    limit = raise_open_files_limit()
+    if args.clients + 64 > limit:
+        print(f"warning: {args.clients} clients but only {limit} open files allowed", file=sys.stderr)
+    config = {
+        'clients': args.clients, 'rooms': args.rooms, 'workers': args.workers, 'protocol': args.protocol,
+        'msg_rate': args.msg_rate, 'status_rate': args.status_rate, 'talkers': min(args.talkers, args.rooms),
+        'voice_fps': args.voice_fps, 'voice_bytes': max(args.voice_bytes, 8), 'padding': 'x' * args.msg_bytes,
+        'duration': args.duration, 'ramp': args.ramp, 'drain': args.drain,
+    }
+    if args.server_workers > 1:
+        # Left out otherwise, so reports of single-process runs still compare without a warning
+        config['server_workers'] = args.server_workers
+    results = {}
+    for engine in args.engines:
+        port = free_port()
+        # Only passed when asked for, so older builds still run
+        extra = ['--workers', str(args.server_workers)] if args.server_workers > 1 else []
+        proc = start_server_process(engine, port, extra, script=args.server, rate_limits=True)
+        try:
+            results[engine] = load_scenario(port, proc.pid, config)
+        finally:
+            proc.kill()
+            proc.wait()
+
+    print(f"{args.clients} clients in {args.rooms} rooms, {args.protocol} protocol, {args.duration:.0f} s; "
+          f"server {args.server}" + (f" with {args.server_workers} workers" if args.server_workers > 1 else ""))
+    print(f"{'engine':<10} {'kind':<6} {'sent':>8} {'delivered':>10} {'lost':>7} {'per s':>9} "
+          f"{'p50 ms':>8} {'p99 ms':>8} {'p999 ms':>8}")
+    for engine, r in results.items():
+        for kind in ('chat', 'voice'):
+            s = r[kind]
+            lost = 1 - s['delivered'] / s['expected'] if s['expected'] else 0.0
+            print(f"{engine:<10} {kind:<6} {s['sent']:>8} {s['delivered']:>10} {lost:>7.1%} {s['per_s']:>9.0f} "
+                  f"{s['p50_ms']:>8.1f} {s['p99_ms']:>8.1f} {s['p999_ms']:>8.1f}")
+        print(f"{engine:<10} server CPU {r['server_cpu_pct']:.0f}%, peak RSS {r['server_rss_peak_kib'] / 1024:.1f} MiB, "
+              f"{r['status']['sent']} talk requests ({r['status']['busy']} busy), "
+              f"{r['connected']}/{args.clients} connected, generator CPU {r['generator_cpu_pct']:.0f}%")
+        if r['generator_cpu_pct'] > GENERATOR_BUSY_PCT:
+            print(f"{engine:<10} warning: the load generator was saturated; latencies include its own delays "
+                  f"(use more --workers)", file=sys.stderr)
+
+    if args.json:
+        report = {'scenario': 'load', 'server': os.path.abspath(args.server),
+                  'revision': script_revision(args.server), 'config': config, 'results': results}
+        if args.json == '-':
+            json.dump(report, sys.stdout, indent=2)
+            print()
+        else:
+            with open(args.json, 'w') as f:
+                json.dump(report, f, indent=2)
+    return results
+
+def metric_value(result, path):
+    for key in path:
+        result = result[key]
+    return result
+
+def run_compare(args):
+    """
+    Compare two `load --json` reports and exit with status 1 if any metric
+    got worse by more than the tolerance.
+    """
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+    if baseline['config'] != candidate['config']:
+        print("warning: the reports were produced with different load settings", file=sys.stderr)
+
+    print(f"baseline  {baseline['server']} ({baseline.get('revision') or 'unknown revision'})")
+    print(f"candidate {candidate['server']} ({candidate.get('revision') or 'unknown revision'})")
+    print(f"{'engine':<10} {'metric':<20} {'baseline':>10} {'candidate':>10} {'change':>8}")
+    regressions = 0
+    for engine in baseline['results']:
+        if engine not in candidate['results']:
+            continue
+        for path, label, higher_is_better in LOAD_METRICS:
+            old = metric_value(baseline['results'][engine], path)
+            new = metric_value(candidate['results'][engine], path)
+            change = (new - old) / old * 100 if old else 0.0
+            worse = -change if higher_is_better else change
+            flag = ''
+            if worse > args.tolerance:
+                flag = '  REGRESSION'
+                regressions += 1
+            print(f"{engine:<10} {label:<20} {old:>10.1f} {new:>10.1f} {change:>+7.1f}%{flag}")
+    if regressions:
+        sys.exit(1)
+    return regressions
+
+def scrape_metrics(port, stop, counts):
+    """
+    Scrape the metrics endpoint every second until `stop` is set, as a
+    monitoring system would.
+    """
+    import urllib.request
+    while not stop.wait(1.0):
+        try:
+            with urllib.request.urlopen(f"http://{BENCH_HOST}:{port}/metrics", timeout=5) as response:
+                response.read()
+            counts['scrapes'] += 1
+        except OSError:
+            counts['errors'] += 1
+
+def run_metrics(args):
+    """
+    Measure the cost of instrumentation: broadcast() and lock round trips
+    in-process with metrics off and on, then a load test of each engine
+    without and with --metrics-port while the endpoint is scraped.
+    """
+    import server
+    from metrics import Metrics
+
+    conns = [null_connection(binary=i % 2 == 0) for i in range(args.room_size)]
+    for i, conn in enumerate(conns):
+        room = server.add_client(conn, f"bench{i}", room_name='metrics')
+    plain_lock = server.clients_lock
+    # Off and on runs alternate and the best of each counts, to keep
+    # other load on the machine out of the comparison
+    timings = {False: (float('inf'), float('inf')), True: (float('inf'), float('inf'))}
+    for _ in range(args.repeats):
+        for enabled in (False, True):
+            server.metrics = Metrics() if enabled else None
+            lock = server.metrics.timed_lock('bench', plain_lock) if enabled else plain_lock
+            start = time.perf_counter()
+            for _ in range(args.broadcasts):
+                server.broadcast(room, "MSG:bench: instrumented")
+            broadcast_time = (time.perf_counter() - start) / args.broadcasts
+            for conn in conns:
+                conn.queue.pop_batch()
+            start = time.perf_counter()
+            for _ in range(args.broadcasts * 10):
+                with lock:
+                    pass
+            lock_time = (time.perf_counter() - start) / (args.broadcasts * 10)
+            best = timings[enabled]
+            timings[enabled] = (min(best[0], broadcast_time), min(best[1], lock_time))
+    server.metrics = None
+    for conn in conns:
+        server.discard_client(conn)
+
+    print(f"in-process, room of {args.room_size}:")
+    print(f"{'metrics':<8} {'broadcast us':>13} {'ns/recipient':>13} {'lock ns':>8}")
+    for enabled, (broadcast_time, lock_time) in timings.items():
+        print(f"{'on' if enabled else 'off':<8} {broadcast_time * 1e6:>13.1f} "
+              f"{broadcast_time / args.room_size * 1e9:>13.0f} {lock_time * 1e9:>8.0f}")
+    overhead = timings[True][0] / timings[False][0] - 1
+    print(f"broadcast overhead {overhead:+.1%}")
+
+    config = {
+        'clients': args.clients, 'rooms': args.rooms, 'workers': args.workers, 'protocol': 'mixed',
+        'msg_rate': args.msg_rate, 'status_rate': 0.05, 'talkers': min(args.talkers, args.rooms),
+        'voice_fps': 43.0, 'voice_bytes': 2048, 'padding': 'x' * 40,
+        'duration': args.duration, 'ramp': args.ramp, 'drain': 2.0,
+    }
+    rows = []
+    for engine in args.engines:
+        for enabled in (False, True):
+            port = free_port()
+            metrics_port = free_port()
+            extra = ['--metrics-port', str(metrics_port)] if enabled else []
+            proc = start_server_process(engine, port, extra)
+            stop = threading.Event()
+            counts = {'scrapes': 0, 'errors': 0}
+            scraper = threading.Thread(target=scrape_metrics, args=(metrics_port, stop, counts), daemon=True)
+            if enabled:
+                scraper.start()
+            try:
+                result = load_scenario(port, proc.pid, config)
+            finally:
+                stop.set()
+                proc.kill()
+                proc.wait()
+            if enabled:
+                scraper.join()
+            rows.append((engine, enabled, result, counts))
+    if not rows:
+        return timings, rows
+
+    print(f"\nload test, {args.clients} clients for {args.duration:.0f} s (scraped every second when on):")
+    print(f"{'engine':<10} {'metrics':<8} {'server CPU %':>13} {'chat p50 ms':>12} {'chat p99 ms':>12} "
+          f"{'voice p99 ms':>13} {'scrapes':>8}")
+    for engine, enabled, r, counts in rows:
+        print(f"{engine:<10} {'on' if enabled else 'off':<8} {r['server_cpu_pct']:>13.1f} "
+              f"{r['chat']['p50_ms']:>12.1f} {r['chat']['p99_ms']:>12.1f} {r['voice']['p99_ms']:>13.1f} "
+              f"{counts['scrapes'] if enabled else '-':>8}")
+    return timings, rows
+
+def python_mix(rows):
+    """
+    The mixing step in pure Python, sample by sample. Kept as the baseline
+    for the NumPy mixer.
+    """
+    def clip(value):
+        return -32768 if value < -32768 else 32767 if value > 32767 else value
+    total = [sum(column) for column in zip(*rows)]
+    return [clip(value) for value in total], [[clip(t - v) for t, v in zip(total, row)] for row in rows]
+
+def run_mixer(args):
+    """
+    Cost of one mixing tick for a growing number of talkers in one room:
+    decoding, mixing, encoding and queuing a frame for every member,
+    against relaying every talker's frames, and the downlink of a listener
+    in each mode. Half the members are binary clients that offered mu-law.
+    """
+    from array import array
+    import server
+    from mixer import MIX_TICK, PREFILL_TICKS, Mixer
+    from codec import ULawCodec
+
+    mixer = Mixer()
+    samples = mixer.tick_samples
+    voice = synthetic_voice(mixer.rate, 2.0)
+    frames = [voice[i:i + samples * 2] for i in range(0, len(voice) - samples * 2, samples * 2)]
+    server.mixed_rooms = frozenset(['mixed'])
+    rows = []
+    for talkers in args.talkers:
+        result = {'talkers': talkers}
+        for mode in ('relay', 'mixed'):
+            conns = [null_connection(binary=i % 2 == 0) for i in range(args.room_size)]
+            for i, conn in enumerate(conns):
+                if conn.binary:
+                    conn.codecs = frozenset([0, ULawCodec.codec_id])
+                room = server.add_client(conn, f"bench{i}", room_name=mode)
+            speakers = conns[:talkers]
+            start = time.perf_counter()
+            for tick in range(args.ticks):
+                audio = frames[tick % len(frames)]
+                for conn in speakers:
+                    if mode == 'mixed':
+                        room.mixer.push(conn, 0, audio)
+                    else:
+                        server.broadcast(room, server.Outgoing(audio=audio, codec=0, seq=tick,
+                                                               timestamp=tick * samples))
+                if mode == 'mixed':
+                    server.send_mix(room)
+            elapsed = (time.perf_counter() - start) / args.ticks
+            # Downlink of the listeners that are not talking, per second of voice
+            listeners = conns[talkers:]
+            received = sum(sum(map(len, conn.queue.pop_batch())) for conn in listeners)
+            result[mode] = (elapsed, received / len(listeners) / (args.ticks * MIX_TICK) / 1024)
+            for conn in conns:
+                conn.queue.pop_batch()
+                server.discard_client(conn)
+
+        signal = [array('h', frame) for frame in frames[:talkers]]
+        stacked = [list(row) for row in signal]
+        start = time.perf_counter()
+        for _ in range(args.repeats):
+            python_mix(stacked)
+        result['python_mix'] = (time.perf_counter() - start) / args.repeats
+        # Decoding is timed along with the NumPy mix, which only makes it look worse
+        for _ in range(PREFILL_TICKS):
+            for source, row in enumerate(signal):
+                mixer.push(source, 0, row)
+        start = time.perf_counter()
+        for _ in range(args.repeats):
+            for source, row in enumerate(signal):
+                mixer.push(source, 0, row)
+            mixer.mix()
+        result['numpy_mix'] = (time.perf_counter() - start) / args.repeats
+        rows.append(result)
+
+    print(f"room of {args.room_size}, {MIX_TICK * 1000:.0f} ms tick; tick cost includes queuing for every member")
+    print(f"{'talkers':>8} {'relay us/tick':>14} {'mixed us/tick':>14} {'% of tick':>10} "
+          f"{'relay KiB/s':>12} {'mixed KiB/s':>12} {'python mix us':>14} {'numpy mix us':>13}")
+    for r in rows:
+        print(f"{r['talkers']:>8} {r['relay'][0] * 1e6:>14.0f} {r['mixed'][0] * 1e6:>14.0f} "
+              f"{r['mixed'][0] / MIX_TICK * 100:>10.1f} {r['relay'][1]:>12.1f} {r['mixed'][1]:>12.1f} "
+              f"{r['python_mix'] * 1e6:>14.0f} {r['numpy_mix'] * 1e6:>13.0f}")
+    return rows
+
+class ReplaySocket:
+    """
+    Stands in for a connected socket: hands out recorded traffic, at most
+    `chunk` bytes per read, the way a busy TCP stream arrives.
+    """
+
+    def __init__(self, data, chunk):
+        self.data = memoryview(data)
+        self.chunk = chunk
+        self.pos = 0
+
+    def recv(self, size):
+        end = min(self.pos + min(size, self.chunk), len(self.data))
+        data = bytes(self.data[self.pos:end])
+        self.pos = end
+        return data
+
+    def recv_into(self, view):
+        end = min(self.pos + min(len(view), self.chunk), len(self.data))
+        size = end - self.pos
+        view[:size] = self.data[self.pos:end]
+        self.pos = end
+        return size
+
+def legacy_server_lines(sock, recv_size):
+    """
+    The server's line loop before framing.Receiver: bytes appended and
+    split per read, every line decoded. Kept as a parser baseline.
+    """
+    count = 0
+    buffer = b""
+    while True:
+        data = sock.recv(recv_size)
+        if not data:
+            return count
+        buffer += data
+        *lines, buffer = buffer.split(b'\n')
+        for line in lines:
+            if line.decode('utf-8', errors='ignore').strip():
+                count += 1
+
+def legacy_client_lines(sock, recv_size):
+    """
+    The client's line loop before framing.Receiver: decoded to str per
+    read, one line split off the front at a time.
+    """
+    count = 0
+    buffer = ""
+    while True:
+        data = sock.recv(recv_size)
+        if not data:
+            return count
+        buffer += data.decode('utf-8', errors='ignore')
+        while '\n' in buffer:
+            message, buffer = buffer.split('\n', 1)
+            if message.strip():
+                count += 1
+
+def legacy_frames(sock, recv_size):
+    """
+    The frame loop before framing.Receiver, with FrameDecoder.
+    """
+    from protocol import FRAME_TEXT, FrameDecoder
+    count = 0
+    decoder = FrameDecoder()
+    while True:
+        data = sock.recv(recv_size)
+        if not data:
+            return count
+        for frame_type, payload in decoder.feed(data):
+            if frame_type == FRAME_TEXT:
+                str(payload, 'utf-8', errors='ignore').strip()
+            count += 1
+
+def receiver_lines(sock, recv_size):
+    from framing import Receiver
+    count = 0
+    receiver = Receiver(sock, capacity=recv_size)
+    while receiver.fill():
+        for line in receiver.lines():
+            if line.strip():
+                count += 1
+    return count
+
+def receiver_frames(sock, recv_size):
+    from framing import Receiver
+    from protocol import FRAME_TEXT
+    count = 0
+    receiver = Receiver(sock, capacity=recv_size)
+    while receiver.fill():
+        for frame_type, payload in receiver.frames():
+            if frame_type == FRAME_TEXT:
+                str(payload, 'utf-8', errors='ignore').strip()
+            count += 1
+    return count
+
+def parser_traffic(kind, protocol, size, voice_bytes, chat_per_voice):
+    """
+    About `size` bytes of client traffic: chat only, voice only, or
+    `chat_per_voice` chat messages per voice frame. Returns (data, messages).
+    """
+    from protocol import text_frame, voice_frame
+    rng = random.Random(13)
+    audio = bytes(rng.getrandbits(8) for _ in range(voice_bytes))
+    if protocol == 'text':
+        voice = b"VOICE:" + base64.b64encode(audio) + b"\n"
+        chat = lambda n: f"MSG:user{n % 100}: message {n} {'x' * (n % 40)}\n".encode('utf-8')
+    else:
+        voice = voice_frame(0, audio)
+        chat = lambda n: text_frame(f"MSG:user{n % 100}: message {n} {'x' * (n % 40)}")
+    parts = []
+    total = n = 0
+    while total < size:
+        if kind == 'voice' or (kind == 'mixed' and n % (chat_per_voice + 1) == 0):
+            part = voice
+        else:
+            part = chat(n)
+        parts.append(part)
+        total += len(part)
+        n += 1
+    return b"".join(parts), n
+
+def run_parser(args):
+    """
+    Time the receive-side parsers on recorded traffic, without sockets:
+    the loops used before framing.Receiver against the Receiver, for each
+    traffic mix and read size.
+    """
+    parsers = {
+        'text': [('server bytes split', legacy_server_lines), ('client str split', legacy_client_lines),
+                 ('Receiver.lines', receiver_lines)],
+        'binary': [('FrameDecoder', legacy_frames), ('Receiver.frames', receiver_frames)],
+    }
+    size = int(args.megabytes * 1024 * 1024)
+    results = []
+    print(f"{'protocol':<8} {'traffic':<7} {'recv':>6} {'parser':<20} {'MB/s':>8} {'ns/msg':>8}")
+    for protocol in args.protocols:
+        for kind in args.traffic:
+            data, messages = parser_traffic(kind, protocol, size, args.voice_bytes, args.chat_per_voice)
+            for recv_size in args.recv_sizes:
+                for name, parse in parsers[protocol]:
+                    best = float('inf')
+                    for _ in range(args.repeats):
+                        sock = ReplaySocket(data, recv_size)
+                        start = time.perf_counter()
+                        count = parse(sock, recv_size)
+                        best = min(best, time.perf_counter() - start)
+                        if count != messages:
+                            raise RuntimeError(f"{name} parsed {count} of {messages} messages")
+                    results.append({'protocol': protocol, 'traffic': kind, 'recv': recv_size, 'parser': name,
+                                    'mb_per_s': len(data) / best / 1e6, 'ns_per_msg': best / messages * 1e9})
+                    r = results[-1]
+                    print(f"{protocol:<8} {kind:<7} {recv_size:>6} {name:<20} {r['mb_per_s']:>8.1f} "
+                          f"{r['ns_per_msg']:>8.0f}")
+    return results
+
+def python_features(samples):
+    """
+    The detector's features in pure Python, the baseline of the vad scenario.
+    """
+    power = sum(s * s for s in samples) / (len(samples) * 32768.0 * 32768.0)
+    energy = 10 * math.log10(power) if power > 0 else -127.0
+    crossings = sum(1 for a, b in zip(samples, samples[1:]) if (a < 0) != (b < 0))
+    return energy, crossings / (len(samples) - 1)
+
+def run_vad(args):
+    """
+    Silence suppression on synthetic push-to-talk audio: talk spurts with
+    pauses between them, over background noise. For each codec and noise
+    level, the share of speech and of pause frames sent, the bytes on the
+    wire against sending everything, and the detector's cost per frame.
+    """
+    import numpy as np
+    from codec import ComfortNoiseCodec, available_codecs, create_codec
+    from protocol import voice_frame
+    from vad import SID, VOICE, VoiceActivityDetector
+
+    rng = np.random.default_rng(1)
+    rows = []
+    for name in available_codecs():
+        codec = create_codec(name)
+        rate, step = codec.sample_rate, codec.frame_size
+        speech = np.frombuffer(synthetic_voice(rate, args.talk), np.int16)
+        cycle = int(rate * (args.talk + args.pause))
+        count = int(rate * args.seconds)
+        is_speech = np.arange(count) % cycle < len(speech)
+        voice = np.zeros(count)
+        for start in range(0, count, cycle):
+            end = min(start + len(speech), count)
+            voice[start:end] = speech[:end - start]
+        for noise_db in args.noise_db:
+            noise = rng.normal(0, 32768 * 10 ** (noise_db / 20), count)
+            pcm = np.clip(voice + noise, -32768, 32767).astype(np.int16)
+            chunks = [pcm[i:i + step].tobytes() for i in range(0, count - step + 1, step)]
+            truth = [bool(is_speech[i:i + step].any()) for i in range(0, count - step + 1, step)]
+            vad = VoiceActivityDetector(rate, step)
+            vad.start()
+            sent = {True: 0, False: 0}
+            wire = everything = 0
+            start = time.perf_counter()
+            decisions = [vad.process(chunk) for chunk in chunks]
+            elapsed = (time.perf_counter() - start) / len(chunks)
+            for chunk, decision, speaking in zip(chunks, decisions, truth):
+                size = len(voice_frame(codec.codec_id, codec.encode(chunk)))
+                everything += size
+                if decision == VOICE:
+                    sent[speaking] += 1
+                    wire += size
+                elif decision == SID:
+                    wire += len(voice_frame(ComfortNoiseCodec.codec_id, ComfortNoiseCodec().encode(vad.noise_level)))
+            samples = np.frombuffer(chunks[0], np.int16).tolist()
+            start = time.perf_counter()
+            for _ in range(args.repeats):
+                python_features(samples)
+            python_cost = (time.perf_counter() - start) / args.repeats
+            speaking = sum(truth)
+            rows.append({'codec': name, 'noise_db': noise_db, 'frames': len(chunks),
+                         'speech_sent': sent[True] / speaking, 'pause_sent': sent[False] / (len(chunks) - speaking),
+                         'suppressed': vad.suppressed_fraction, 'descriptors': vad.descriptors,
+                         'wire': wire / everything, 'us_per_frame': elapsed * 1e6,
+                         'python_us': python_cost * 1e6, 'frame_ms': step / rate * 1000})
+
+    print(f"{args.talk:g} s talk spurts, {args.pause:g} s pauses, {args.seconds:g} s per run")
+    print(f"{'codec':<6} {'noise dBFS':>10} {'speech sent':>12} {'pauses sent':>12} {'suppressed':>11} "
+          f"{'SIDs':>5} {'bytes sent':>11} {'vad us':>7} {'python us':>10} {'frame ms':>9}")
+    for r in rows:
+        print(f"{r['codec']:<6} {r['noise_db']:>10g} {r['speech_sent']:>12.1%} {r['pause_sent']:>12.1%} "
+              f"{r['suppressed']:>11.1%} {r['descriptors']:>5} {r['wire']:>11.1%} {r['us_per_frame']:>7.1f} "
+              f"{r['python_us']:>10.0f} {r['frame_ms']:>9.1f}")
+    return rows
+
+class LossyProxy:
+    """
+    Forwards one client connection to the server over loopback, losing
+    each chunk the server sends with probability `loss`. A lost chunk is
+    held back for a retransmission timeout, and everything sent after it
+    waits behind it, as TCP delivers in order.
+    """
+
+    def __init__(self, port, loss, timeout=0.2):
+        self.upstream = port
+        self.loss = loss
+        self.timeout = timeout
+        self.listener = socket.create_server((BENCH_HOST, 0))
+        self.port = self.listener.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        client, _ = self.listener.accept()
+        server = socket.create_connection((BENCH_HOST, self.upstream))
+        threading.Thread(target=self._pump, args=(client, server, 0.0), daemon=True).start()
+        self._pump(server, client, self.loss)
+
+    def _pump(self, source, sink, loss):
+        rng = random.Random()
+        try:
+            while True:
+                data = source.recv(65536)
+                if not data:
+                    break
+                if loss and rng.random() < loss:
+                    time.sleep(self.timeout)
+                sink.sendall(data)
+        except OSError:
+            pass
+        finally:
+            sink.close()
+
+def media_run(port, transport, loss, seconds, fps, block=None):
+    """
+    One talker streams 20 ms mu-law frames and a chat message every 100 ms
+    over an unimpaired connection; one listener receives both through a
+    LossyProxy and, for `transport` 'udp', its voice over the media channel
+    with the same loss. With `block`, the listener's UDP traffic is dropped
+    from the start (0) or from `block` seconds into the stream on, and it
+    falls back to TCP as client.py does. Returns the voice and chat
+    latencies in microseconds, the frame count, and for `block` the
+    seconds it took to fall back (None if it never did) and the share of
+    the frames sent after that which arrived over TCP.
+    """
+    from framing import Receiver
+    from media import MediaLink
+    from protocol import (
+        FRAME_VOICE, MEDIA_OFF, MEDIA_ON, MEDIA_REQUEST, hello_line, parse_media_offer, parse_voice, text_frame,
+        voice_frame
+    )
+
+    stamp = struct.Struct('!d')
+    voice, chat = [], []
+    ready = threading.Event()
+    over_tcp = set()  # sequence numbers of the frames received as VOICE frames
+    fell_back = []
+    opened = []
+
+    def on_voice(payload):
+        audio = parse_voice(payload)[3]
+        voice.append((time.perf_counter() - stamp.unpack_from(audio)[0]) * 1e6)
+
+    proxy = LossyProxy(port, loss)
+    listener = socket.create_connection((BENCH_HOST, proxy.port))
+    listener.sendall(hello_line("listener", ['ulaw', 'pcm']))
+    talker = socket.create_connection((BENCH_HOST, port))
+    talker.sendall(hello_line("talker", ['ulaw', 'pcm']))
+    links = []
+
+    def on_state(up):
+        listener.sendall(text_frame(MEDIA_ON if up else MEDIA_OFF))
+        if not up:
+            fell_back.append(time.perf_counter())
+        ready.set()
+
+    def listen():
+        receiver = Receiver(listener)
+        while receiver.line() is None:
+            receiver.fill()
+        if transport == 'udp':
+            listener.sendall(text_frame(MEDIA_REQUEST))
+        else:
+            ready.set()
+        try:
+            while True:
+                for frame_type, payload in receiver.frames():
+                    if frame_type == FRAME_VOICE:
+                        on_voice(payload)
+                        over_tcp.add(parse_voice(payload)[1])
+                        continue
+                    message = str(payload, 'utf-8')
+                    if message.startswith("MSG:talker: "):
+                        chat.append((time.perf_counter() - float(message[len("MSG:talker: "):])) * 1e6)
+                    elif message.startswith("MEDIA:OFFER:"):
+                        udp_port, token = parse_media_offer(message)
+                        link = MediaLink(BENCH_HOST, udp_port, token, on_voice, on_state,
+                                         1.0 if block == 0 else loss)
+                        links.append(link)
+                        opened.append(time.perf_counter())
+                        link.start()
+                if not receiver.fill():
+                    break
+        except OSError:
+            pass
+
+    def drain_talker():
+        try:
+            while talker.recv(65536):
+                pass
+        except OSError:
+            pass
+
+    threading.Thread(target=listen, daemon=True).start()
+    threading.Thread(target=drain_talker, daemon=True).start()
+    if not ready.wait(5):
+        raise RuntimeError("the media channel did not come up")
+    time.sleep(0.2)
+    frames = int(seconds * fps)
+    sent_at = []
+    start = time.perf_counter()
+    blocked_at = opened[0] if block == 0 and opened else None
+    for seq in range(frames):
+        now = time.perf_counter()
+        if block and blocked_at is None and now - start >= block:
+            blocked_at = now
+            for link in links:
+                link.loss = 1.0
+        sent_at.append(now)
+        talker.sendall(voice_frame(1, stamp.pack(now) + bytes(152), seq, seq * 160))
+        if seq % max(1, int(fps / 10)) == 0:
+            talker.sendall(text_frame(f"MSG:{now!r}"))
+        delay = start + (seq + 1) / fps - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+    time.sleep(1.0)
+    for link in links:
+        link.close()
+    listener.close()
+    talker.close()
+    if block is None:
+        return voice, chat, frames, None, None
+    if not fell_back:
+        return voice, chat, frames, None, 0.0
+    # Frames the server may still have sent as datagrams before it got MEDIA:OFF are not counted
+    later = [seq for seq in range(frames) if sent_at[seq] > fell_back[0] + 0.1]
+    return (voice, chat, frames, fell_back[0] - blocked_at,
+            sum(1 for seq in later if seq in over_tcp) / len(later) if later else 0.0)
+
+def run_media(args):
+    """
+    Voice and chat latency to a listener on a lossy path, with voice over
+    TCP (where a loss stalls everything behind it) and over the UDP media
+    channel (where it only loses the one frame). Then the fallback to TCP
+    when UDP is blocked from the start, and when it stops getting through
+    mid-stream. Exits with status 1 if voice was delivered or on time less
+    often than the thresholds allow, or did not come back over TCP.
+    """
+    from media import MEDIA_TIMEOUT, PROBE_TIMEOUT
+
+    results = {}
+    fallbacks = {}
+    for engine in args.engines:
+        port = free_port()
+        proc = start_server_process(engine, port, ['--media-port', '0'])
+        try:
+            for loss in args.loss:
+                for transport in ('tcp', 'udp'):
+                    voice, chat, frames, _, _ = media_run(port, transport, loss, args.seconds, args.fps)
+                    voice.sort()
+                    chat.sort()
+                    results[engine, loss, transport] = {
+                        'delivered': len(voice) / frames,
+                        'on_time': sum(1 for v in voice if v <= args.deadline * 1000) / frames,
+                        'voice_p50_ms': percentile(voice, 0.5) / 1000,
+                        'voice_p99_ms': percentile(voice, 0.99) / 1000,
+                        'chat_p50_ms': percentile(chat, 0.5) / 1000,
+                        'chat_p99_ms': percentile(chat, 0.99) / 1000,
+                    }
+            # Long enough for the channel to time out and a few seconds of voice after that
+            for case, block, seconds in (('blocked', 0, PROBE_TIMEOUT + 3), ('cut', 1.0, 1 + MEDIA_TIMEOUT + 3)):
+                _, _, _, after, over_tcp = media_run(port, 'udp', 0.0, seconds, args.fps, block)
+                fallbacks[engine, case] = {'fallback_s': after, 'over_tcp': over_tcp}
+        finally:
+            proc.terminate()
+            proc.wait()
+
+    print(f"{args.seconds:g} s of {args.fps:g} frames/s; TCP loss stalls the stream for 200 ms; "
+          f"on time = within {args.deadline:g} ms")
+    print(f"{'engine':<9} {'loss':>5} {'voice':>6} {'delivered':>10} {'on time':>8} {'voice p50':>10} "
+          f"{'voice p99':>10} {'chat p50':>9} {'chat p99':>9}")
+    failed = []
+    for (engine, loss, transport), r in results.items():
+        print(f"{engine:<9} {loss:>5.0%} {transport:>6} {r['delivered']:>10.1%} {r['on_time']:>8.1%} "
+              f"{r['voice_p50_ms']:>10.1f} {r['voice_p99_ms']:>10.1f} {r['chat_p50_ms']:>9.1f} "
+              f"{r['chat_p99_ms']:>9.1f}")
+        if r['delivered'] < args.min_delivered:
+            failed.append(f"{engine} {transport} at {loss:.0%} loss delivered {r['delivered']:.1%}")
+        # TCP is expected to be late under loss; that is what the media channel is for
+        if (transport == 'udp' or not loss) and r['on_time'] < args.min_on_time:
+            failed.append(f"{engine} {transport} at {loss:.0%} loss on time {r['on_time']:.1%}")
+    print("UDP blocked from the start, and from 1 s into the stream on:")
+    print(f"{'engine':<9} {'case':<8} {'fallback s':>11} {'then over TCP':>14}")
+    for (engine, case), r in fallbacks.items():
+        after = f"{r['fallback_s']:.1f}" if r['fallback_s'] is not None else "never"
+        print(f"{engine:<9} {case:<8} {after:>11} {r['over_tcp']:>14.1%}")
+        if r['fallback_s'] is None or r['over_tcp'] < args.min_delivered:
+            failed.append(f"{engine} {case}: fell back {after}, then {r['over_tcp']:.1%} over TCP")
+    if failed:
+        print(f"FAILED: {'; '.join(failed)}")
+        sys.exit(1)
+    return results, fallbacks
+
+def chat_views(scrollback):
+    """
+    (kind, append one line, append a batch of lines, process GUI events)
+    for the two ways of rendering chat: the client's earlier QTextEdit and
+    its capped QPlainTextEdit, on Qt's offscreen platform. Without PyQt5,
+    plain lists stand in for both, which leaves only the cost of handing
+    lines over to measure.
+    """
+    try:
+        os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+        from PyQt5.QtWidgets import QApplication, QPlainTextEdit, QTextEdit
+    except ImportError:
+        unbounded = []
+        capped = []
+
+        def append_batch(text):
+            capped.extend(text.split('\n'))
+            del capped[:-scrollback]
+        return 'list', unbounded.append, append_batch, lambda: None
+    app = QApplication.instance() or QApplication([])
+    old, new = QTextEdit(), QPlainTextEdit()
+    old.setReadOnly(True)
+    new.setReadOnly(True)
+    new.setMaximumBlockCount(scrollback)
+    for view in (old, new):
+        view.resize(600, 400)
+        view.show()
+    return 'qt', old.append, new.appendPlainText, app.processEvents
+
+def chat_feed(post, rate, seconds):
+    """
+    Post (time posted, text) lines at `rate` per second from a thread of
+    its own, as the client's network thread would. Returns the thread.
+    """
+    def feed():
+        start = time.perf_counter()
+        count = int(rate * seconds)
+        for i in range(count):
+            delay = start + i / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            post((time.perf_counter(), f"user{i % 50}: message {i} " + "x" * (i % 60)))
+
+    thread = threading.Thread(target=feed, daemon=True)
+    thread.start()
+    return thread
+
+def chat_run(mode, rate, seconds, view):
+    """
+    Feed chat lines to a simulated GUI thread, one event per line
+    ('per-line') or through a ChatLog flushed every FLUSH_INTERVAL
+    ('batched'). Returns the GUI thread's busy time, events handled,
+    the longest event and each line's delay until it was rendered.
+    """
+    import queue
+    from chatlog import FLUSH_INTERVAL, ChatLog
+
+    _, append_line, append_batch, process_events = view
+    events = queue.Queue()  # the GUI thread's event queue, fed across threads
+    delays = []
+    busy = longest = 0.0
+    handled = 0
+    if mode == 'batched':
+        log = ChatLog()
+
+        def post(line):
+            if log.post(line):
+                events.put(None)
+    else:
+        post = events.put
+    feed = chat_feed(post, rate, seconds)
+    while True:
+        try:
+            event = events.get(timeout=0.2)
+        except queue.Empty:
+            if not feed.is_alive():
+                break
+            continue
+        if mode == 'batched':
+            # The single-shot timer the signal started
+            time.sleep(FLUSH_INTERVAL / 1000)
+        start = time.perf_counter()
+        if mode == 'batched':
+            lines = log.flush()
+            append_batch('\n'.join(text for _, text in lines))
+        else:
+            lines = [event]
+            append_line(event[1])
+        process_events()
+        end = time.perf_counter()
+        delays.extend((end - posted) * 1e6 for posted, _ in lines)
+        busy += end - start
+        longest = max(longest, end - start)
+        handled += 1
+    return busy, handled, longest, delays
+
+def run_chat(args):
+    """
+    Chat rendering under a synthetic feed: GUI thread time, events and
+    display delay with one append per line against batched appends into
+    a capped view.
+    """
+    from chatlog import FLUSH_INTERVAL, SCROLLBACK
+
+    view = chat_views(SCROLLBACK)
+    results = []
+    for rate in args.rates:
+        for mode in ('per-line', 'batched'):
+            start = time.perf_counter()
+            busy, handled, longest, delays = chat_run(mode, rate, args.seconds, view)
+            elapsed = time.perf_counter() - start
+            delays.sort()
+            results.append({'rate': rate, 'mode': mode, 'lines': len(delays), 'events': handled,
+                            'busy': busy / elapsed, 'longest_ms': longest * 1000,
+                            'p50_ms': percentile(delays, 0.5) / 1000, 'p99_ms': percentile(delays, 0.99) / 1000,
+                            'max_ms': delays[-1] / 1000 if delays else 0.0})
+
+    print(f"views: {view[0]}; {args.seconds:g} s per run, flush every {FLUSH_INTERVAL} ms, "
+          f"scrollback {SCROLLBACK} lines")
+    print(f"{'msg/s':>6} {'mode':<9} {'lines':>7} {'events':>7} {'GUI busy':>9} {'longest ms':>11} "
+          f"{'p50 ms':>7} {'p99 ms':>7} {'max ms':>7}")
+    for r in results:
+        print(f"{r['rate']:>6} {r['mode']:<9} {r['lines']:>7} {r['events']:>7} {r['busy']:>9.1%} "
+              f"{r['longest_ms']:>11.2f} {r['p50_ms']:>7.1f} {r['p99_ms']:>7.1f} {r['max_ms']:>7.1f}")
+    return results
+
+def flood_run(port, pid, listeners, seconds):
+    """
+    `listeners` clients in one room, one of which chats 5 times a second,
+    while another client sends MSG: lines as fast as the server takes
+    them. Returns the probe chat latencies in microseconds, flood lines
+    relayed to the chatting listener, bytes received per listener, server
+    CPU seconds and whether the flooder was still connected at the end.
+    """
+    received = [0] * (listeners + 1)  # the flooder's last
+    latencies, flood = [], [0]
+
+    def drain(sock, index):
+        pending = b""
+        try:
+            while True:
+                data = sock.recv(65536)
+                if not data:
+                    break
+                received[index] += len(data)
+                if index:
+                    continue
+                pending += data
+                *lines, pending = pending.split(b"\n")
+                for line in lines:
+                    if line.startswith(b"MSG:probe: "):
+                        latencies.append((time.perf_counter() - float(line[len(b"MSG:probe: "):])) * 1e6)
+                    elif line.startswith(b"MSG:flooder: "):
+                        flood[0] += 1
+        except OSError:
+            pass
+
+    socks = []
+    for index in range(listeners):
+        sock = socket.create_connection((BENCH_HOST, port))
+        sock.sendall(b"probe\n" if index == 0 else f"listener{index}\n".encode())
+        threading.Thread(target=drain, args=(sock, index), daemon=True).start()
+        socks.append(sock)
+    flooder = socket.create_connection((BENCH_HOST, port))
+    flooder.sendall(b"flooder\n")
+    threading.Thread(target=drain, args=(flooder, listeners), daemon=True).start()
+    connected = [True]
+
+    def flood_loop():
+        burst = b"MSG:" + b"x" * 60 + b"\n"
+        burst *= 100
+        try:
+            while time.perf_counter() < stop:
+                flooder.sendall(burst)
+        except OSError:
+            connected[0] = False
+
+    time.sleep(0.5)
+    cpu_start = process_cpu_seconds(pid)
+    stop = time.perf_counter() + seconds
+    threading.Thread(target=flood_loop, daemon=True).start()
+    while time.perf_counter() < stop:
+        socks[0].sendall(f"MSG:{time.perf_counter()!r}\n".encode())
+        time.sleep(0.2)
+    time.sleep(1.0)
+    cpu = process_cpu_seconds(pid) - cpu_start
+    for sock in socks + [flooder]:
+        sock.close()
+    return latencies, flood[0], sum(received[1:listeners]) / max(1, listeners - 1), cpu, connected[0]
+
+def run_flood(args):
+    """
+    Chat latency and listener downlink while one client floods the room,
+    with and without per-client rate limits, and the cost of checking one
+    message against its limiter.
+    """
+    from ratelimit import RateLimiter
+
+    limiter = RateLimiter({'MSG': (1e9, 10 ** 9)})
+    message = "MSG:" + "x" * 60
+    start = time.perf_counter()
+    for _ in range(args.repeats):
+        limiter.allow(message.partition(':')[0])
+    check_ns = (time.perf_counter() - start) / args.repeats * 1e9
+
+    results = []
+    for engine in args.engines:
+        for limited in (False, True):
+            port = free_port()
+            proc = start_server_process(engine, port, rate_limits=limited)
+            try:
+                latencies, flood, downlink, cpu, connected = flood_run(port, proc.pid, args.listeners, args.seconds)
+            finally:
+                proc.kill()
+                proc.wait()
+            latencies.sort()
+            results.append({'engine': engine, 'limits': limited, 'probes': len(latencies),
+                            'p50_ms': percentile(latencies, 0.5) / 1000, 'p99_ms': percentile(latencies, 0.99) / 1000,
+                            'flood_relayed': flood, 'downlink_kib': downlink / 1024,
+                            'server_cpu_pct': cpu / args.seconds * 100, 'flooder_connected': connected})
+
+    print(f"{args.listeners} listeners, {args.seconds:g} s flood; limiter check {check_ns:.0f} ns per message")
+    print(f"{'engine':<9} {'limits':<7} {'probes':>7} {'chat p50 ms':>12} {'chat p99 ms':>12} {'flood relayed':>14} "
+          f"{'KiB/listener':>13} {'server CPU':>11} {'flooder':>13}")
+    for r in results:
+        print(f"{r['engine']:<9} {'on' if r['limits'] else 'off':<7} {r['probes']:>7} {r['p50_ms']:>12.1f} "
+              f"{r['p99_ms']:>12.1f} {r['flood_relayed']:>14} {r['downlink_kib']:>13.0f} "
+              f"{r['server_cpu_pct']:>10.0f}% {'connected' if r['flooder_connected'] else 'disconnected':>13}")
+    return results
+
+class CutProxy:
+    """
+    Forwards any number of connections to the server over loopback, and
+    can cut them all at once: cut() closes both ends of every connection,
+    as a network failure would, and refuses new ones until restore().
+    """
+
+    def __init__(self, port):
+        self.upstream = port
+        self.listener = socket.create_server((BENCH_HOST, 0))
+        self.port = self.listener.getsockname()[1]
+        self.down = False
+        self._pairs = []
+        self._lock = threading.Lock()
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                client, _ = self.listener.accept()
+            except OSError:
+                break
+            if self.down:
+                client.close()
+                continue
+            try:
+                server = socket.create_connection((BENCH_HOST, self.upstream))
+            except OSError:
+                client.close()
+                continue
+            with self._lock:
+                self._pairs.append((client, server))
+            threading.Thread(target=self._pump, args=(client, server), daemon=True).start()
+            threading.Thread(target=self._pump, args=(server, client), daemon=True).start()
+
+    def _pump(self, source, sink):
+        try:
+            while True:
+                data = source.recv(65536)
+                if not data:
+                    break
+                sink.sendall(data)
+        except OSError:
+            pass
+        finally:
+            for sock in (source, sink):
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def cut(self):
+        self.down = True
+        with self._lock:
+            pairs, self._pairs = self._pairs, []
+        for pair in pairs:
+            for sock in pair:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                sock.close()
+
+    def restore(self):
+        self.down = False
+
+    def close(self):
+        self.cut()
+        # Wakes the accept thread, which close() alone would leave blocked on a reused descriptor
+        try:
+            self.listener.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.listener.close()
+
+
+def resuming_listener(port, nickname, max_delay=1.0):
+    """
+    A text-only ClientCore, reconnecting as client.py does: at once, then
+    backing off exponentially; resuming its session if it has one, else
+    logging in afresh. It records the numbered chat messages it receives
+    and how long each reconnect took.
+    """
+    from clientcore import ClientCore
+
+    class ResumingListener(ClientCore):
+        reconnect_delay = 0.05
+        reconnect_max_delay = max_delay
+
+        def __init__(self):
+            super().__init__(BENCH_HOST, port, voice=False, history=0)
+            self.seen = set()
+            self.duplicates = 0
+            self.out_of_order = 0
+            self.last = -1
+            self.logins = 0
+            self.resumes = 0
+            self.expired = 0
+            self.reconnect_ms = []
+            self._dropped = None
+            self._had_session = False
+
+        def on_chat(self, text):
+            if text.startswith("talker: "):
+                number = int(text[len("talker: "):])
+                if number in self.seen:
+                    self.duplicates += 1
+                elif number < self.last:
+                    self.out_of_order += 1
+                self.seen.add(number)
+                self.last = max(self.last, number)
+
+        def on_connection_lost(self):
+            self._dropped = time.perf_counter()
+            self._had_session = self.session is not None
+
+        def on_reconnected(self, resumed):
+            self.reconnect_ms.append((time.perf_counter() - self._dropped) * 1000)
+            if resumed:
+                self.resumes += 1
+            else:
+                self.logins += 1
+                self.expired += self._had_session
+
+        def log(self, text):
+            pass
+
+    listener = ResumingListener()
+    listener.connect(nickname)
+    listener.logins += 1
+    return listener
+
+
+def reconnect_run(port, listeners, seconds, cuts, outage, rate, fps):
+    """
+    `listeners` clients reach the server through a CutProxy, which drops
+    every connection `cuts` times and refuses new ones for `outage`
+    seconds each time, while a talker sends numbered chat messages at
+    `rate` a second and voice at `fps`, and an observer counts the
+    presence changes it is told about. Returns the listeners, the
+    number of chat messages sent and the JOIN and LEAVE deltas observed.
+    """
+    from framing import Receiver
+    from protocol import FRAME_TEXT, PRESENCE_PREFIX, hello_line, text_frame, voice_frame
+
+    churn = [0]
+
+    def observe(sock):
+        receiver = Receiver(sock)
+        try:
+            while receiver.line() is None:
+                receiver.fill()
+            while True:
+                for frame_type, payload in receiver.frames():
+                    if frame_type == FRAME_TEXT:
+                        message = str(payload, 'utf-8')
+                        if message.startswith((PRESENCE_PREFIX + "JOIN:", PRESENCE_PREFIX + "LEAVE:")):
+                            churn[0] += 1
+                if not receiver.fill():
+                    break
+        except OSError:
+            pass
+
+    def drain(sock):
+        try:
+            while sock.recv(65536):
+                pass
+        except OSError:
+            pass
+
+    proxy = CutProxy(port)
+    clients = [resuming_listener(proxy.port, f"listener{index}") for index in range(listeners)]
+    talker = socket.create_connection((BENCH_HOST, port))
+    talker.sendall(hello_line("talker", ['pcm']))
+    threading.Thread(target=drain, args=(talker,), daemon=True).start()
+    observer = socket.create_connection((BENCH_HOST, port))
+    observer.sendall(hello_line("observer", ['pcm']))
+    time.sleep(0.5)
+    threading.Thread(target=observe, args=(observer,), daemon=True).start()
+    time.sleep(0.2)
+    churn[0] = 0
+
+    sent = 0
+    start = time.perf_counter()
+    cut_times = [start + seconds * (index + 1) / (cuts + 1) for index in range(cuts)]
+    restore_at = None
+    audio = bytes(320)
+    step = 1 / max(rate, fps)
+    chat_every = max(1, round(max(rate, fps) / rate))
+    tick = 0
+    while time.perf_counter() - start < seconds:
+        now = time.perf_counter()
+        if cut_times and now >= cut_times[0]:
+            cut_times.pop(0)
+            proxy.cut()
+            restore_at = now + outage
+        if restore_at is not None and now >= restore_at:
+            proxy.restore()
+            restore_at = None
+        if fps:
+            talker.sendall(voice_frame(0, audio, tick, tick * 160))
+        if tick % chat_every == 0:
+            talker.sendall(text_frame(f"MSG:{sent}"))
+            sent += 1
+        tick += 1
+        delay = start + tick * step - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+    proxy.restore()
+    time.sleep(2.0 + outage)
+    # Counted before the listeners close, which makes them leave the room at once
+    observed = churn[0]
+    for client in clients:
+        client.close()
+    observer.close()
+    talker.close()
+    proxy.close()
+    return clients, sent, observed
+
+def run_reconnect(args):
+    """
+    Messages missed and presence churn when connections drop under load,
+    with session resumption and with clients logging in afresh. Exits
+    with status 1 if resuming lost, repeated or reordered any message,
+    or anyone was seen to leave or join.
+    """
+    results = []
+    for engine in args.engines:
+        for resume in (False, True):
+            port = free_port()
+            extra = [] if resume else ['--resume-grace', '0']
+            proc = start_server_process(engine, port, extra)
+            try:
+                clients, sent, churn = reconnect_run(port, args.listeners, args.seconds, args.cuts,
+                                                     args.outage, args.rate, args.fps)
+            finally:
+                proc.kill()
+                proc.wait()
+            reconnects = sorted(ms for client in clients for ms in client.reconnect_ms)
+            results.append({
+                'engine': engine, 'mode': 'resume' if resume else 'relogin', 'sent': sent,
+                'missed': sum(sent - len(client.seen) for client in clients),
+                'duplicates': sum(client.duplicates for client in clients),
+                'out_of_order': sum(client.out_of_order for client in clients),
+                'resumes': sum(client.resumes for client in clients),
+                'logins': sum(client.logins for client in clients) - len(clients),
+                'expired': sum(client.expired for client in clients),
+                'reconnect_p50_ms': percentile(reconnects, 0.5), 'reconnect_max_ms': reconnects[-1] if reconnects else 0.0,
+                'presence_churn': churn,
+            })
+
+    print(f"{args.listeners} listeners, {args.cuts} cuts of {args.outage:g} s in {args.seconds:g} s; "
+          f"{args.rate:g} chat/s and {args.fps:g} voice frames/s")
+    print(f"{'engine':<9} {'mode':<8} {'sent':>6} {'missed':>7} {'dup':>5} {'order':>6} {'resumes':>8} "
+          f"{'relogins':>9} {'reconnect p50':>14} {'max ms':>8} {'join/leave':>11}")
+    for r in results:
+        print(f"{r['engine']:<9} {r['mode']:<8} {r['sent']:>6} {r['missed']:>7} {r['duplicates']:>5} "
+              f"{r['out_of_order']:>6} {r['resumes']:>8} {r['logins']:>9} {r['reconnect_p50_ms']:>14.0f} "
+              f"{r['reconnect_max_ms']:>8.0f} {r['presence_churn']:>11}")
+    # Logging in afresh is expected to miss messages and be seen; resuming is not
+    failed = [f"{r['engine']}: {check} {r[check]}" for r in results if r['mode'] == 'resume'
+              for check in ('missed', 'duplicates', 'out_of_order', 'presence_churn') if r[check]]
+    if failed:
+        print(f"FAILED: {'; '.join(failed)}")
+        sys.exit(1)
+    return results
+
+# Run by the startup scenario in a fresh interpreter: logs in as a text-only
+# client and prints the milliseconds its imports and its login took, then
+# waits for stdin to close. `eager` first loads what client.py used to load
+# and set up on startup, apart from PyQt5.
+STARTUP_CLIENT = """
+import sys, time
+start = time.perf_counter()
+eager, host, port = sys.argv[1] == 'eager', sys.argv[2], int(sys.argv[3])
+if eager:
+    import asyncio
+    try:
+        import vad
+    except ImportError:
+        pass
+    try:
+        import pyaudio
+        pyaudio.PyAudio()
+    except ImportError:
+        pass
+from clientcore import ClientCore, create_vad
+from codec import create_codec
+imported = time.perf_counter()
+core = ClientCore(host, port)
+core.connect('startup')
+if eager:
+    core.codec = create_codec(core.codec_name)
+    core.vad = create_vad(core.codec)
+    core.start_playback()
+print((imported - start) * 1000, (time.perf_counter() - start) * 1000, flush=True)
+sys.stdin.read()
+core.close()
+"""
+
+def startup_run(port, mode):
+    """
+    Start one STARTUP_CLIENT. Returns the milliseconds from spawning it to
+    its login, its own import and login times, and its RSS and threads
+    once logged in.
+    """
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, '-c', STARTUP_CLIENT, mode, BENCH_HOST, str(port)],
+                            cwd=os.path.dirname(SERVER_SCRIPT), stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            text=True)
+    try:
+        imported_ms, ready_ms = map(float, proc.stdout.readline().split())
+        spawn_ms = (time.perf_counter() - start) * 1000
+        rss, threads = process_stats(proc.pid)
+    finally:
+        proc.stdin.close()
+        proc.wait()
+    return spawn_ms, imported_ms, ready_ms, rss, threads
+
+def run_startup(args):
+    """
+    Cold start and memory of a text-only client: the headless core,
+    which loads audio and NumPy only once voice is used, against what
+    the client loaded and set up before connecting until it did.
+    """
+    import importlib.util
+
+    optional = [name for name in ('numpy', 'pyaudio') if importlib.util.find_spec(name) is not None]
+    port = free_port()
+    proc = start_server_process('threaded', port)
+    samples = {'eager': [], 'lazy': []}
+    try:
+        for mode in samples:
+            startup_run(port, mode)  # compiles and caches bytecode
+        for _ in range(args.runs):
+            for mode in samples:
+                samples[mode].append(startup_run(port, mode))
+    finally:
+        proc.kill()
+        proc.wait()
+
+    results = []
+    for mode, runs in samples.items():
+        columns = list(zip(*runs))
+        results.append({'mode': mode, 'spawn_ms': percentile(sorted(columns[0]), 0.5),
+                        'import_ms': percentile(sorted(columns[1]), 0.5),
+                        'login_ms': percentile(sorted(columns[2]), 0.5),
+                        'rss_kib': percentile(sorted(columns[3]), 0.5), 'threads': max(columns[4])})
+
+    print(f"{args.runs} runs each, medians; optional packages installed: {', '.join(optional) or 'none'} "
+          f"(PyQt5 left out of both)")
+    print(f"{'startup':<8} {'spawn to login ms':>18} {'imports ms':>11} {'in-process ms':>14} {'RSS MiB':>8} "
+          f"{'threads':>8}")
+    for r in results:
+        print(f"{r['mode']:<8} {r['spawn_ms']:>18.1f} {r['import_ms']:>11.1f} {r['login_ms']:>14.1f} "
+              f"{r['rss_kib'] / 1024:>8.1f} {r['threads']:>8}")
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load tests for the chat server.")
+    sub = parser.add_subparsers(dest='scenario', required=True)
+
+    idle = sub.add_parser('idle', help="Hold many idle connections and compare server engines.")
+    idle.add_argument('--clients', type=int, default=1000)
+    idle.add_argument('--engines', nargs='+', default=['threaded', 'asyncio'])
+    idle.add_argument('--settle', type=float, default=2.0,
+                      help="Seconds to wait after connecting before sampling memory.")
+    idle.set_defaults(func=run_idle)
+
+    slow = sub.add_parser('slow', help="Measure chat latency while one client stops reading.")
+    slow.add_argument('--clients', type=int, default=50)
+    slow.add_argument('--voice-frames', type=int, default=2000)
+    slow.add_argument('--engines', nargs='+', default=['threaded', 'asyncio'])
+    slow.set_defaults(func=run_slow)
+
+    fanout = sub.add_parser('fanout', help="Microbenchmark broadcast() serialization against room size.")
+    fanout.add_argument('--room-sizes', type=int, nargs='+', default=[10, 100, 1000, 5000])
+    fanout.add_argument('--payload', type=int, default=2048, help="Voice chunk size in bytes.")
+    fanout.add_argument('--broadcasts', type=int, default=200)
+    fanout.set_defaults(func=run_fanout)
+
+    codecs = sub.add_parser('codecs', help="Compare voice bandwidth per listener for each codec.")
+    codecs.add_argument('--listeners', type=int, default=50)
+    codecs.set_defaults(func=run_codecs)
+
+    cluster = sub.add_parser('cluster', help="Run N clustered nodes on localhost and verify delivery and the talk floor.")
+    cluster.add_argument('--nodes', type=int, default=3)
+    cluster.add_argument('--clients-per-node', type=int, default=20)
+    cluster.add_argument('--messages', type=int, default=50, help="Chat messages sent by every client.")
+    cluster.add_argument('--voice-frames', type=int, default=50)
+    cluster.add_argument('--engines', nargs='+', default=['threaded', 'asyncio'],
+                         help="Engines assigned to the nodes in turn.")
+    cluster.add_argument('--timeout', type=float, default=30.0)
+    cluster.set_defaults(func=run_cluster)
+
+    churn = sub.add_parser('churn', help="Compare USERLIST rebroadcasts with presence deltas for a wave of joins.")
+    churn.add_argument('--clients', type=int, default=500)
+    churn.add_argument('--engines', nargs='+', default=['threaded', 'asyncio'])
+    churn.add_argument('--timeout', type=float, default=60.0)
+    churn.add_argument('--server-workers', type=int, default=1,
+                       help="Serve from this many worker processes, joined by their bus.")
+    churn.set_defaults(func=run_churn)
+
+    history = sub.add_parser('history', help="Time a full history replay and live chat latency during it.")
+    history.add_argument('--messages', type=int, default=100000)
+    history.add_argument('--probes', type=int, default=50, help="Live messages timed during the replay.")
+    history.add_argument('--engines', nargs='+', default=['threaded', 'asyncio'])
+    history.set_defaults(func=run_history)
+
+    load = sub.add_parser('load', help="Drive a server with many simulated users and report throughput, "
+                                       "latency percentiles, CPU and memory.")
+    load.add_argument('--clients', type=int, default=1000)
+    load.add_argument('--rooms', type=int, default=20, help="Rooms the clients are spread over.")
+    load.add_argument('--workers', type=int, default=max(1, (os.cpu_count() or 2) // 2),
+                      help="Load generator processes.")
+    load.add_argument('--protocol', choices=['text', 'binary', 'mixed'], default='mixed',
+                      help="Wire protocol of the clients; mixed alternates.")
+    load.add_argument('--msg-rate', type=float, default=0.5, help="Chat messages per second per client.")
+    load.add_argument('--msg-bytes', type=int, default=40, help="Padding added to every chat message.")
+    load.add_argument('--status-rate', type=float, default=0.05, help="Talk requests per second per client.")
+    load.add_argument('--talkers', type=int, default=5, help="Rooms with a client streaming voice.")
+    load.add_argument('--voice-fps', type=float, default=43.0, help="Voice frames per second per talker.")
+    load.add_argument('--voice-bytes', type=int, default=2048, help="Audio bytes per voice frame.")
+    load.add_argument('--duration', type=float, default=10.0, help="Seconds of measured load.")
+    load.add_argument('--ramp', type=float, default=5.0, help="Seconds to connect all clients before measuring.")
+    load.add_argument('--drain', type=float, default=2.0, help="Seconds to collect in-flight deliveries.")
+    load.add_argument('--engines', nargs='+', default=['threaded', 'asyncio'])
+    load.add_argument('--server-workers', type=int, default=1,
+                      help="Worker processes of the server (its --workers); CPU and RSS cover them all.")
+    load.add_argument('--server', default=SERVER_SCRIPT,
+                      help="server.py of the build to test, e.g. from a git worktree of another revision.")
+    load.add_argument('--json', metavar='PATH', help="Write the results as JSON to PATH, or - for stdout.")
+    load.set_defaults(func=run_load)
+
+    compare = sub.add_parser('compare', help="Compare two load --json reports and flag regressions.")
+    compare.add_argument('baseline')
+    compare.add_argument('candidate')
+    compare.add_argument('--tolerance', type=float, default=10.0, help="Percent change counted as a regression.")
+    compare.set_defaults(func=run_compare)
+
+    instrumented = sub.add_parser('metrics', help="Measure the overhead of --metrics-port instrumentation.")
+    instrumented.add_argument('--room-size', type=int, default=500, help="Room size of the in-process test.")
+    instrumented.add_argument('--broadcasts', type=int, default=1000)
+    instrumented.add_argument('--repeats', type=int, default=5)
+    instrumented.add_argument('--clients', type=int, default=500)
+    instrumented.add_argument('--rooms', type=int, default=10)
+    instrumented.add_argument('--talkers', type=int, default=5)
+    instrumented.add_argument('--msg-rate', type=float, default=0.5)
+    instrumented.add_argument('--workers', type=int, default=max(1, (os.cpu_count() or 2) // 2))
+    instrumented.add_argument('--duration', type=float, default=10.0)
+    instrumented.add_argument('--ramp', type=float, default=5.0)
+    instrumented.add_argument('--engines', nargs='*', default=['threaded', 'asyncio'],
+                              help="Engines to load test; none for the in-process test only.")
+    instrumented.set_defaults(func=run_metrics)
+
+    mixing = sub.add_parser('mixer', help="Time server-side mixing for several talkers against relaying them.")
+    mixing.add_argument('--talkers', type=int, nargs='+', default=[1, 2, 4, 8])
+    mixing.add_argument('--room-size', type=int, default=100)
+    mixing.add_argument('--ticks', type=int, default=200)
+    mixing.add_argument('--repeats', type=int, default=20, help="Runs of the bare mixing step timed.")
+    mixing.set_defaults(func=run_mixer)
+
+    parser_bench = sub.add_parser('parser', help="Compare receive-side line and frame parsers on recorded traffic.")
+    parser_bench.add_argument('--megabytes', type=float, default=8.0, help="Traffic per mix.")
+    parser_bench.add_argument('--recv-sizes', type=int, nargs='+', default=[4096, 65536])
+    parser_bench.add_argument('--traffic', nargs='+', choices=['chat', 'voice', 'mixed'],
+                              default=['chat', 'voice', 'mixed'])
+    parser_bench.add_argument('--protocols', nargs='+', choices=['text', 'binary'], default=['text', 'binary'])
+    parser_bench.add_argument('--voice-bytes', type=int, default=2048)
+    parser_bench.add_argument('--chat-per-voice', type=int, default=10,
+                              help="Chat messages between two voice frames in the mixed traffic.")
+    parser_bench.add_argument('--repeats', type=int, default=3)
+    parser_bench.set_defaults(func=run_parser)
+
+    vad = sub.add_parser('vad', help="Measure voice activity detection and silence suppression on synthetic speech.")
+    vad.add_argument('--seconds', type=float, default=30.0)
+    vad.add_argument('--talk', type=float, default=2.0, help="Seconds of each talk spurt.")
+    vad.add_argument('--pause', type=float, default=1.5, help="Seconds of background noise between spurts.")
+    vad.add_argument('--noise-db', type=float, nargs='+', default=[-70.0, -55.0, -45.0],
+                     help="Background noise levels in dB below full scale.")
+    vad.add_argument('--repeats', type=int, default=20, help="Runs of the pure Python baseline.")
+    vad.set_defaults(func=run_vad)
+
+    media = sub.add_parser('media', help="Compare voice and chat latency over TCP and the UDP media channel "
+                                         "under simulated loss.")
+    media.add_argument('--loss', type=float, nargs='+', default=[0.0, 0.02, 0.05],
+                       help="Share of packets lost on the listener's path.")
+    media.add_argument('--seconds', type=float, default=10.0)
+    media.add_argument('--fps', type=float, default=50.0, help="Voice frames per second.")
+    media.add_argument('--deadline', type=float, default=150.0,
+                       help="Milliseconds within which a frame counts as on time.")
+    media.add_argument('--engines', nargs='+', default=['threaded', 'asyncio'])
+    media.add_argument('--min-delivered', type=float, default=0.9,
+                       help="Least share of voice frames that must arrive, on either transport.")
+    media.add_argument('--min-on-time', type=float, default=0.9,
+                       help="Least share that must arrive within the deadline over UDP, and over TCP without loss.")
+    media.set_defaults(func=run_media)
+
+    chat = sub.add_parser('chat', help="Compare per-line and batched chat rendering under a synthetic feed.")
+    chat.add_argument('--rates', type=int, nargs='+', default=[100, 1000, 5000], help="Messages per second.")
+    chat.add_argument('--seconds', type=float, default=5.0)
+    chat.set_defaults(func=run_chat)
+
+    flood = sub.add_parser('flood', help="Measure chat latency while one client floods, with and without rate limits.")
+    flood.add_argument('--listeners', type=int, default=20)
+    flood.add_argument('--seconds', type=float, default=10.0)
+    flood.add_argument('--repeats', type=int, default=1000000, help="Limiter checks timed.")
+    flood.add_argument('--engines', nargs='+', default=['threaded', 'asyncio'])
+    flood.set_defaults(func=run_flood)
+
+    reconnect = sub.add_parser('reconnect', help="Drop every client connection under load and count missed "
+                                                 "messages and presence churn, with and without session resumption.")
+    reconnect.add_argument('--listeners', type=int, default=20)
+    reconnect.add_argument('--seconds', type=float, default=12.0)
+    reconnect.add_argument('--cuts', type=int, default=5, help="Times every connection is dropped.")
+    reconnect.add_argument('--outage', type=float, default=0.5,
+                           help="Seconds new connections are refused after each cut.")
+    reconnect.add_argument('--rate', type=float, default=50.0, help="Chat messages per second.")
+    reconnect.add_argument('--fps', type=float, default=50.0, help="Voice frames per second.")
+    reconnect.add_argument('--engines', nargs='+', default=['threaded', 'asyncio'])
+    reconnect.set_defaults(func=run_reconnect)
+
+    startup = sub.add_parser('startup', help="Compare cold start time and memory of a text-only client with "
+                                             "lazily and eagerly loaded audio.")
+    startup.add_argument('--runs', type=int, default=10, help="Client processes started for each mode.")
+    startup.set_defaults(func=run_startup)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Client-side batching of chat lines on their way to the display.
+
+Handing every incoming line to the GUI thread on its own (one signal and
+one widget append each) costs the GUI thread a queued event, a relayout
+and a repaint per line, and a busy room or a history replay keeps it from
+doing anything else. Instead the network thread posts lines to a ChatLog,
+and only the first line posted after a flush asks the GUI thread for one:
+the GUI thread takes every pending line at most once per FLUSH_INTERVAL
+and appends them to the view in one go.
+
+The view keeps the last SCROLLBACK lines. A flush never hands over more
+than that, so when lines arrive faster than they can be read the ones
+that would scroll out before being drawn are skipped, not rendered.
+It holds no GUI state: posting is safe from any thread, flushing is for
+the one thread that owns the view.
+"""
+import threading
+from collections import deque
+
+# Lines kept in the chat view; older ones are dropped from the top
+SCROLLBACK = 5000
+# Milliseconds between flushes while lines keep arriving: about two frames
+# at 60 Hz, too short to notice and long enough to batch a burst
+FLUSH_INTERVAL = 33
+
+
+class ChatLog:
+    """
+    Lines waiting for the display, with counters of what became of them.
+    """
+
+    def __init__(self, scrollback=SCROLLBACK):
+        self.scrollback = scrollback
+        self.received = 0  # lines posted
+        self.shown = 0  # lines handed to the view
+        self.skipped = 0  # lines that would have scrolled out before being drawn
+        self.flushes = 0  # batches handed to the view
+        self._pending = deque()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def post(self, line):
+        """
+        Queue one line. Returns True when no flush is pending yet, i.e.
+        when the caller should schedule one.
+        """
+        with self._lock:
+            self._pending.append(line)
+            self.received += 1
+            return len(self._pending) == 1
+
+    def post_many(self, lines):
+        """
+        Queue several lines at once, e.g. a history backlog. Returns True
+        when the caller should schedule a flush.
+        """
+        with self._lock:
+            was_empty = not self._pending
+            self._pending.extend(lines)
+            self.received += len(lines)
+            return was_empty and bool(self._pending)
+
+    def flush(self):
+        """
+        Take every pending line, oldest first, keeping at most the last
+        `scrollback` of them. The next post() asks for a flush again.
+        """
+        with self._lock:
+            pending = self._pending
+            self._pending = deque()
+        if not pending:
+            return []
+        skip = len(pending) - self.scrollback
+        if skip > 0:
+            self.skipped += skip
+            lines = list(pending)[skip:]
+        else:
+            lines = list(pending)
+        self.shown += len(lines)
+        self.flushes += 1
+        return lines
+
+    def stats(self):
+        return {
+            'received': self.received,
+            'shown': self.shown,
+            'skipped': self.skipped,
+            'flushes': self.flushes,
+            'pending': len(self._pending),
+        }
@@ -1,52 +1,115 @@
 import sys
-import socket
-import threading
-import base64
-import pyaudio
+import time
 from PyQt5.QtWidgets import (
     QApplication, QWidget, QVBoxLayout, QHBoxLayout,
-    QTextEdit, QLineEdit, QPushButton, QListWidget,
-    QLabel, QMessageBox, QSizePolicy
+    QPlainTextEdit, QLineEdit, QPushButton, QListWidget,
+    QLabel, QMessageBox, QSizePolicy, QComboBox
 )
-from PyQt5.QtCore import Qt, pyqtSignal, QObject
+from PyQt5.QtCore import Qt, pyqtSignal, QObject, QTimer
+
+from protocol import PRESENCE_SYNC
+from chatlog import ChatLog, FLUSH_INTERVAL
+from clientcore import ClientCore, HISTORY_BACKLOG, chat_text
+from presence import PresenceModel, SNAPSHOT, JOIN, LEAVE, START, STOP
 
 # Server configuration
 SERVER_HOST = 'localhost'  # Updated server IP address
 SERVER_PORT = 5050             # Updated port number
 
-# Voice configuration
-CHUNK = 1024
-FORMAT = pyaudio.paInt16
-CHANNELS = 1
-RATE = 44100
+# Lines kept in the chat window; older ones scroll out for good
+CHAT_SCROLLBACK = 5000
+
+# Ask servers that offer it to carry voice over UDP, keeping chat on TCP
+USE_MEDIA_CHANNEL = True
+
+# How often the voice buffer statistics label refreshes, in milliseconds
+VOICE_STATS_INTERVAL = 1000
 
 class Communicate(QObject):
     message_received = pyqtSignal(str)
+    chat_pending = pyqtSignal()
     userlist_updated = pyqtSignal(list)
+    presence_received = pyqtSignal(str)
+    history_received = pyqtSignal(list)
     status_updated = pyqtSignal(str, str)
+    room_joined = pyqtSignal(str)
+    rooms_listed = pyqtSignal(list)
     error_occurred = pyqtSignal(str)
 
+class QtClientCore(ClientCore):
+    """
+    The client core (see clientcore.py) handing what it receives to the
+    GUI thread: chat lines through the chat log, the rest as signals.
+    """
+
+    def __init__(self, comm, chat_log):
+        super().__init__(SERVER_HOST, SERVER_PORT, media=USE_MEDIA_CHANNEL, history=HISTORY_BACKLOG)
+        self.comm = comm
+        self.chat_log = chat_log
+
+    def on_chat(self, text):
+        if self.chat_log.post(text):
+            # The first line since the last flush schedules the next one
+            self.comm.chat_pending.emit()
+
+    on_notice = on_chat
+
+    def on_history(self, entries):
+        # The whole backlog reaches the GUI in one update
+        self.comm.history_received.emit(entries)
+
+    def on_userlist(self, users):
+        self.comm.userlist_updated.emit(users)
+
+    def on_presence(self, message):
+        self.comm.presence_received.emit(message)
+
+    def on_status(self, action, user):
+        self.comm.status_updated.emit(action, user)
+
+    def on_room_joined(self, name):
+        self.comm.room_joined.emit(name)
+
+    def on_rooms(self, rooms):
+        self.comm.rooms_listed.emit(rooms)
+
+    def on_error(self, text):
+        self.comm.error_occurred.emit(text)
+
+    def on_disconnected(self):
+        self.comm.message_received.emit("Disconnected from the server.")
+        self.comm.error_occurred.emit("Disconnected from the server.")
+
 class ChatClient(QWidget):
     def __init__(self):
         super().__init__()
         self.setWindowTitle("PyQt5 Chat Client with Exclusive Voice")
         self.setGeometry(100, 100, 800, 600)
-        self.nickname = ""
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Chat lines from the network thread, shown in batches (see chatlog.py)
+        self.chat_log = ChatLog(CHAT_SCROLLBACK)
+        self.chat_timer = QTimer(self)
+        self.chat_timer.setSingleShot(True)
+        self.chat_timer.setInterval(FLUSH_INTERVAL)
+        self.chat_timer.timeout.connect(self.flush_chat)
         self.comm = Communicate()
         self.comm.message_received.connect(self.display_message)
+        self.comm.chat_pending.connect(self.chat_timer.start)
         self.comm.userlist_updated.connect(self.update_users_list_display)
+        self.comm.presence_received.connect(self.apply_presence)
+        self.comm.history_received.connect(self.display_history)
         self.comm.status_updated.connect(self.handle_status_update)
+        self.comm.room_joined.connect(self.handle_room_joined)
+        self.comm.rooms_listed.connect(self.update_rooms_display)
         self.comm.error_occurred.connect(self.handle_error)
         self.init_ui()
-        self.connected = False
-        self.listening = False
-        self.pyaudio_instance = pyaudio.PyAudio()
-        self.stream = None
-        self.voice_thread = None
-        self.play_stream = None
-        self.play_lock = threading.Lock()
+        # Protocol, network and audio; nothing of it is set up before it is needed
+        self.core = QtClientCore(self.comm, self.chat_log)
         self.currently_talking_user = None  # Track the current talker
+        # Users in the current room, indexed; user_items maps each to its list entry
+        self.presence = PresenceModel()
+        self.user_items = {}
+        self.stats_timer = QTimer(self)
+        self.stats_timer.timeout.connect(self.update_voice_stats)
 
     def init_ui(self):
         """
@@ -71,8 +134,10 @@ class ChatClient(QWidget):
         chat_layout.addWidget(self.connect_button)
 
         # Chat display area
-        self.chat_display = QTextEdit()
+        # Lays out only the lines in view, and drops the oldest beyond the scrollback
+        self.chat_display = QPlainTextEdit()
         self.chat_display.setReadOnly(True)
+        self.chat_display.setMaximumBlockCount(CHAT_SCROLLBACK)
         self.chat_display.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
         chat_layout.addWidget(self.chat_display)
 
@@ -99,13 +164,33 @@ class ChatClient(QWidget):
         chat_layout.addLayout(message_layout)
         main_layout.addLayout(chat_layout, 3)  # Allocate more space to chat
 
-        # Right side: Online users
+        # Right side: Room switcher and online users
         users_layout = QVBoxLayout()
+        room_layout = QHBoxLayout()
+        self.room_selector = QComboBox()
+        self.room_selector.setEditable(True)
+        self.room_selector.setToolTip("Pick a room or type a new name to create one")
+        self.room_selector.setDisabled(True)
+        room_layout.addWidget(self.room_selector, 1)
+        self.join_room_button = QPushButton("Join")
+        self.join_room_button.setDisabled(True)
+        self.join_room_button.clicked.connect(self.join_room)
+        room_layout.addWidget(self.join_room_button)
+        self.refresh_rooms_button = QPushButton("↻")
+        self.refresh_rooms_button.setToolTip("Refresh the room list")
+        self.refresh_rooms_button.setDisabled(True)
+        self.refresh_rooms_button.clicked.connect(self.request_room_list)
+        room_layout.addWidget(self.refresh_rooms_button)
+        users_layout.addWidget(QLabel("Room:"))
+        users_layout.addLayout(room_layout)
         users_label = QLabel("Online Users:")
         users_layout.addWidget(users_label)
         self.users_list = QListWidget()
         self.users_list.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Expanding)
         users_layout.addWidget(self.users_list)
+        self.voice_stats_label = QLabel("")
+        self.voice_stats_label.setWordWrap(True)
+        users_layout.addWidget(self.voice_stats_label)
         main_layout.addLayout(users_layout, 1)  # Allocate less space to users
 
         self.setLayout(main_layout)
@@ -114,104 +199,86 @@ class ChatClient(QWidget):
         """
         Connect to the chat server with the provided nickname.
         """
-        if self.connected:
+        if self.core.connected:
             QMessageBox.warning(self, "Already Connected", "You are already connected to the server.")
             return
 
-        self.nickname = self.nickname_input.text().strip()
-        if not self.nickname:
+        nickname = self.nickname_input.text().strip()
+        if not nickname:
             QMessageBox.warning(self, "Input Error", "Please enter a nickname.")
             return
 
         try:
-            self.socket.connect((SERVER_HOST, SERVER_PORT))
-            self.socket.sendall((self.nickname + '\n').encode('utf-8'))
+            # Logs in and starts the listening thread
+            self.core.connect(nickname)
         except Exception as e:
             QMessageBox.critical(self, "Connection Failed", f"Could not connect to server: {e}")
             return
 
-        self.connected = True
         self.connect_button.setDisabled(True)
         self.nickname_input.setDisabled(True)
         self.message_input.setDisabled(False)
         self.send_button.setDisabled(False)
         self.talk_button.setDisabled(False)
-        self.chat_display.append("Connected to the server.")
+        self.room_selector.setDisabled(False)
+        self.join_room_button.setDisabled(False)
+        self.refresh_rooms_button.setDisabled(False)
+        self.append_chat("Connected to the server.")
+        self.stats_timer.start(VOICE_STATS_INTERVAL)
 
-        # Start the listening thread
-        listen_thread = threading.Thread(target=self.listen_for_messages, daemon=True)
-        listen_thread.start()
+    def flush_chat(self):
+        """
+        Append every chat line waiting in the chat log to the chat display,
+        in one edit.
+        """
+        lines = self.chat_log.flush()
+        if lines:
+            self.chat_display.appendPlainText('\n'.join(lines))
 
-    def listen_for_messages(self):
+    def append_chat(self, text):
         """
-        Listen for incoming messages from the server.
+        Show a line from the GUI thread, after the chat lines still waiting.
         """
-        buffer = ""
-        try:
-            while True:
-                data = self.socket.recv(4096)
-                if not data:
-                    break  # Server closed connection
-                buffer += data.decode('utf-8', errors='ignore')
-                while '\n' in buffer:
-                    message, buffer = buffer.split('\n', 1)
-                    message = message.strip()
-                    if not message:
-                        continue
-                    if message.startswith("USERLIST:"):
-                        users = message[len("USERLIST:"):].split(',')
-                        self.comm.userlist_updated.emit(users)
-                    elif message.startswith("STATUS:"):
-                        parts = message.split(':', 2)
-                        if len(parts) == 3:
-                            _, action, user = parts
-                            self.comm.status_updated.emit(action, user)
-                    elif message.startswith("VOICE:") or message.startswith("MSG:") or message.startswith("SERVER:"):
-                        self.comm.message_received.emit(message)
-        except Exception as e:
-            self.comm.error_occurred.emit(f"Error receiving messages: {e}")
-        finally:
-            self.socket.close()
-            self.connected = False
-            self.comm.message_received.emit("Disconnected from the server.")
-            self.comm.error_occurred.emit("Disconnected from the server.")
+        self.chat_log.post(text)
+        self.flush_chat()
 
     def display_message(self, message):
         """
-        Display received text or handle voice messages.
+        Display received text messages.
         """
-        if message.startswith("VOICE:"):
-            # Handle incoming voice data
-            encoded_data = message[len("VOICE:"):].strip()
-            try:
-                audio_data = base64.b64decode(encoded_data)
-                self.play_audio(audio_data)
-            except Exception as e:
-                print(f"Error decoding audio data: {e}")
-        elif message.startswith("MSG:"):
-            # Display the message in chat
-            display_message = message[len("MSG:"):].strip()
-            self.chat_display.append(display_message)
-        elif message.startswith("SERVER:"):
-            # Display server messages (like user joining or leaving)
-            display_message = message[len("SERVER:"):].strip()
-            self.chat_display.append(display_message)
-        elif message == "Disconnected from the server.":
-            self.chat_display.append(message)
+        if message == "Disconnected from the server.":
+            self.append_chat(message)
             QMessageBox.information(self, "Disconnected", message)
 
+    def display_history(self, entries):
+        """
+        Show a backlog of (id, unix time, message) entries from the server,
+        followed by the live messages that arrived while it was loading
+        (with no id or time).
+        """
+        lines = []
+        for msg_id, timestamp, message in entries:
+            text = chat_text(message)
+            if text is None:
+                continue
+            if timestamp is not None:
+                text = f"[{time.strftime('%H:%M', time.localtime(timestamp))}] {text}"
+            lines.append(text)
+        self.chat_log.post_many(lines)
+        self.flush_chat()
+
     def send_message(self):
         """
         Send a text message to the server.
         """
-        if not self.connected:
+        if not self.core.connected:
             QMessageBox.warning(self, "Not Connected", "You are not connected to any server.")
             return
 
         message = self.message_input.text().strip()
         if message:
             try:
-                self.socket.sendall(f"MSG:{message}\n".encode('utf-8'))
+                self.core.send_chat(message)
                 # Remove the local append to prevent duplication
                 # Messages are displayed when received from the server
                 self.message_input.clear()
@@ -224,25 +291,73 @@ class ChatClient(QWidget):
         """
         if self.talk_button.isChecked():
             # Attempt to start talking
-            self.socket.sendall(f"STATUS:START:{self.nickname}\n".encode('utf-8'))
+            self.core.send_text(f"STATUS:START:{self.core.nickname}")
         else:
             # Stop talking
-            self.socket.sendall(f"STATUS:STOP:{self.nickname}\n".encode('utf-8'))
-            self.stop_sending_voice()
+            self.core.send_text(f"STATUS:STOP:{self.core.nickname}")
+            self.core.stop_voice()
 
     def send_status_start(self):
         """
         Start sending voice data.
         """
         self.talk_button.setText("🎤 Stop Talking")
-        self.start_sending_voice()
+        self.core.start_voice()
 
     def send_status_stop(self):
         """
         Stop sending voice data.
         """
         self.talk_button.setText("🎤 Talk")
-        self.stop_sending_voice()
+        self.core.stop_voice()
+
+    def request_room_list(self):
+        """
+        Ask the server for the current rooms and their sizes.
+        """
+        self.core.request_room_list()
+
+    def join_room(self):
+        """
+        Switch to the room picked or typed in the room selector.
+        """
+        text = self.room_selector.currentText().strip()
+        index = self.room_selector.findText(text)
+        name = self.room_selector.itemData(index) if index >= 0 else text
+        if not name or name == self.core.current_room:
+            return
+        if self.talk_button.isChecked():
+            # Give up the floor in the room we are leaving
+            self.talk_button.setChecked(False)
+            self.toggle_talking()
+            self.talk_button.setText("🎤 Talk")
+        self.core.join_room(name)
+
+    def handle_room_joined(self, name):
+        """
+        Reset per-room state after the server moved us to another room.
+        """
+        self.currently_talking_user = None
+        self.talk_button.setDisabled(False)
+        # The new room's snapshot or user list follows
+        self.presence.reset([])
+        self.users_list.clear()
+        self.user_items = {}
+        self.append_chat(f"Joined room {name}.")
+        self.request_room_list()
+
+    def update_rooms_display(self, rooms):
+        """
+        Refill the room selector from a ROOMS: listing of (name, members).
+        """
+        self.room_selector.blockSignals(True)
+        self.room_selector.clear()
+        for name, count in rooms:
+            self.room_selector.addItem(f"{name} ({count})", name)
+        index = self.room_selector.findData(self.core.current_room)
+        if index >= 0:
+            self.room_selector.setCurrentIndex(index)
+        self.room_selector.blockSignals(False)
 
     def handle_status_update(self, action, user):
         """
@@ -251,95 +366,114 @@ class ChatClient(QWidget):
         if action == "START":
             if self.currently_talking_user is None:
                 self.currently_talking_user = user
-                if user == self.nickname:
+                if user == self.core.nickname:
                     # You are the talker
                     self.send_status_start()
                 else:
                     # Another user is talking; disable your Talk button
                     self.talk_button.setDisabled(True)
-                self.update_users_list_display(self.current_users())
+                self.refresh_user_item(user)
             else:
-                if user != self.nickname:
+                if user != self.core.nickname:
                     # Someone else started talking; ensure your Talk button is disabled
                     self.talk_button.setDisabled(True)
         elif action == "STOP":
             if self.currently_talking_user == user:
                 self.currently_talking_user = None
-                if user == self.nickname:
+                if user == self.core.nickname:
                     # You stopped talking
                     self.send_status_stop()
                 # Re-enable Talk button for all users
                 self.talk_button.setDisabled(False)
-                self.update_users_list_display(self.current_users())
+                self.refresh_user_item(user)
         elif action == "BUSY":
             # Received BUSY status when trying to start talking
             self.talk_button.setChecked(False)
             self.talk_button.setText("🎤 Talk")
             QMessageBox.information(self, "Mic Busy", f"Someone else is currently talking. Please wait until they finish.")
 
-    def start_sending_voice(self):
+    def update_voice_stats(self):
         """
-        Start capturing and sending voice data.
+        Show jitter buffer depth and loss counters for tuning.
         """
-        self.stream = self.pyaudio_instance.open(format=FORMAT,
-                                                 channels=CHANNELS,
-                                                 rate=RATE,
-                                                 input=True,
-                                                 frames_per_buffer=CHUNK)
-        self.listening = True
-        self.voice_thread = threading.Thread(target=self.capture_and_send_voice, daemon=True)
-        self.voice_thread.start()
+        stats = self.core.playback.stats()
+        text = (
+            f"Voice buffer: {stats['depth']}/{stats['target_depth']} frames, "
+            f"jitter {stats['jitter_ms']:.0f} ms\n"
+            f"Underruns: {stats['underruns']}  Late: {stats['late']}  "
+            f"Concealed: {stats['concealed']}"
+        )
+        media = self.core.media
+        text += "\nVoice over " + ("UDP" if media is not None and media.up else "TCP")
+        vad = self.core.vad
+        if vad is not None and vad.frames:
+            text += f"\nSilence suppressed: {vad.suppressed_fraction:.0%} of {vad.frames} frames captured"
+        self.voice_stats_label.setText(text)
 
-    def capture_and_send_voice(self):
+    def update_users_list_display(self, users):
         """
-        Capture audio from the microphone and send it to the server.
+        Replace the whole user list, from a USERLIST sent by a server
+        without presence deltas.
         """
-        try:
-            while self.listening:
-                data = self.stream.read(CHUNK, exception_on_overflow=False)
-                encoded_data = base64.b64encode(data).decode('utf-8')
-                voice_message = f"VOICE:{encoded_data}\n"
-                self.socket.sendall(voice_message.encode('utf-8'))
-        except Exception as e:
-            self.comm.error_occurred.emit(f"Error capturing/sending voice: {e}")
+        self.presence.reset([user for user in users if user], self.currently_talking_user)
+        self.rebuild_users_list()
 
-    def stop_sending_voice(self):
+    def apply_presence(self, message):
         """
-        Stop capturing and sending voice data.
+        Apply a PRESENCE snapshot or delta, touching only the list entries
+        that changed. Asks for a new snapshot if a delta went missing or
+        could not be read.
         """
-        self.listening = False
-        if self.voice_thread is not None:
-            self.voice_thread.join()
-        if self.stream is not None:
-            self.stream.stop_stream()
-            self.stream.close()
-            self.stream = None
+        changes = self.presence.apply(message)
+        if changes is None:
+            self.core.send_text(PRESENCE_SYNC)
+            return
+        for kind, user in changes:
+            if kind == SNAPSHOT:
+                self.rebuild_users_list()
+                talker = self.presence.talker
+                if talker != self.currently_talking_user:
+                    if self.currently_talking_user is not None:
+                        self.handle_status_update("STOP", self.currently_talking_user)
+                    if talker is not None:
+                        self.handle_status_update("START", talker)
+            elif kind == JOIN:
+                self.user_items[user] = self.add_user_item(user)
+            elif kind == LEAVE:
+                item = self.user_items.pop(user, None)
+                if item is not None:
+                    self.users_list.takeItem(self.users_list.row(item))
+            elif kind == START:
+                self.handle_status_update("START", user)
+            elif kind == STOP:
+                self.handle_status_update("STOP", user)
+
+    def rebuild_users_list(self):
+        """
+        Recreate every list entry from the presence model.
+        """
+        self.users_list.clear()
+        self.user_items = {user: self.add_user_item(user) for user in self.presence}
+
+    def add_user_item(self, user):
+        self.users_list.addItem(self.user_label(user))
+        return self.users_list.item(self.users_list.count() - 1)
 
-    def play_audio(self, audio_data):
+    def refresh_user_item(self, user):
         """
-        Play received audio data.
+        Update one user's entry after their talking state changed.
         """
-        try:
-            if self.play_stream is None:
-                self.play_stream = self.pyaudio_instance.open(format=FORMAT,
-                                                               channels=CHANNELS,
-                                                               rate=RATE,
-                                                               output=True,
-                                                               frames_per_buffer=CHUNK)
-            self.play_stream.write(audio_data)
-        except Exception as e:
-            print(f"Error playing audio data: {e}")
+        item = self.user_items.get(user)
+        if item is not None:
+            item.setText(self.user_label(user))
 
-    def update_users_list_display(self, users):
+    def user_label(self, user):
         """
-        Refresh the users list widget, adding mic emojis on the left where necessary.
+        Display name, with a mic emoji on the left for the current talker.
         """
-        self.users_list.clear()
-        for user in users:
-            display_name = user
-            if user == self.currently_talking_user:
-                display_name = "🎤 " + user
-            self.users_list.addItem(display_name)
+        if user == self.currently_talking_user:
+            return "🎤 " + user
+        return user
 
     def handle_error(self, error_message):
         """
@@ -349,30 +483,22 @@ class ChatClient(QWidget):
         if "Disconnected" in error_message:
             QMessageBox.information(self, "Disconnected", error_message)
         else:
-            self.chat_display.append(f"Error: {error_message}")
+            self.append_chat(f"Error: {error_message}")
 
     def current_users(self):
         """
-        Retrieve the current list of users from the users_list widget.
+        Retrieve the current list of users from the presence model.
         """
-        return [self.users_list.item(i).text().replace("🎤 ", "") for i in range(self.users_list.count())]
+        return list(self.presence)
 
     def closeEvent(self, event):
         """
         Handle the window close event to ensure resources are cleaned up.
         """
-        if self.connected:
-            if self.talk_button.isChecked():
-                self.talk_button.setChecked(False)
-                self.toggle_talking()
-            try:
-                self.socket.close()
-            except:
-                pass
-        if self.play_stream is not None:
-            self.play_stream.stop_stream()
-            self.play_stream.close()
-        self.pyaudio_instance.terminate()
+        if self.core.connected and self.talk_button.isChecked():
+            self.talk_button.setChecked(False)
+            self.toggle_talking()
+        self.core.close()
         event.accept()
 
 def main():
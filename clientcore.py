@@ -0,0 +1,691 @@
+"""
+The chat client without its window: protocol negotiation, the network
+thread, reconnecting and resuming, the media channel, voice capture and
+playback. client.py puts a PyQt5 window on it; bots and the benchmarks
+use it as it is, with neither PyQt5 nor PyAudio installed.
+
+A ClientCore reports what it receives by calling its on_*() methods,
+which do nothing here and are overridden by subclasses. Most are called
+on the network thread, so a GUI must hand their arguments over to its
+own thread (client.py does it with Qt signals).
+
+Nothing is set up before it is needed, so a client that only chats pays
+for no audio: PyAudio is loaded and initialized when a stream is first
+opened, the playback thread starts with the first voice received, and
+the voice activity detector (and with it NumPy) is loaded when voice is
+first captured.
+"""
+import base64
+import random
+import socket
+import threading
+import time
+
+from protocol import (
+    BINARY_PROTOCOL_VERSION, HISTORY_PROTOCOL_VERSION, MEDIA_PROTOCOL_VERSION, PRESENCE_PREFIX,
+    HISTORY_PREFIX, MEDIA_PREFIX, MEDIA_REQUEST, MEDIA_ON, MEDIA_OFF, SESSION_PREFIX, SESSION_CLOSE, RESUME_OK,
+    FRAME_HEADER, FRAME_TEXT, FRAME_VOICE, ProtocolError, hello_line, parse_hello_reply, text_frame, voice_frame,
+    parse_voice, parse_history, parse_media_offer, resume_line
+)
+from codec import ComfortNoiseCodec, PCMCodec, available_codecs, create_codec
+from framing import Receiver
+from media import MediaLink
+from playback import PlaybackEngine
+
+# Seconds to wait for the server to answer protocol negotiation
+HANDSHAKE_TIMEOUT = 5
+
+# Reconnecting after the connection drops: the first attempt is immediate,
+# then the delay doubles from RECONNECT_DELAY up to RECONNECT_MAX_DELAY
+# (each randomized down to half, so clients dropped together do not retry
+# together) until RECONNECT_TIMEOUT seconds have passed
+RECONNECT_DELAY = 0.25
+RECONNECT_MAX_DELAY = 4.0
+RECONNECT_TIMEOUT = 60.0
+
+# Chat messages fetched from the server's history on connect and on every room change
+HISTORY_BACKLOG = 50
+
+# Receive buffer; large enough for a burst of voice or a history backlog in one read
+RECEIVE_BUFFER_SIZE = 64 * 1024
+
+# Audio streams: 16-bit mono PCM (the negotiated codec sets rate and chunk size)
+SAMPLE_WIDTH = 2
+CHANNELS = 1
+
+
+def chat_text(message):
+    """
+    The text to show for a MSG: or SERVER: message, None for other messages.
+    """
+    if message.startswith("MSG:"):
+        return message[len("MSG:"):].strip()
+    if message.startswith("SERVER:"):
+        # Server notices, like users joining or leaving
+        return message[len("SERVER:"):].strip()
+    return None
+
+
+def read_line(sock):
+    """
+    Read the server's first line. Returns it without the newline, and
+    whatever arrived after it.
+    """
+    buffer = b""
+    while b'\n' not in buffer:
+        data = sock.recv(4096)
+        if not data:
+            raise ConnectionError("the server closed the connection")
+        buffer += data
+    line, _, rest = buffer.partition(b'\n')
+    return line, rest
+
+
+def create_vad(codec):
+    """
+    A voice activity detector for a codec's capture stream, or None if
+    NumPy is missing, in which case every captured chunk is sent. The
+    vad module is imported here rather than at startup because NumPy
+    takes longer to load than the rest of the client.
+    """
+    try:
+        from vad import VoiceActivityDetector
+    except ImportError:
+        return None
+    return VoiceActivityDetector(codec.sample_rate, codec.frame_size)
+
+
+class AudioDevices:
+    """
+    PyAudio, imported and initialized when the first stream is opened:
+    initializing it probes every sound device, which takes a while and
+    is wasted on a client that never talks or hears anyone.
+    """
+
+    def __init__(self):
+        self._pyaudio = None
+        self._format = None
+        self._lock = threading.Lock()  # the capture and playback threads may open streams together
+
+    def _instance(self):
+        with self._lock:
+            if self._pyaudio is None:
+                import pyaudio
+                self._pyaudio = pyaudio.PyAudio()
+                self._format = self._pyaudio.get_format_from_width(SAMPLE_WIDTH)
+            return self._pyaudio
+
+    def open_input(self, rate, frames_per_buffer):
+        pa = self._instance()
+        return pa.open(format=self._format, channels=CHANNELS, rate=rate,
+                       input=True, frames_per_buffer=frames_per_buffer)
+
+    def open_output(self, rate, frames_per_buffer):
+        pa = self._instance()
+        return pa.open(format=self._format, channels=CHANNELS, rate=rate,
+                       output=True, frames_per_buffer=frames_per_buffer)
+
+    def terminate(self):
+        with self._lock:
+            if self._pyaudio is not None:
+                self._pyaudio.terminate()
+                self._pyaudio = None
+
+
+class ClientCore:
+    """
+    One connection to a chat server, kept up until close(). With
+    `voice=False` received voice is dropped and no audio is ever
+    touched; `media` asks servers that offer it to carry voice over UDP;
+    `history` is the backlog fetched on connect and on every room
+    change, 0 for none.
+    """
+    reconnect_delay = RECONNECT_DELAY
+    reconnect_max_delay = RECONNECT_MAX_DELAY
+    reconnect_timeout = RECONNECT_TIMEOUT
+
+    def __init__(self, host, port, voice=True, media=True, history=HISTORY_BACKLOG):
+        self.host = host
+        self.port = port
+        self.use_media = media and voice
+        self.history = history
+        self.nickname = ""
+        self.socket = None
+        self.connected = False
+        self.binary = False  # True once the server accepted the binary protocol
+        self.server_version = 1  # Protocol version the server agreed to
+        self.pending_data = b""  # Bytes received along with the handshake reply
+        self.session = None  # Token to resume with after a drop, if the server gave one
+        self.stream_offset = 0  # Bytes of the server's stream read, up to the last complete message
+        self.reconnecting = False
+        self.send_lock = threading.Lock()  # Keeps frames from the caller's and voice threads whole
+        self.codec_name = PCMCodec.name  # Codec for outgoing voice, set during negotiation
+        self.codec = None  # Its encoder, made when voice is first captured
+        self.current_room = "lobby"  # The server puts every new client in the lobby
+        # Backlog being received, with live messages held back until it ends; network thread only
+        self.history_pending = False
+        self.history_batch = []
+        self.media = None  # UDP media channel, while voice uses it
+        self.audio = AudioDevices()
+        # Incoming voice bypasses the caller: network thread -> jitter buffer -> playback thread
+        self.playback = PlaybackEngine(self.audio.open_output) if voice else None
+        self._playback_lock = threading.Lock()
+        self.capturing = False
+        self.capture_stream = None
+        self.capture_thread = None
+        self.voice_seq = 0  # Sequence number of the next outgoing voice frame
+        self.voice_timestamp = 0  # Samples captured so far, sent or suppressed
+        self.vad = None  # Silence detector for the negotiated codec's capture stream, once capturing
+
+    # Called with what the server sends; on the network thread unless noted
+
+    def on_chat(self, text):
+        """A chat line or server notice to show."""
+
+    def on_history(self, entries):
+        """
+        A room's backlog of (id, unix time, message) entries, followed by
+        the live messages held back while it loaded (with no id or time).
+        """
+
+    def on_userlist(self, users):
+        """The whole user list, from a server without presence deltas."""
+
+    def on_presence(self, message):
+        """A PRESENCE snapshot or delta (see presence.py)."""
+
+    def on_status(self, action, user):
+        """A STATUS: update of the talk floor: START, STOP or BUSY."""
+
+    def on_room_joined(self, name):
+        """The server moved us to another room."""
+
+    def on_rooms(self, rooms):
+        """A room listing of (name, members)."""
+
+    def on_error(self, text):
+        """An error to tell the user about; from any thread."""
+
+    def on_notice(self, text):
+        """News of the connection itself, like reconnecting."""
+
+    def on_connection_lost(self):
+        """The connection dropped; reconnecting starts."""
+
+    def on_reconnected(self, resumed):
+        """Connected again, with the session resumed or logged in afresh."""
+
+    def on_disconnected(self):
+        """The connection is gone for good."""
+
+    def log(self, text):
+        """Diagnostics not meant for the user; from any thread."""
+        print(text)
+
+    def connect(self, nickname):
+        """
+        Log in and start the network thread. Raises if the server cannot
+        be reached.
+        """
+        self.nickname = nickname
+        self.open_connection()
+        self.connected = True
+        # Asked before listening starts, so no live message is shown ahead of the backlog
+        self.request_history()
+        self.request_media()
+        threading.Thread(target=self.listen_for_messages, daemon=True).start()
+        self.request_room_list()
+
+    def open_connection(self):
+        """
+        Connect and negotiate the binary protocol, falling back to the text
+        protocol if the server does not understand the HELLO line. The new
+        socket replaces the current one only once negotiated, so nothing
+        the other threads send can get ahead of the handshake.
+        """
+        codecs = available_codecs()
+        sock = socket.create_connection((self.host, self.port), timeout=HANDSHAKE_TIMEOUT)
+        try:
+            # Comfort noise descriptors can always be played
+            sock.sendall(hello_line(self.nickname, codecs + [ComfortNoiseCodec.name]))
+            line, rest = read_line(sock)
+            reply = parse_hello_reply(line.decode('utf-8', errors='ignore'))
+            if reply is None:
+                # An older server took the HELLO line for a nickname; start over in text mode
+                sock.close()
+                sock = socket.create_connection((self.host, self.port), timeout=HANDSHAKE_TIMEOUT)
+                sock.sendall((self.nickname + '\n').encode('utf-8'))
+                rest = b""
+                reply = (1, None)
+        except OSError:
+            sock.close()
+            raise
+        sock.settimeout(None)
+        version, codec_name = reply
+        binary = version >= BINARY_PROTOCOL_VERSION
+        with self.send_lock:
+            old, self.socket = self.socket, sock
+            self.server_version = version
+            self.binary = binary
+            # Text protocol clients can only send PCM
+            self.codec_name = codec_name if binary and codec_name in codecs else PCMCodec.name
+        if old is not None:
+            old.close()
+        # The server's stream is counted from the reply on, for resuming
+        self.stream_offset = len(line) + 1
+        self.session = None
+        if self.codec is not None and self.codec.name != self.codec_name:
+            # Made again for the new codec when voice is next captured
+            self.codec = self.vad = None
+        self.pending_data = rest
+
+    def send_raw(self, data):
+        """
+        Send already serialized data without interleaving with other threads.
+        """
+        with self.send_lock:
+            self.socket.sendall(data)
+
+    def send_text(self, message):
+        """
+        Send one text protocol message in the negotiated wire format.
+        """
+        with self.send_lock:
+            # Encoded under the lock: a relogin may change the protocol
+            if self.binary:
+                self.socket.sendall(text_frame(message))
+            else:
+                self.socket.sendall(f"{message}\n".encode('utf-8'))
+
+    def send_chat(self, text):
+        self.send_text(f"MSG:{text}")
+
+    def request_history(self):
+        """
+        Ask for the recent messages of the current room, if the server keeps history.
+        """
+        if self.connected and self.history and self.server_version >= HISTORY_PROTOCOL_VERSION:
+            self.history_pending = True
+            self.send_text(f"HISTORY:LAST:{self.history}")
+
+    def request_media(self):
+        if self.use_media and self.binary and self.server_version >= MEDIA_PROTOCOL_VERSION:
+            self.send_text(MEDIA_REQUEST)
+
+    def request_room_list(self):
+        """
+        Ask the server for the current rooms and their sizes.
+        """
+        if self.connected:
+            self.send_text("ROOM:LIST")
+
+    def join_room(self, name):
+        self.send_text(f"ROOM:JOIN:{name}")
+
+    def listen_for_messages(self):
+        """
+        Listen for incoming messages from the server, reconnecting whenever
+        the connection drops.
+        """
+        error = None
+        try:
+            while True:
+                try:
+                    if self.binary:
+                        self.receive_frames()
+                    else:
+                        self.receive_lines()
+                    error = None
+                except Exception as e:
+                    error = e
+                if not self.connected or not self.reconnect():
+                    break
+        finally:
+            if error is not None and self.connected:
+                self.on_error(f"Error receiving messages: {error}")
+            self.close_media()
+            self.socket.close()
+            self.connected = False
+            self.on_disconnected()
+
+    def reconnect(self):
+        """
+        Connect again after the connection dropped, backing off exponentially:
+        resume the session where the server still keeps it, so nothing is
+        missed and nobody sees us leave, or else log in afresh. Returns
+        False if the user disconnected or the reconnect timeout passed first.
+        Runs on the network thread.
+        """
+        self.reconnecting = True
+        self.close_media()
+        self.on_connection_lost()
+        self.on_notice("Connection lost; reconnecting...")
+        deadline = time.monotonic() + self.reconnect_timeout
+        delay = self.reconnect_delay
+        try:
+            while self.connected:
+                try:
+                    resumed = self.resume_connection()
+                    if not resumed:
+                        self.open_connection()
+                    if not self.connected:
+                        return False  # closed meanwhile; the new socket is closed on the way out
+                    if resumed:
+                        self.on_notice("Reconnected.")
+                        self.on_reconnected(True)
+                    else:
+                        self.on_notice("Reconnected with a new session.")
+                        self.on_reconnected(False)
+                        self.after_login()
+                    self.request_media()
+                    return True
+                except (OSError, ProtocolError) as e:
+                    self.log(f"Reconnect failed: {e}")
+                if time.monotonic() + delay > deadline:
+                    return False
+                time.sleep(random.uniform(delay / 2, delay))
+                delay = min(delay * 2, self.reconnect_max_delay)
+            return False
+        finally:
+            self.reconnecting = False
+
+    def resume_connection(self):
+        """
+        Reconnect and ask to resume the session from the last message read.
+        Returns False if there is no session to resume.
+        """
+        if self.session is None:
+            return False
+        sock = socket.create_connection((self.host, self.port), timeout=HANDSHAKE_TIMEOUT)
+        try:
+            sock.sendall(resume_line(self.session, self.stream_offset))
+            line, rest = read_line(sock)
+        except OSError:
+            sock.close()
+            raise
+        if line.decode('ascii', errors='ignore') != RESUME_OK:
+            sock.close()
+            self.session = None
+            return False
+        sock.settimeout(None)
+        with self.send_lock:
+            old, self.socket = self.socket, sock
+        old.close()
+        self.pending_data = rest
+        return True
+
+    def after_login(self):
+        """
+        Catch up after logging in afresh: the server put us in the lobby
+        and sends a new snapshot of it.
+        """
+        if self.current_room != "lobby":
+            self.join_room(self.current_room)  # its history follows ROOM:JOINED
+        else:
+            self.request_history()
+
+    def receive_lines(self):
+        """
+        Read newline-terminated text protocol messages until the server disconnects.
+        """
+        receiver = Receiver(self.socket, self.pending_data, capacity=RECEIVE_BUFFER_SIZE)
+        while True:
+            for line in receiver.lines():
+                message = line.strip()
+                if message:
+                    self.dispatch_message(message)
+            if not receiver.fill():
+                break  # Server closed connection
+
+    def receive_frames(self):
+        """
+        Read binary protocol frames until the server disconnects, keeping
+        count of the stream read for a resume.
+        """
+        receiver = Receiver(self.socket, self.pending_data, capacity=RECEIVE_BUFFER_SIZE)
+        end = self.stream_offset + len(self.pending_data)
+        try:
+            while True:
+                for frame_type, payload in receiver.frames():
+                    if frame_type == FRAME_VOICE:
+                        self.receive_voice(payload)
+                    elif frame_type == FRAME_TEXT:
+                        message = str(payload, 'utf-8', errors='ignore').strip()
+                        if message:
+                            self.dispatch_message(message)
+                received = receiver.fill()
+                if not received:
+                    break  # Server closed connection
+                end += received
+        finally:
+            # A partial frame left in the receiver is sent again on resume
+            self.stream_offset = end - len(receiver)
+
+    def start_playback(self):
+        """
+        The playback engine, with its thread started on first use; None
+        for a client without voice.
+        """
+        playback = self.playback
+        if playback is not None and not playback.running:
+            with self._playback_lock:
+                if self.connected:
+                    playback.start()
+        return playback
+
+    def receive_voice(self, payload):
+        """
+        Queue a VOICE frame payload for playback; from the network thread,
+        or from the media channel's thread for datagrams.
+        """
+        playback = self.start_playback()
+        if playback is not None:
+            codec_id, seq, timestamp, audio = parse_voice(payload)
+            playback.push(codec_id, seq, timestamp, audio)
+
+    def open_media(self, message):
+        """
+        Start probing the UDP media channel the server offered. Voice keeps
+        going over TCP until the server answers.
+        """
+        try:
+            offer = parse_media_offer(message)
+        except ProtocolError:
+            return
+        if offer is None:
+            return  # MEDIA:NONE: the server has no media channel
+        port, token = offer
+        self.close_media()
+        try:
+            media = MediaLink(self.host, port, token, self.receive_voice,
+                              lambda up: self.media_state_changed(media, up))
+        except OSError as e:
+            self.log(f"Media channel unavailable, voice stays on TCP: {e}")
+            return
+        self.media = media
+        media.start()
+
+    def media_state_changed(self, media, up):
+        """
+        Move incoming voice to the media channel once it works, and back
+        to TCP when it stops working. Runs on the media channel's thread.
+        """
+        if media is not self.media:
+            return  # replaced or closed meanwhile
+        try:
+            self.send_text(MEDIA_ON if up else MEDIA_OFF)
+        except OSError:
+            pass
+        if not up:
+            self.media = None
+
+    def close_media(self):
+        media = self.media
+        self.media = None
+        if media is not None:
+            media.close()
+
+    def dispatch_message(self, message):
+        """
+        Route one text protocol message to its on_*() method.
+        """
+        if message.startswith(PRESENCE_PREFIX):
+            self.on_presence(message)
+        elif message.startswith("USERLIST:"):
+            self.on_userlist(message[len("USERLIST:"):].split(','))
+        elif message.startswith("STATUS:"):
+            parts = message.split(':', 2)
+            if len(parts) == 3:
+                _, action, user = parts
+                self.on_status(action, user)
+        elif message.startswith("ROOM:JOINED:"):
+            self.current_room = message[len("ROOM:JOINED:"):]
+            self.on_room_joined(self.current_room)
+            # Holds the new room's live messages until its backlog is in
+            self.request_history()
+        elif message.startswith("ROOM:ERROR:"):
+            self.on_error(message[len("ROOM:ERROR:"):])
+        elif message.startswith("ROOMS:"):
+            rooms = []
+            for entry in message[len("ROOMS:"):].split(','):
+                name, _, count = entry.partition('=')
+                if name:
+                    rooms.append((name, int(count) if count.isdigit() else 0))
+            self.on_rooms(rooms)
+        elif message.startswith("VOICE:"):
+            # Text protocol voice goes to the playback thread
+            playback = self.start_playback()
+            if playback is None:
+                return
+            try:
+                audio_data = base64.b64decode(message[len("VOICE:"):].strip())
+                playback.push_unsequenced(PCMCodec.codec_id, audio_data)
+            except Exception as e:
+                self.log(f"Error decoding audio data: {e}")
+        elif message.startswith(MEDIA_PREFIX):
+            self.open_media(message)
+        elif message.startswith(SESSION_PREFIX):
+            self.session = message[len(SESSION_PREFIX):]
+        elif message.startswith(HISTORY_PREFIX):
+            try:
+                entry = parse_history(message)
+            except ProtocolError:
+                return
+            if entry is None:
+                # The whole backlog is handed on in one call
+                self.history_pending = False
+                self.on_history(self.history_batch)
+                self.history_batch = []
+            else:
+                self.history_batch.append(entry)
+        elif message.startswith("MSG:") or message.startswith("SERVER:"):
+            if self.history_pending:
+                # Shown after the backlog it follows
+                self.history_batch.append((None, None, message))
+            else:
+                self.on_chat(chat_text(message))
+
+    def start_voice(self):
+        """
+        Start capturing and sending voice data, once the server gave us
+        the floor.
+        """
+        if self.codec is None:
+            self.codec = create_codec(self.codec_name)
+        self.capture_stream = self.audio.open_input(self.codec.sample_rate, self.codec.frame_size)
+        if self.vad is None:
+            self.vad = create_vad(self.codec)
+        if self.vad is not None:
+            self.vad.start()
+        self.capturing = True
+        self.capture_thread = threading.Thread(target=self.capture_and_send_voice, daemon=True)
+        self.capture_thread.start()
+
+    def capture_and_send_voice(self):
+        """
+        Capture audio from the microphone and send it to the server,
+        leaving out silence when a voice activity detector is available.
+        """
+        vad = self.vad
+        if vad is not None:
+            from vad import SID, VOICE
+        try:
+            while self.capturing:
+                data = self.capture_stream.read(self.codec.frame_size, exception_on_overflow=False)
+                # Timestamps count every captured chunk, sequence numbers only
+                # the frames sent, so suppressed silence is not taken for loss
+                timestamp = self.voice_timestamp
+                self.voice_timestamp += self.codec.frame_size
+                if vad is not None:
+                    decision = vad.process(data)
+                    if decision == SID and self.binary:
+                        # Text protocol listeners just hear the gap
+                        self.send_voice_frame(voice_frame(ComfortNoiseCodec.codec_id,
+                                                          ComfortNoiseCodec().encode(vad.noise_level),
+                                                          self.voice_seq, timestamp))
+                        self.voice_seq += 1
+                    if decision != VOICE:
+                        continue
+                if self.binary:
+                    # Encoded with the negotiated codec, no base64 step
+                    self.send_voice_frame(voice_frame(self.codec.codec_id, self.codec.encode(data),
+                                                      self.voice_seq, timestamp))
+                    self.voice_seq += 1
+                else:
+                    encoded_data = base64.b64encode(data).decode('utf-8')
+                    voice_message = f"VOICE:{encoded_data}\n"
+                    self.send_raw(voice_message.encode('utf-8'))
+        except Exception as e:
+            self.on_error(f"Error capturing/sending voice: {e}")
+
+    def send_voice_frame(self, frame):
+        """
+        Send a VOICE frame as a datagram while the media channel is up,
+        else over TCP.
+        """
+        media = self.media
+        if media is None or not media.send_voice(memoryview(frame)[FRAME_HEADER.size:]):
+            try:
+                self.send_raw(frame)
+            except OSError:
+                if not self.reconnecting:
+                    raise
+                # Voice from while the connection is down is lost, like any late frame
+
+    def stop_voice(self):
+        """
+        Stop capturing and sending voice data.
+        """
+        self.capturing = False
+        if self.capture_thread is not None:
+            self.capture_thread.join()
+            self.capture_thread = None
+        if self.capture_stream is not None:
+            self.capture_stream.stop_stream()
+            self.capture_stream.close()
+            self.capture_stream = None
+
+    def close(self):
+        """
+        Leave for good, not dropping: no reconnect, and no grace period
+        on the server. Releases the audio devices.
+        """
+        self.stop_voice()
+        if self.connected:
+            self.close_media()
+            self.connected = False
+            try:
+                if self.session is not None:
+                    self.send_text(SESSION_CLOSE)
+            except OSError:
+                pass
+            # Wakes the network thread, which closes the socket once it stopped
+            # reading: closed under a blocked read, its descriptor could be reused
+            try:
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        if self.playback is not None:
+            with self._playback_lock:
+                self.playback.stop()
+        self.audio.terminate()
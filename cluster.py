@@ -0,0 +1,526 @@
+"""
+Cluster bus for running several server processes as one chat service.
+
+Each server process is a node. Nodes relay room traffic (chat, voice,
+join and leave notices) and their room membership to each other through
+a bus, and a single hub arbitrates every room's talk floor, so only one
+user can talk in a room across the whole cluster.
+
+Two bus implementations share the same hub logic (Hub):
+
+    LocalHub   in-process, each node's events delivered by its own thread;
+               for tests and for checking the hub without sockets
+    BusServer  TCP hub, run with `python cluster.py`; server nodes join it
+               with `python server.py --cluster HOST:PORT` (SocketBus).
+               It can also listen on a Unix socket, as it does for the
+               worker processes of `python server.py --workers N`
+
+Events are dicts with a 'type' key:
+
+    text            {room, text}         relayed to every other node
+    voice           {room, body[, user]} relayed to every other node; body
+                                         is a complete binary VOICE frame,
+                                         user its talker in a mixed room
+    member          {room, user, change[, notice][, node]}
+                                         a user entered (change JOIN) or
+                                         left (LEAVE) a room on a node;
+                                         notice is the SERVER: text to
+                                         show before the member list
+    presence        {room, users, node}  all of a node's members of a room:
+                                         sent by the hub to a node that
+                                         joins, and for one that leaves;
+                                         a node may send it when it joins
+    floor-request   {room, user}         to the hub only
+    floor-release   {room, user}         to the hub only
+    floor-granted   {room, user}         from the hub, to every node
+    floor-released  {room, user}         from the hub, to every node
+    floor-busy      {room, user}         from the hub, to the requester
+
+Membership travels as member events, one per change, so a wave of
+joins costs each node one small event per user rather than the whole
+member list again for every one of them. The hub keeps every node's
+members to bring a joining node up to date.
+
+The hub forwards the events of each node in the order that node
+published them, and every node sees floor decisions in the order the hub
+made them. A node that disconnects has its floors released and its
+members removed from every room.
+
+On the wire each event is a 4-byte metadata length, a 4-byte body length,
+the metadata as JSON and the body as raw bytes (empty except for voice).
+"""
+import argparse
+import json
+import queue
+import socket
+import struct
+import threading
+
+from sendqueue import SendQueue, QueueOverflow
+
+BUS_HOST = '127.0.0.1'
+BUS_PORT = 5060
+
+BUS_HEADER = struct.Struct('!II')
+# Largest event metadata accepted from the wire
+MAX_META_SIZE = 1024 * 1024
+MAX_BODY_SIZE = 1024 * 1024
+
+# Limits of the queue between the hub and each node. Voice is shed first,
+# like on client connections; a node that falls further behind is dropped.
+BUS_QUEUE_BYTES = 4 * 1024 * 1024
+BUS_QUEUE_MESSAGES = 8192
+BUS_DISCONNECT_BYTES = 64 * 1024 * 1024
+
+# Events that are relayed to every other node unchanged
+RELAYED_EVENTS = ('text', 'voice')
+
+
+def encode_event(event):
+    """
+    Serialize one event for the socket bus.
+    """
+    body = event.get('body', b'')
+    meta = json.dumps({key: value for key, value in event.items() if key != 'body'},
+                      separators=(',', ':')).encode('utf-8')
+    return BUS_HEADER.pack(len(meta), len(body)) + meta + bytes(body)
+
+def read_event(stream):
+    """
+    Read one event from a binary file object. Returns None at end of stream.
+    """
+    header = stream.read(BUS_HEADER.size)
+    if len(header) < BUS_HEADER.size:
+        return None
+    meta_size, body_size = BUS_HEADER.unpack(header)
+    if meta_size > MAX_META_SIZE or body_size > MAX_BODY_SIZE:
+        raise ValueError(f"bus event of {meta_size}+{body_size} bytes exceeds limits")
+    meta = stream.read(meta_size)
+    body = stream.read(body_size)
+    if len(meta) < meta_size or len(body) < body_size:
+        return None
+    event = json.loads(meta)
+    if body_size:
+        event['body'] = body
+    return event
+
+
+class Hub:
+    """
+    Routing and talk floor arbitration shared by every bus implementation.
+    Not thread-safe; callers serialize access and deliver the returned
+    (node, event) pairs in order.
+    """
+
+    def __init__(self):
+        self.nodes = []  # node ids, in join order
+        self.floors = {}  # room -> (user, node holding the floor)
+        self.presence = {}  # (node, room) -> that node's users in the room
+
+    def join(self, node):
+        """
+        Register a node. Returns the events that bring it up to date:
+        every other node's members and the current floors.
+        """
+        if node in self.nodes:
+            raise ValueError(f"node {node!r} is already connected")
+        self.nodes.append(node)
+        snapshot = [{'type': 'presence', 'room': room, 'users': users, 'node': owner}
+                    for (owner, room), users in self.presence.items()]
+        snapshot += [{'type': 'floor-granted', 'room': room, 'user': user}
+                     for room, (user, _) in self.floors.items()]
+        return snapshot
+
+    def leave(self, node):
+        """
+        Forget a node, releasing its floors and removing its members.
+        Returns the deliveries telling the remaining nodes.
+        """
+        if node not in self.nodes:
+            return []
+        self.nodes.remove(node)
+        events = []
+        for room, (user, owner) in list(self.floors.items()):
+            if owner == node:
+                del self.floors[room]
+                events.append({'type': 'floor-released', 'room': room, 'user': user})
+        for owner, room in [key for key in self.presence if key[0] == node]:
+            del self.presence[owner, room]
+            events.append({'type': 'presence', 'room': room, 'users': [], 'node': node})
+        return [(target, event) for event in events for target in self.nodes]
+
+    def route(self, origin, event):
+        """
+        Handle one event published by `origin`. Returns the deliveries.
+        """
+        kind = event['type']
+        if kind in RELAYED_EVENTS:
+            return [(target, event) for target in self.nodes if target != origin]
+        if kind == 'member':
+            room, user = event['room'], event['user']
+            users = self.presence.setdefault((origin, room), [])
+            if event['change'] == 'JOIN':
+                users.append(user)
+            elif user in users:
+                users.remove(user)
+            if not users:
+                del self.presence[origin, room]
+            relayed = {'type': 'member', 'room': room, 'user': user, 'change': event['change'], 'node': origin}
+            if 'notice' in event:
+                relayed['notice'] = event['notice']
+            return [(target, relayed) for target in self.nodes if target != origin]
+        if kind == 'presence':
+            event = {'type': 'presence', 'room': event['room'], 'users': list(event['users']), 'node': origin}
+            if event['users']:
+                self.presence[origin, event['room']] = event['users']
+            else:
+                self.presence.pop((origin, event['room']), None)
+            return [(target, event) for target in self.nodes if target != origin]
+        if kind == 'floor-request':
+            room, user = event['room'], event['user']
+            holder = self.floors.get(room)
+            if holder is None:
+                self.floors[room] = (user, origin)
+                granted = {'type': 'floor-granted', 'room': room, 'user': user}
+                return [(target, granted) for target in self.nodes]
+            # A user is told apart by its node too: the same nickname may be taken on another one
+            if holder != (user, origin):
+                return [(origin, {'type': 'floor-busy', 'room': room, 'user': user})]
+            return []  # already holds it
+        if kind == 'floor-release':
+            room, user = event['room'], event['user']
+            if self.floors.get(room) == (user, origin):
+                del self.floors[room]
+                released = {'type': 'floor-released', 'room': room, 'user': user}
+                return [(target, released) for target in self.nodes]
+            return []
+        raise ValueError(f"unknown bus event {kind!r}")
+
+
+class Bus:
+    """
+    A node's connection to the cluster. Incoming events are passed to the
+    handler given when connecting, on a thread owned by the bus and in
+    order; the handler must not block for long.
+    """
+    node = None
+
+    def publish(self, event):
+        """
+        Send an event to the hub. Never blocks on other nodes, and never
+        raises for a hub that is gone or stalled.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+
+class LocalBus(Bus):
+    """
+    A node attached to a LocalHub.
+    """
+
+    def __init__(self, hub, node, handler):
+        self.hub = hub
+        self.node = node
+        self.handler = handler
+        self._events = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._deliver_loop, daemon=True)
+        self._thread.start()
+
+    def _deliver(self, event):
+        self._events.put(event)
+
+    def _deliver_loop(self):
+        while True:
+            event = self._events.get()
+            if event is None:
+                break
+            try:
+                self.handler(event)
+            except Exception as e:
+                print(f"Error handling bus event on {self.node}: {e}")
+
+    def publish(self, event):
+        try:
+            self.hub._publish(self.node, event)
+        except ConnectionError:
+            pass  # disconnected; nothing is delivered any more
+
+    def close(self):
+        self.hub._disconnect(self.node)
+        self._events.put(None)
+        if threading.current_thread() is not self._thread:
+            self._thread.join()
+
+
+class LocalHub:
+    """
+    In-process hub. Every node gets its own delivery thread, so handlers
+    may publish from inside a handler without deadlocking the hub.
+    """
+
+    def __init__(self):
+        self.hub = Hub()
+        self._lock = threading.Lock()
+        self._buses = {}
+
+    def connect(self, node, handler):
+        bus = LocalBus(self, node, handler)
+        with self._lock:
+            snapshot = self.hub.join(node)
+            self._buses[node] = bus
+            for event in snapshot:
+                bus._deliver(event)
+        return bus
+
+    def _publish(self, node, event):
+        with self._lock:
+            if node not in self._buses:
+                raise ConnectionError(f"node {node!r} is not connected")
+            for target, delivered in self.hub.route(node, event):
+                self._buses[target]._deliver(delivered)
+
+    def _disconnect(self, node):
+        with self._lock:
+            if self._buses.pop(node, None) is None:
+                return
+            for target, delivered in self.hub.leave(node):
+                self._buses[target]._deliver(delivered)
+
+
+def connect_bus(address):
+    """
+    Connect to a hub at (host, port), or at the path of its Unix socket.
+    """
+    if isinstance(address, str):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(address)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+    sock = socket.create_connection(address)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+def format_bus_address(address):
+    return address if isinstance(address, str) else f"{address[0]}:{address[1]}"
+
+def _write_loop(sock, send_queue):
+    """
+    Drain a bus send queue onto a socket.
+    """
+    try:
+        while True:
+            batch = send_queue.get_batch()
+            if batch is None:
+                break
+            sock.sendall(b''.join(batch))
+    except OSError:
+        pass
+    finally:
+        send_queue.close()
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+def _bus_queue():
+    return SendQueue(max_bytes=BUS_QUEUE_BYTES, max_messages=BUS_QUEUE_MESSAGES,
+                     disconnect_bytes=BUS_DISCONNECT_BYTES)
+
+
+class SocketBus(Bus):
+    """
+    A node attached to a BusServer at `address` (see connect_bus()).
+    `on_close` is called once if the connection to the hub is lost.
+    """
+
+    def __init__(self, address, node, handler, on_close=None):
+        self.node = node
+        self.handler = handler
+        self.on_close = on_close
+        self._lost = False  # set once the connection to the hub is going away
+        self.socket = connect_bus(address)
+        self.queue = _bus_queue()
+        self.queue.put(encode_event({'type': 'hello', 'node': node}))
+        self._writer = threading.Thread(target=_write_loop, args=(self.socket, self.queue), daemon=True)
+        self._writer.start()
+        self._reader = threading.Thread(target=self._read_loop, daemon=True)
+        self._reader.start()
+
+    def _read_loop(self):
+        stream = self.socket.makefile('rb')
+        try:
+            while True:
+                event = read_event(stream)
+                if event is None:
+                    break
+                try:
+                    self.handler(event)
+                except Exception as e:
+                    print(f"Error handling bus event on {self.node}: {e}")
+        except (OSError, ValueError):
+            pass
+        finally:
+            self._lost = True
+            stream.close()
+            self.queue.close()
+            if self.on_close is not None:
+                self.on_close()
+
+    def publish(self, event):
+        """
+        Queue an event for the hub. If the hub fell so far behind that
+        its queue overflowed, or the connection is already gone, the
+        event is dropped and the connection closed: the node carries on
+        standalone through `on_close`, called from the reader thread, so
+        publishing is safe under the caller's locks.
+        """
+        try:
+            self.queue.put(encode_event(event), event['type'] == 'voice')
+        except QueueOverflow as e:
+            if self._lost:
+                return
+            self._lost = True
+            print(f"Dropping the bus connection of {self.node}: {e}")
+            try:
+                # Wakes the reader, and the writer if a stalled hub blocks it
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def close(self):
+        self.queue.close()
+        self._writer.join()
+        self.socket.close()
+
+
+class BusServer:
+    """
+    TCP hub, or a Unix socket one when given a `path`. Each node gets a
+    reader thread and a writer thread with its own bounded queue, so a
+    slow node only backs up its own queue. Listens from the start; nodes
+    are served once serve_forever() or start() runs.
+    """
+
+    def __init__(self, host=BUS_HOST, port=BUS_PORT, path=None):
+        self.hub = Hub()
+        self._lock = threading.Lock()
+        self._queues = {}  # node -> SendQueue
+        if path is not None:
+            self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.server.bind(path)
+        else:
+            self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.server.bind((host, port))
+        self.server.listen()
+        self.address = self.server.getsockname()
+
+    def serve_forever(self):
+        tcp = self.server.family != socket.AF_UNIX
+        try:
+            while True:
+                sock, _ = self.server.accept()
+                if tcp:
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                threading.Thread(target=self._serve_node, args=(sock,), daemon=True).start()
+        except OSError:
+            pass  # closed
+
+    def start(self):
+        """
+        Serve on a background thread.
+        """
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+    def close(self):
+        self.server.close()
+
+    def _deliver(self, deliveries):
+        """
+        Queue deliveries, serializing each event once. Caller holds the lock.
+        Returns the nodes whose queues overflowed.
+        """
+        encoded = {}
+        failed = []
+        for target, event in deliveries:
+            data = encoded.get(id(event))
+            if data is None:
+                data = encoded[id(event)] = encode_event(event)
+            try:
+                self._queues[target].put(data, event['type'] == 'voice')
+            except QueueOverflow:
+                failed.append(target)
+        return failed
+
+    def _drop(self, nodes):
+        for node in nodes:
+            with self._lock:
+                send_queue = self._queues.pop(node, None)
+                if send_queue is None:
+                    continue
+                failed = self._deliver(self.hub.leave(node))
+            send_queue.close()
+            print(f"Node {node} left the cluster.")
+            self._drop(failed)
+
+    def _serve_node(self, sock):
+        stream = sock.makefile('rb')
+        node = None
+        try:
+            hello = read_event(stream)
+            if hello is None or hello.get('type') != 'hello':
+                return
+            send_queue = _bus_queue()
+            with self._lock:
+                snapshot = self.hub.join(hello['node'])
+                node = hello['node']
+                self._queues[node] = send_queue
+                failed = self._deliver((node, event) for event in snapshot)
+            threading.Thread(target=_write_loop, args=(sock, send_queue), daemon=True).start()
+            print(f"Node {node} joined the cluster.")
+            self._drop(failed)
+            while True:
+                event = read_event(stream)
+                if event is None:
+                    break
+                with self._lock:
+                    failed = self._deliver(self.hub.route(node, event))
+                self._drop(failed)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Error serving node {node}: {e}")
+        finally:
+            if node is not None:
+                self._drop([node])
+            stream.close()
+            sock.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Cluster bus hub for chat server nodes.")
+    parser.add_argument('--host', default=BUS_HOST, help="Address to listen on for nodes.")
+    parser.add_argument('--port', type=int, default=BUS_PORT, help="Port to listen on for nodes.")
+    args = parser.parse_args(argv)
+
+    try:
+        server = BusServer(args.host, args.port)
+    except OSError as e:
+        print(f"Failed to bind bus hub on {args.host}:{args.port}: {e}")
+        return
+    print(f"Cluster bus hub started on {args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nShutting down the hub.")
+    finally:
+        server.close()
+
+if __name__ == "__main__":
+    main()
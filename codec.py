@@ -0,0 +1,250 @@
+"""
+Voice codecs.
+
+Every codec works on 16-bit mono PCM at its own sample rate and frame size;
+the client opens its audio streams with those parameters. The server never
+decodes voice, it only reads the codec id in front of each frame to decide
+which listeners can play it.
+
+Codecs, in order of preference:
+
+    opus  48 kHz, ~24 kbit/s, needs the optional `opuslib` package
+    ulaw  8 kHz G.711 mu-law, 64 kbit/s, pure Python
+    pcm   44.1 kHz raw 16-bit samples, 705.6 kbit/s, the original format
+
+One more id, 'cn', is not audio but a comfort noise descriptor, sent in
+place of voice frames while the talker is silent (see vad.py). Clients
+that can play it list it in their HELLO offer; it is never negotiated as
+the codec to send with.
+"""
+import random
+from array import array
+from functools import lru_cache
+
+SAMPLE_WIDTH = 2  # bytes per 16-bit sample
+CHANNELS = 1
+
+
+class Codec:
+    """
+    Base class. Instances are per stream because real codecs keep state
+    between frames; create a separate one for each direction.
+    """
+    name = None
+    codec_id = None
+    sample_rate = None
+    frame_size = None  # samples per encoded frame
+
+    @property
+    def frame_bytes(self):
+        """
+        Size of one frame of input PCM.
+        """
+        return self.frame_size * SAMPLE_WIDTH * CHANNELS
+
+    @classmethod
+    def available(cls):
+        """
+        Whether this process can encode and decode with the codec.
+        """
+        return True
+
+    def encode(self, pcm):
+        raise NotImplementedError
+
+    def decode(self, data):
+        raise NotImplementedError
+
+
+class PCMCodec(Codec):
+    """
+    Uncompressed samples, as sent by clients before codecs were negotiated.
+    """
+    name = 'pcm'
+    codec_id = 0
+    sample_rate = 44100
+    frame_size = 1024
+
+    def encode(self, pcm):
+        return bytes(pcm)
+
+    def decode(self, data):
+        return bytes(data)
+
+
+# Upper bound of each mu-law segment, on 14-bit magnitudes
+_ULAW_SEGMENT_END = (0x3F, 0x7F, 0xFF, 0x1FF, 0x3FF, 0x7FF, 0xFFF, 0x1FFF)
+
+def _ulaw_encode_sample(sample):
+    """
+    G.711 mu-law encoding of one signed 16-bit sample (Sun reference algorithm).
+    """
+    sample >>= 2  # 14-bit
+    if sample < 0:
+        sample = -sample
+        mask = 0x7F
+    else:
+        mask = 0xFF
+    sample = min(sample, 8159) + (0x84 >> 2)
+    for segment, end in enumerate(_ULAW_SEGMENT_END):
+        if sample <= end:
+            return ((segment << 4) | ((sample >> (segment + 1)) & 0x0F)) ^ mask
+    return 0x7F ^ mask
+
+def _ulaw_decode_byte(byte):
+    byte = ~byte & 0xFF
+    sign = byte & 0x80
+    exponent = (byte >> 4) & 0x07
+    mantissa = byte & 0x0F
+    sample = (((mantissa << 3) + 0x84) << exponent) - 0x84
+    return -sample if sign else sample
+
+@lru_cache(maxsize=None)
+def ulaw_tables():
+    """
+    Lookup tables, built on first use: every 16-bit sample (indexed as
+    unsigned) to its mu-law byte, and every mu-law byte back to a sample.
+    """
+    encode = bytes(_ulaw_encode_sample(s - 65536 if s >= 32768 else s) for s in range(65536))
+    decode = array('h', (_ulaw_decode_byte(b) for b in range(256)))
+    return encode, decode
+
+
+class ULawCodec(Codec):
+    """
+    Narrowband G.711 mu-law: one byte per sample at 8 kHz.
+    About 11x less data than the 44.1 kHz PCM format.
+    """
+    name = 'ulaw'
+    codec_id = 1
+    sample_rate = 8000
+    frame_size = 160  # 20 ms
+
+    def __init__(self):
+        self._encode_table, self._decode_table = ulaw_tables()
+
+    def encode(self, pcm):
+        samples = array('H')
+        samples.frombytes(pcm)
+        table = self._encode_table
+        return bytes(table[s] for s in samples)
+
+    def decode(self, data):
+        table = self._decode_table
+        return array('h', (table[b] for b in data)).tobytes()
+
+
+class OpusCodec(Codec):
+    """
+    Opus in VoIP mode through the optional `opuslib` package.
+    """
+    name = 'opus'
+    codec_id = 2
+    sample_rate = 48000
+    frame_size = 960  # 20 ms
+    bitrate = 24000
+
+    def __init__(self):
+        import opuslib
+        self._encoder = opuslib.Encoder(self.sample_rate, CHANNELS, opuslib.APPLICATION_VOIP)
+        self._encoder.bitrate = self.bitrate
+        self._decoder = opuslib.Decoder(self.sample_rate, CHANNELS)
+
+    @classmethod
+    def available(cls):
+        try:
+            cls()
+        except Exception:
+            return False
+        return True
+
+    def encode(self, pcm):
+        return self._encoder.encode(bytes(pcm), self.frame_size)
+
+    def decode(self, data):
+        return self._decoder.decode(bytes(data), self.frame_size)
+
+
+# Comfort noise levels run from 0 (full scale) to 127 dB below it
+MAX_NOISE_LEVEL = 127
+# Samples of noise generated per level, played from random offsets
+NOISE_SAMPLES = 8192
+
+@lru_cache(maxsize=None)
+def _noise(level):
+    rms = 32768 * 10 ** (-level / 20)
+    rng = random.Random(level)
+    samples = array('h', (max(-32768, min(32767, round(rng.gauss(0, rms)))) for _ in range(NOISE_SAMPLES)))
+    # Doubled, so any window of up to NOISE_SAMPLES is one slice
+    return samples.tobytes() * 2
+
+
+class ComfortNoiseCodec(Codec):
+    """
+    Silence descriptor for discontinuous transmission: one byte, the
+    background noise level in -dBov as in RFC 3389. encode() takes that
+    level and decode() returns it; comfort_noise() turns it into audio at
+    whatever rate the receiver is playing.
+    """
+    name = 'cn'
+    codec_id = 3
+    sample_rate = 8000
+    frame_size = 160  # nominal, for the jitter buffer's frame duration
+
+    def encode(self, level):
+        return bytes([max(0, min(MAX_NOISE_LEVEL, round(level)))])
+
+    def decode(self, data):
+        return data[0] & MAX_NOISE_LEVEL if len(data) else MAX_NOISE_LEVEL
+
+    @staticmethod
+    def comfort_noise(level, samples):
+        """
+        `samples` 16-bit samples of white noise at the given level.
+        """
+        samples = min(samples, NOISE_SAMPLES)
+        offset = random.randrange(NOISE_SAMPLES) * 2
+        return _noise(level)[offset:offset + samples * 2]
+
+
+# Every codec the protocol knows, best first. The server relays all of them
+# whether or not it could decode them itself.
+CODECS = (OpusCodec, ULawCodec, PCMCodec)
+CODEC_NAMES = {codec.name: codec for codec in CODECS}
+CODEC_IDS = {codec.codec_id: codec for codec in CODECS + (ComfortNoiseCodec,)}
+DEFAULT_CODEC = PCMCodec
+
+
+@lru_cache(maxsize=None)
+def codec_is_available(codec):
+    """
+    Return True if this process can encode and decode `codec`. Checked
+    once per process: a missing opuslib is looked for again on every
+    import attempt, which takes a while.
+    """
+    return codec.available()
+
+def available_codecs():
+    """
+    Names of the codecs usable in this process, best first.
+    """
+    return [codec.name for codec in CODECS if codec_is_available(codec)]
+
+def choose_codec(offered, allowed=None):
+    """
+    Pick the best codec from a client's offer, restricted to `allowed` names.
+    Falls back to PCM, which every client supports.
+    """
+    for codec in CODECS:
+        if codec.name in offered and (allowed is None or codec.name in allowed):
+            return codec
+    return DEFAULT_CODEC
+
+def create_codec(name_or_id):
+    """
+    Instantiate a codec by name or numeric id.
+    """
+    codec = CODEC_NAMES.get(name_or_id) or CODEC_IDS.get(name_or_id)
+    if codec is None:
+        raise ValueError(f"unknown codec {name_or_id!r}")
+    return codec()
@@ -0,0 +1,151 @@
+"""
+Receive-side framing shared by the server and the client.
+
+A Receiver reads a blocking socket with recv_into() straight into one
+preallocated bytearray, and splits what arrived into text protocol lines
+or binary frames (see protocol.py) in place: finding a delimiter or a
+length prefix copies nothing, and the unread tail is only moved to the
+front when the free space at the end runs low.
+
+Every complete line in the buffer is decoded with a single str() call and
+split after that: slicing and classifying line by line in Python costs
+more than decoding a VOICE: line's base64 along with the chat around it,
+which is ASCII and decodes at memcpy speed. TEXT frames are returned as
+memoryviews into the buffer, valid until the next fill(), and decoded
+right away by the caller. VOICE frames are kept by their receiver (queued
+for relay, or buffered for playback), so each is copied once into its own
+bytes object and returned as a view of it, like FrameDecoder does.
+"""
+from protocol import FRAME_HEADER, FRAME_TYPES, FRAME_VOICE, MAX_FRAME_SIZE, ProtocolError
+
+# One buffer per connection on the server, so it starts small; it grows
+# when a frame does not fit, and a client can ask for more up front
+DEFAULT_CAPACITY = 8 * 1024
+# The unread tail is moved to the front when less room than this is left
+MIN_READ = 4096
+
+
+class Receiver:
+    """
+    Socket reader with an in-place line and frame splitter. Line and frame
+    mode can be mixed on one stream, e.g. a HELLO line followed by frames.
+    """
+
+    def __init__(self, sock, initial=b"", capacity=DEFAULT_CAPACITY, max_size=MAX_FRAME_SIZE):
+        self.sock = sock
+        self.max_size = max_size  # longest line or frame payload accepted
+        self.buffer = bytearray(max(capacity, len(initial) + MIN_READ))
+        self.view = memoryview(self.buffer)
+        self.view[:len(initial)] = initial
+        self.start = 0  # unread data is buffer[start:end]
+        self.end = len(initial)
+        self._scanned = 0  # no newline in buffer[start:_scanned]
+        self._needed = 0  # size of the incomplete frame at start, once its header is in
+
+    def __len__(self):
+        return self.end - self.start
+
+    def fill(self):
+        """
+        Read once from the socket into the buffer. Returns the number of
+        bytes read, 0 once the peer closed the connection. Invalidates the
+        views returned so far.
+        """
+        if len(self.buffer) - self.end < max(MIN_READ, self._needed - (self.end - self.start)):
+            self._make_room()
+        received = self.sock.recv_into(self.view[self.end:])
+        self.end += received
+        return received
+
+    def _make_room(self):
+        pending = self.end - self.start
+        size = len(self.buffer)
+        wanted = max(pending + MIN_READ, self._needed)
+        if wanted > size:
+            # A new buffer rather than a resize, which views still held would prevent
+            buffer = bytearray(max(size * 2, wanted))
+            buffer[:pending] = self.view[self.start:self.end]
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+        else:
+            # memoryview assignment copies overlapping ranges correctly
+            self.view[:pending] = self.view[self.start:self.end]
+        self._scanned = max(0, self._scanned - self.start)
+        self.start = 0
+        self.end = pending
+
+    def _consumed(self, start):
+        if start == self.end:
+            # Everything read: start over at the front, so nothing needs moving later
+            self.start = self.end = self._scanned = 0
+        else:
+            self.start = start
+            self._scanned = max(self._scanned, start)
+
+    def line(self):
+        """
+        Consume one complete line, newline included, as a memoryview into
+        the buffer, or return None if none has fully arrived. For the first
+        line of a connection, which may be followed by binary frames.
+        """
+        newline = self.buffer.find(b'\n', max(self.start, self._scanned), self.end)
+        if newline < 0:
+            self._check_line_length()
+            return None
+        line = self.view[self.start:newline + 1]
+        self._consumed(newline + 1)
+        return line
+
+    def lines(self):
+        """
+        Consume every complete line received so far, decoded as UTF-8
+        (invalid bytes dropped) and without newlines.
+        """
+        start, end = self.start, self.end
+        last = self.buffer.rfind(b'\n', max(start, self._scanned), end)
+        if last < 0:
+            self._check_line_length()
+            return []
+        text = str(self.view[start:last], 'utf-8', 'ignore')
+        if last + 1 == end:
+            self.start = self.end = self._scanned = 0
+        else:
+            # What is left is a partial line, with no newline in it
+            self.start = last + 1
+            self._check_line_length()
+        return text.split('\n')
+
+    def _check_line_length(self):
+        self._scanned = self.end
+        if self.end - self.start > self.max_size:
+            raise ProtocolError(f"line longer than {self.max_size} bytes")
+
+    def frames(self):
+        """
+        Consume every complete binary frame received so far, as
+        (type, payload) pairs. TEXT payloads are views into the buffer;
+        VOICE payloads are views of an immutable copy of the whole frame,
+        header included (payload.obj), so it can be relayed as is.
+        """
+        buffer, view = self.buffer, self.view
+        start, end = self.start, self.end
+        header_size = FRAME_HEADER.size
+        frames = []
+        self._needed = 0
+        while end - start >= header_size:
+            frame_type, length = FRAME_HEADER.unpack_from(buffer, start)
+            if frame_type not in FRAME_TYPES:
+                raise ProtocolError(f"unknown frame type {frame_type}")
+            if length > self.max_size:
+                raise ProtocolError(f"frame of {length} bytes exceeds limit of {self.max_size}")
+            frame_end = start + header_size + length
+            if frame_end > end:
+                self._needed = header_size + length
+                break
+            if frame_type == FRAME_VOICE:
+                frames.append((frame_type, memoryview(bytes(view[start:frame_end]))[header_size:]))
+            else:
+                frames.append((frame_type, view[start + header_size:frame_end]))
+            start = frame_end
+        self._consumed(start)
+        return frames
@@ -0,0 +1,405 @@
+"""
+Persistent chat history, one append-only log per room.
+
+A room's directory holds segment files named after the id of their first
+message. <first id>.log is a sequence of records
+
+    +---------+------------------+----------+----------------+
+    | id      | timestamp        | length   | message        |
+    | 8 bytes | 8 bytes, double  | 4 bytes  | `length` bytes |
+    +---------+------------------+----------+----------------+
+
+and <first id>.idx holds the 8-byte offset of each record in the log.
+Ids are consecutive within a room, so locating a message is one index
+read, and a backlog is a sequential scan of memory-mapped segments from
+there on; nothing is looked up per message.
+
+Once a segment reaches its size limit a new one is started, and the
+oldest segments are deleted while the room's history exceeds its size
+limit or their newest message is older than the age limit. The segment
+being written is never deleted.
+
+Messages are written by a thread of the HistoryStore, so storing one
+never waits for the disk. A message that cannot be written (the disk is
+full, say) is dropped and its id skipped: the next message starts a new
+segment, so ids stay consecutive within every segment.
+"""
+import errno
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import deque
+
+RECORD_HEADER = struct.Struct('!QdI')
+INDEX_ENTRY = struct.Struct('!Q')
+
+DEFAULT_SEGMENT_BYTES = 4 * 1024 * 1024
+# Retention per room
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_MAX_AGE = 30 * 24 * 3600  # seconds
+# Quiet rooms never fill a segment; age limits are also checked this often on append
+RETENTION_CHECK_INTERVAL = 60
+# Size of the chunks a backlog is produced in
+REPLAY_BATCH_BYTES = 64 * 1024
+
+
+class Segment:
+    """
+    One log file and its offset index.
+    """
+
+    def __init__(self, directory, first_id):
+        self.first_id = first_id
+        self.log_path = os.path.join(directory, f"{first_id:020d}.log")
+        self.index_path = os.path.join(directory, f"{first_id:020d}.idx")
+        self.count = 0
+        self.size = 0
+        self._log = None
+        self._index = None
+
+    @property
+    def next_id(self):
+        return self.first_id + self.count
+
+    def open(self):
+        """
+        Open for appending, dropping a record left half-written by a crash.
+        """
+        self._log = open(self.log_path, 'ab', buffering=0)
+        self._index = open(self.index_path, 'ab', buffering=0)
+        log_size = os.fstat(self._log.fileno()).st_size
+        count = os.fstat(self._index.fileno()).st_size // INDEX_ENTRY.size
+        size = 0
+        if count:
+            with open(self.index_path, 'rb') as index, open(self.log_path, 'rb') as log:
+                index.seek((count - 1) * INDEX_ENTRY.size)
+                (offset,) = INDEX_ENTRY.unpack(index.read(INDEX_ENTRY.size))
+                log.seek(offset)
+                header = log.read(RECORD_HEADER.size)
+                if len(header) == RECORD_HEADER.size:
+                    size = offset + RECORD_HEADER.size + RECORD_HEADER.unpack(header)[2]
+                if size > log_size or len(header) < RECORD_HEADER.size:
+                    count -= 1
+                    size = offset
+        # Only when needed: truncating updates the modification time retention goes by
+        if size != log_size:
+            self._log.truncate(size)
+        if count * INDEX_ENTRY.size != os.fstat(self._index.fileno()).st_size:
+            self._index.truncate(count * INDEX_ENTRY.size)
+        self.count = count
+        self.size = size
+
+    def append(self, msg_id, timestamp, message):
+        """
+        Write one record and its index entry. If either write fails, both
+        files are cut back to the records before it, so `count` and `size`
+        still describe what is on disk.
+        """
+        record = RECORD_HEADER.pack(msg_id, timestamp, len(message)) + message
+        try:
+            # Unbuffered writes, so memory-mapped readers see the record at once
+            _write_all(self._log, record)
+            _write_all(self._index, INDEX_ENTRY.pack(self.size))
+        except OSError:
+            try:
+                self._log.truncate(self.size)
+                self._index.truncate(self.count * INDEX_ENTRY.size)
+            except OSError:
+                pass  # open() drops what is left over
+            raise
+        self.size += len(record)
+        self.count += 1
+
+    def close(self):
+        if self._log is not None:
+            self._log.close()
+            self._index.close()
+            self._log = self._index = None
+
+    def delete(self):
+        self.close()
+        for path in (self.log_path, self.index_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def offset_of(self, msg_id):
+        with open(self.index_path, 'rb') as index:
+            index.seek((msg_id - self.first_id) * INDEX_ENTRY.size)
+            return INDEX_ENTRY.unpack(index.read(INDEX_ENTRY.size))[0]
+
+
+def _write_all(file, data):
+    if file.write(data) != len(data):
+        raise OSError(errno.ENOSPC, "short write")
+
+
+def scan(log_path, offset, size, count):
+    """
+    Yield (id, timestamp, message) for `count` records of a log file,
+    starting at byte `offset` and not reading past `size`. The message is
+    a memoryview into the mapping, valid until the next record is requested.
+    """
+    with open(log_path, 'rb') as log:
+        with mmap.mmap(log.fileno(), size, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            try:
+                for _ in range(count):
+                    msg_id, timestamp, length = RECORD_HEADER.unpack_from(mapped, offset)
+                    start = offset + RECORD_HEADER.size
+                    offset = start + length
+                    message = view[start:offset]
+                    try:
+                        yield msg_id, timestamp, message
+                    finally:
+                        message.release()
+            finally:
+                view.release()
+
+
+class RoomHistory:
+    """
+    The segments of one room. A message is staged first, which gives it
+    its id without touching the disk, and written by the next flush();
+    writes are serialized by a lock. Replays flush, then work from a
+    snapshot of the segment list and read without the lock.
+    `on_staged(history)` is called after each message is staged.
+    """
+
+    def __init__(self, directory, segment_bytes, max_bytes, max_age, on_staged=None):
+        self.directory = directory
+        self.on_staged = on_staged
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        first_ids = sorted(int(name[:-4]) for name in os.listdir(directory)
+                           if name.endswith('.log') and name[:-4].isdigit())
+        self.segments = [Segment(directory, first_id) for first_id in first_ids]
+        if not self.segments:
+            self.segments.append(Segment(directory, 1))
+        for segment in self.segments:
+            segment.open()
+        for segment in self.segments[:-1]:
+            segment.close()  # only the newest one is appended to
+        self._checked = time.monotonic()
+        self._enforce_retention()
+        self._staging = threading.Lock()
+        self._staged = deque()  # (id, timestamp, message) not written yet, in id order
+        self._next_staged = self.segments[-1].next_id
+
+    @property
+    def next_id(self):
+        """
+        The id the next message will get, counting those staged.
+        """
+        return self._next_staged
+
+    @property
+    def first_id(self):
+        return self.segments[0].first_id
+
+    def append(self, message, timestamp=None):
+        """
+        Store one message (bytes) and return its id.
+        """
+        msg_id = self.stage(message, timestamp)
+        self.flush()
+        return msg_id
+
+    def stage(self, message, timestamp=None):
+        """
+        Give one message (bytes) its id and queue it for the next flush().
+        Never waits for the disk, so callers may hold locks of their own.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        with self._staging:
+            msg_id = self._next_staged
+            self._next_staged += 1
+            self._staged.append((msg_id, timestamp, message))
+        if self.on_staged is not None:
+            self.on_staged(self)
+        return msg_id
+
+    def flush(self):
+        """
+        Write every staged message, in id order. One that cannot be written
+        is reported and dropped.
+        """
+        with self.lock:
+            while self._staged:
+                # Only ever popped under self.lock, so records are written in order
+                msg_id, timestamp, message = self._staged.popleft()
+                try:
+                    self._segment_for(msg_id).append(msg_id, timestamp, message)
+                except OSError as e:
+                    self._report(f"message {msg_id} dropped: {e}")
+
+    def _segment_for(self, msg_id):
+        """
+        The segment to append `msg_id` to, starting a new one when the
+        newest is full or the id before was dropped. Caller holds the lock.
+        """
+        segment = self.segments[-1]
+        if segment.next_id == msg_id and segment.size < self.segment_bytes:
+            if time.monotonic() - self._checked > RETENTION_CHECK_INTERVAL:
+                self._enforce_retention()
+            return segment
+        new = Segment(self.directory, msg_id)
+        new.open()
+        segment.close()
+        if not segment.count:
+            # Nothing was ever written to it
+            segment.delete()
+            self.segments.pop()
+        self.segments.append(new)
+        self._enforce_retention()
+        return new
+
+    def _report(self, problem):
+        print(f"Chat history in {self.directory}: {problem}")
+
+    def _enforce_retention(self):
+        """
+        Delete the oldest segments past the size or age limit. Caller holds the lock.
+        """
+        self._checked = time.monotonic()
+        total = sum(segment.size for segment in self.segments)
+        cutoff = time.time() - self.max_age
+        while len(self.segments) > 1:
+            oldest = self.segments[0]
+            try:
+                expired = os.path.getmtime(oldest.log_path) < cutoff
+            except OSError:
+                expired = True
+            if total <= self.max_bytes and not expired:
+                break
+            try:
+                oldest.delete()
+            except OSError as e:
+                self._report(f"cannot delete {oldest.log_path}: {e}")
+                break
+            total -= oldest.size
+            del self.segments[0]
+
+    def replay(self, start_id, end_id, encode, batch_bytes=REPLAY_BATCH_BYTES):
+        """
+        Yield the messages with start_id <= id < end_id, passed through
+        encode(id, timestamp, message) and joined into chunks of about
+        `batch_bytes`. Messages removed by retention or that cannot be
+        read are skipped.
+        """
+        self.flush()  # staged messages before end_id belong in the backlog
+        with self.lock:
+            end_id = min(end_id, self.segments[-1].next_id)
+            start_id = max(start_id, self.first_id)
+            segments = [(segment, segment.size, segment.count) for segment in self.segments
+                        if segment.first_id < end_id and segment.next_id > start_id]
+        batch, size = [], 0
+        for segment, segment_size, segment_count in segments:
+            first = max(start_id, segment.first_id)
+            last = min(end_id, segment.first_id + segment_count)
+            if last <= first:
+                continue
+            try:
+                offset = segment.offset_of(first) if first > segment.first_id else 0
+                records = scan(segment.log_path, offset, segment_size, last - first)
+                for msg_id, timestamp, message in records:
+                    data = encode(msg_id, timestamp, message)
+                    batch.append(data)
+                    size += len(data)
+                    if size >= batch_bytes:
+                        yield b''.join(batch)
+                        batch, size = [], 0
+            except FileNotFoundError:
+                continue  # deleted by retention since the snapshot
+            except OSError as e:
+                self._report(f"cannot read {segment.log_path}: {e}")
+        if batch:
+            yield b''.join(batch)
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            self.segments[-1].close()
+
+
+class HistoryStore:
+    """
+    Histories of every room under one directory, opened on first use.
+    Staged messages are written by a thread of its own.
+    """
+
+    def __init__(self, directory, segment_bytes=DEFAULT_SEGMENT_BYTES,
+                 max_bytes=DEFAULT_MAX_BYTES, max_age=DEFAULT_MAX_AGE):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._rooms = {}
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._wakeup = threading.Condition()
+        self._unwritten = set()  # RoomHistory objects with staged messages
+        self._closing = False
+        self._writer = threading.Thread(target=self._write, name="history-writer", daemon=True)
+        self._writer.start()
+
+    def room(self, name):
+        """
+        The RoomHistory of a room, created if needed; the first time, that
+        reads its segments from disk. Room names must be safe to use as
+        directory names.
+        """
+        with self._lock:
+            history = self._rooms.get(name)
+            if history is None:
+                history = self._rooms[name] = RoomHistory(
+                    os.path.join(self.directory, name), self.segment_bytes, self.max_bytes, self.max_age,
+                    on_staged=self._schedule)
+            return history
+
+    def _schedule(self, history):
+        with self._wakeup:
+            self._unwritten.add(history)
+            self._wakeup.notify()
+
+    def _write(self):
+        while True:
+            with self._wakeup:
+                while not self._unwritten and not self._closing:
+                    self._wakeup.wait()
+                if not self._unwritten:
+                    return
+                unwritten, self._unwritten = self._unwritten, set()
+            for history in unwritten:
+                history.flush()
+
+    def append(self, room, message, timestamp=None):
+        return self.room(room).append(message, timestamp)
+
+    def stage(self, room, message, timestamp=None):
+        return self.room(room).stage(message, timestamp)
+
+    def next_id(self, room):
+        return self.room(room).next_id
+
+    def replay(self, room, start_id, end_id, encode, batch_bytes=REPLAY_BATCH_BYTES):
+        return self.room(room).replay(start_id, end_id, encode, batch_bytes)
+
+    def close(self):
+        """
+        Write what is staged and close every room.
+        """
+        with self._wakeup:
+            self._closing = True
+            self._wakeup.notify()
+        self._writer.join()
+        with self._lock:
+            for history in self._rooms.values():
+                history.close()
@@ -0,0 +1,275 @@
+"""
+UDP media channel for voice, next to the TCP connection that carries chat
+and control (see protocol.py for the datagrams and the MEDIA: messages).
+
+    MediaRelay  server end: one UDP socket shared by every client, a
+                random token per client handed out over TCP, and the
+                address each token was last heard from
+    MediaLink   client end: probes the server until it answers, then
+                sends voice as datagrams and hands received ones on,
+                probing every KEEPALIVE to keep NAT bindings open; it
+                gives up when answers stop, and the client goes back to
+                voice over TCP
+
+Voice keeps its sequence numbers and timestamps, so the receiver's jitter
+buffer reorders datagrams and conceals lost ones as it does for frames.
+Both ends can drop a share of the datagrams they send and receive at
+random (`loss`), to try voice under packet loss on loopback.
+"""
+import random
+import secrets
+import socket
+import threading
+import time
+
+from protocol import (
+    DATAGRAM_PROBE, DATAGRAM_VOICE, MAX_DATAGRAM_SIZE, MEDIA_TOKEN_SIZE, ProtocolError, media_datagram,
+    parse_media_datagram
+)
+
+# Seconds between probes while the client waits for the first answer
+PROBE_INTERVAL = 0.25
+# Seconds without an answer after which the client stays on TCP
+PROBE_TIMEOUT = 2.0
+# Seconds between probes once the channel is up
+KEEPALIVE = 1.0
+# Seconds without an answer after which a working channel is given up
+MEDIA_TIMEOUT = 5.0
+# Never wait for the socket with the blocking flag on a send
+_SEND_FLAGS = getattr(socket, 'MSG_DONTWAIT', 0)
+
+
+class MediaRelay:
+    """
+    The server's media socket. datagram_received() runs on the thread
+    serving the socket (serve()) or on the event loop (serve_async());
+    send() may be called from any thread.
+    """
+
+    def __init__(self, host, port, on_voice, loss=0.0):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, port))
+        self.port = self.sock.getsockname()[1]
+        self.on_voice = on_voice  # called with (client, VOICE frame payload)
+        self.loss = loss
+        self.received = 0
+        self.sent = 0
+        self.dropped = 0  # datagrams that could not be sent, or were dropped on purpose
+        self._clients = {}  # token -> client
+        self._peers = {}  # token -> address last heard from
+        self._lock = threading.Lock()
+
+    def register(self, client):
+        """
+        Give a client a token for its datagrams, replacing any earlier one.
+        Its voice stays on TCP until the new token's probes get through.
+        """
+        token = secrets.token_bytes(MEDIA_TOKEN_SIZE)
+        with self._lock:
+            self._forget(client)
+            self._clients[token] = client
+        client.media_token = token
+        client.media_address = None
+        return token
+
+    def forget(self, client):
+        with self._lock:
+            self._forget(client)
+        client.media_address = None
+
+    def _forget(self, client):
+        token = client.media_token
+        if token is not None and self._clients.get(token) is client:
+            del self._clients[token]
+            self._peers.pop(token, None)
+
+    def peer(self, client):
+        """
+        The address a client's datagrams last came from, or None.
+        """
+        with self._lock:
+            return self._peers.get(client.media_token)
+
+    def datagram_received(self, data, address):
+        if self.loss and random.random() < self.loss:
+            self.dropped += 1
+            return
+        try:
+            kind, token, payload = parse_media_datagram(data)
+        except ProtocolError:
+            return
+        with self._lock:
+            client = self._clients.get(token)
+            if client is None:
+                return
+            self._peers[token] = address
+        self.received += 1
+        if client.media_address is not None and client.media_address != address:
+            # The client's NAT mapping changed; follow it
+            client.media_address = address
+        if kind == DATAGRAM_PROBE:
+            self.send(media_datagram(DATAGRAM_PROBE, token), address)
+        elif kind == DATAGRAM_VOICE:
+            try:
+                self.on_voice(client, payload)
+            except ProtocolError:
+                pass
+
+    def send(self, datagram, address):
+        """
+        Send one datagram without ever blocking; voice that does not fit
+        in the socket buffer right now is dropped, as the network would.
+        """
+        if self.loss and random.random() < self.loss:
+            self.dropped += 1
+            return
+        try:
+            self.sock.sendto(datagram, _SEND_FLAGS, address)
+            self.sent += 1
+        except OSError:
+            self.dropped += 1
+
+    def serve(self):
+        """
+        Receive datagrams until the socket is closed (threaded engine).
+        """
+        while True:
+            try:
+                data, address = self.sock.recvfrom(MAX_DATAGRAM_SIZE)
+            except ConnectionError:
+                continue  # an ICMP error about an earlier send; Windows reports it here
+            except OSError:
+                break
+            self.datagram_received(data, address)
+
+    async def serve_async(self):
+        """
+        Receive datagrams on the running event loop (asyncio engine).
+        Returns the transport, which must be kept referenced.
+        """
+        import asyncio  # here, not at the top: clients import this module too
+
+        loop = asyncio.get_running_loop()
+        transport, _ = await loop.create_datagram_endpoint(lambda: _RelayProtocol(self), sock=self.sock)
+        return transport
+
+    def close(self):
+        self.sock.close()
+
+
+class _RelayProtocol:
+    """
+    An asyncio datagram protocol, written out rather than derived from
+    asyncio.DatagramProtocol so that the client need not load asyncio.
+    """
+
+    def __init__(self, relay):
+        self.relay = relay
+
+    def connection_made(self, transport):
+        pass
+
+    def datagram_received(self, data, address):
+        self.relay.datagram_received(data, address)
+
+    def error_received(self, exc):
+        pass
+
+    def connection_lost(self, exc):
+        pass
+
+
+class MediaLink:
+    """
+    The client's media socket, served by a thread of its own.
+    `on_voice(payload)` gets each VOICE frame payload received;
+    `on_state(up)` is called with True once the server answered and with
+    False when the channel could not be opened or stopped working. Both
+    run on the link's thread.
+    """
+
+    def __init__(self, host, port, token, on_voice, on_state, loss=0.0):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # Connected, so the kernel drops datagrams from anyone but the server
+        self.sock.connect((host, port))
+        self.sock.settimeout(PROBE_INTERVAL)
+        self.token = token
+        self.on_voice = on_voice
+        self.on_state = on_state
+        self.loss = loss
+        self.up = False
+        self.running = False
+        self.thread = None
+        self.sent = 0
+        self.received = 0
+        self.dropped = 0
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="media", daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.running = False
+        self.up = False
+        self.sock.close()
+
+    def send_voice(self, payload):
+        """
+        Send a VOICE frame payload as a datagram. Returns False when the
+        channel is not up, so the caller sends the frame over TCP instead.
+        """
+        if not self.up:
+            return False
+        self._send(media_datagram(DATAGRAM_VOICE, payload, self.token))
+        return True
+
+    def _send(self, datagram):
+        if self.loss and random.random() < self.loss:
+            self.dropped += 1
+            return
+        try:
+            self.sock.send(datagram, _SEND_FLAGS)
+            self.sent += 1
+        except OSError:
+            self.dropped += 1
+
+    def _run(self):
+        started = last_answer = time.monotonic()
+        next_probe = started
+        try:
+            while self.running:
+                now = time.monotonic()
+                if now >= next_probe:
+                    self._send(media_datagram(DATAGRAM_PROBE, token=self.token))
+                    next_probe = now + (KEEPALIVE if self.up else PROBE_INTERVAL)
+                if not self.up and now - started > PROBE_TIMEOUT:
+                    break
+                if self.up and now - last_answer > MEDIA_TIMEOUT:
+                    break
+                try:
+                    data = self.sock.recv(MAX_DATAGRAM_SIZE)
+                except socket.timeout:
+                    continue
+                except ConnectionError:
+                    continue  # nothing listens on the port (ICMP unreachable); keep probing
+                if not data or (self.loss and random.random() < self.loss):
+                    self.dropped += 1
+                    continue
+                self.received += 1
+                if data[0] == DATAGRAM_VOICE:
+                    self.on_voice(memoryview(data)[1:])
+                elif data[0] == DATAGRAM_PROBE and data[1:] == self.token:
+                    last_answer = time.monotonic()
+                    if not self.up:
+                        self.up = True
+                        self.on_state(True)
+        except OSError:
+            pass  # closed
+        finally:
+            was_running = self.running
+            self.up = False
+            self.running = False
+            self.sock.close()
+            if was_running:
+                self.on_state(False)
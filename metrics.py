@@ -0,0 +1,333 @@
+"""
+Server instrumentation: counters, histograms, lock wait timing and a
+sampling profiler, served in the Prometheus text format over HTTP.
+
+Nothing here runs unless the server is started with --metrics-port.
+server.py then creates one Metrics object and calls into it from its hot
+paths. Updates are not locked. Under the threaded engine two racing
+increments can very rarely lose one, which is fine for monitoring and far
+cheaper than a lock per update.
+
+    GET  /metrics              global counters, histograms and gauges
+    GET  /metrics/connections  the same per connected client
+    POST /profile/start        start sampling every thread's stack
+    POST /profile/stop         stop sampling
+    GET  /profile              samples so far, as collapsed stacks
+                               (the input of flamegraph.pl or speedscope)
+"""
+import os
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+METRICS_HOST = '127.0.0.1'
+METRIC_PREFIX = 'chat_'
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Upper bounds of histogram buckets, in seconds
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+                   0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+FANOUT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+# Message types counted separately; anything else is counted as OTHER so
+# a misbehaving client cannot create new series
+MESSAGE_TYPES = frozenset(['MSG', 'STATUS', 'VOICE', 'USERLIST', 'SERVER', 'ROOM', 'ROOMS',
+                           'PRESENCE', 'HISTORY', 'HELLO'])
+
+DEFAULT_PROFILE_INTERVAL = 0.005  # seconds between stack samples
+# Threads whose name starts with this are left out of profiles
+METRICS_THREAD_PREFIX = 'metrics'
+
+
+def message_type(message):
+    """
+    Type label of a text protocol message (str or bytes).
+    """
+    if isinstance(message, (bytes, bytearray, memoryview)):
+        message = bytes(message[:10]).decode('ascii', errors='replace')
+    kind = message.partition(':')[0]
+    return kind if kind in MESSAGE_TYPES else 'OTHER'
+
+
+class Histogram:
+    """
+    Cumulative-on-export histogram with fixed bucket bounds.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def quantile(self, fraction):
+        """
+        Upper bound of the bucket holding the given quantile, for reports.
+        """
+        counts = list(self.counts)
+        target = fraction * sum(counts)
+        seen = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            seen += count
+            if count and seen >= target:
+                return bound
+        return 0.0
+
+    def lines(self, name, labels=''):
+        cumulative = 0
+        separator = ',' if labels else ''
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield f'{name}_bucket{{{labels}{separator}le="{bound:g}"}} {cumulative}'
+        cumulative += self.counts[-1]
+        yield f'{name}_bucket{{{labels}{separator}le="+Inf"}} {cumulative}'
+        suffix = f'{{{labels}}}' if labels else ''
+        yield f'{name}_sum{suffix} {self.sum:.9g}'
+        yield f'{name}_count{suffix} {cumulative}'
+
+
+class TimedLock:
+    """
+    A drop-in for threading.Lock that records how long each acquisition
+    waited. Uncontended acquisitions skip the clock.
+    """
+
+    def __init__(self, lock, histogram):
+        self._lock = lock
+        self.histogram = histogram
+
+    def acquire(self, blocking=True, timeout=-1):
+        if self._lock.acquire(False):
+            self.histogram.counts[0] += 1
+            return True
+        if not blocking:
+            return False
+        start = time.perf_counter()
+        acquired = self._lock.acquire(True, timeout)
+        self.histogram.observe(time.perf_counter() - start)
+        return acquired
+
+    def release(self):
+        self._lock.release()
+
+    def locked(self):
+        return self._lock.locked()
+
+    __enter__ = acquire
+
+    def __exit__(self, *exc_info):
+        self._lock.release()
+
+
+class SamplingProfiler:
+    """
+    Samples the stack of every thread at a fixed interval from a
+    background thread, using sys._current_frames(). Far cheaper than a
+    tracing profiler, and the only cost while stopped is none at all.
+    """
+
+    def __init__(self):
+        self.samples = Counter()
+        self.interval = DEFAULT_PROFILE_INTERVAL
+        self._stop = None
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self, interval=DEFAULT_PROFILE_INTERVAL):
+        if self.running:
+            return
+        self.samples = Counter()
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(self._stop,),
+                                        name=f"{METRICS_THREAD_PREFIX}-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if not self.running:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self, stop):
+        while not stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                name = names.get(ident, 'thread')
+                if name.startswith(METRICS_THREAD_PREFIX):
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)})")
+                    frame = frame.f_back
+                # Threads of the threaded engine are named Thread-N; group them
+                stack.append(name.split('-')[0].split(' ')[0])
+                self.samples[';'.join(reversed(stack))] += 1
+
+    def collapsed(self):
+        return ''.join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+
+class Metrics:
+    """
+    Everything the server measures. Gauges that are cheap to compute on
+    demand (clients, queue depths) are not tracked here but collected from
+    the server when scraped.
+    """
+
+    def __init__(self):
+        self.messages_in = Counter()  # message type -> count
+        self.bytes_in = Counter()
+        self.messages_out = Counter()  # counted per recipient
+        self.bytes_out = Counter()
+        self.broadcast_seconds = {'text': Histogram(), 'voice': Histogram()}
+        self.fanout = Histogram(FANOUT_BUCKETS)
+        self.parse_seconds = Histogram()
+        self.lock_wait = {}  # lock name -> Histogram
+        self.profiler = SamplingProfiler()
+
+    def timed_lock(self, name, lock):
+        histogram = self.lock_wait[name] = Histogram()
+        return TimedLock(lock, histogram)
+
+    def received(self, kind, size):
+        self.messages_in[kind] += 1
+        self.bytes_in[kind] += size
+
+    def sent(self, kind, size, recipients=1):
+        self.messages_out[kind] += recipients
+        self.bytes_out[kind] += size
+
+    def broadcast_done(self, kind, size, recipients, seconds):
+        self.sent(kind, size, recipients)
+        self.broadcast_seconds['voice' if kind == 'VOICE' else 'text'].observe(seconds)
+        self.fanout.observe(recipients)
+
+    def render(self, gauges=()):
+        """
+        The Prometheus text exposition of every metric. `gauges` is a list
+        of (name, help, [(labels, value)]) collected by the server.
+        """
+        p = METRIC_PREFIX
+        out = []
+
+        def header(name, help_text, kind):
+            out.append(f"# HELP {p}{name} {help_text}")
+            out.append(f"# TYPE {p}{name} {kind}")
+
+        for name, help_text, counter in (
+                ('messages_received_total', "Messages received from clients, by type.", self.messages_in),
+                ('bytes_received_total', "Bytes received from clients, by message type.", self.bytes_in),
+                ('messages_sent_total', "Messages queued for clients, by type, once per recipient.", self.messages_out),
+                ('bytes_sent_total', "Bytes queued for clients, by message type.", self.bytes_out)):
+            header(name, help_text, 'counter')
+            for kind, value in sorted(counter.items()):
+                out.append(f'{p}{name}{{type="{kind}"}} {value}')
+
+        header('broadcast_seconds', "Time to queue one message for every member of a room.", 'histogram')
+        for kind, histogram in self.broadcast_seconds.items():
+            out.extend(histogram.lines(f'{p}broadcast_seconds', f'kind="{kind}"'))
+        header('broadcast_recipients', "Recipients per broadcast.", 'histogram')
+        out.extend(self.fanout.lines(f'{p}broadcast_recipients'))
+        header('parse_seconds', "Time to split received bytes into messages, per read.", 'histogram')
+        out.extend(self.parse_seconds.lines(f'{p}parse_seconds'))
+        header('lock_wait_seconds', "Time spent waiting to acquire a server lock.", 'histogram')
+        for name, histogram in self.lock_wait.items():
+            out.extend(histogram.lines(f'{p}lock_wait_seconds', f'lock="{name}"'))
+
+        for name, help_text, values in gauges:
+            header(name, help_text, 'gauge')
+            for labels, value in values:
+                out.append(f'{p}{name}{{{labels}}} {value}' if labels else f'{p}{name} {value}')
+        header('profiler_running', "1 while the sampling profiler is on.", 'gauge')
+        out.append(f'{p}profiler_running {int(self.profiler.running)}')
+        return '\n'.join(out) + '\n'
+
+
+def label_value(value):
+    """
+    Escape a string for use as a Prometheus label value.
+    """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """
+    Serves the endpoints listed in the module docstring. The server object
+    carries the Metrics and the collect callbacks.
+    """
+
+    def setup(self):
+        threading.current_thread().name = f"{METRICS_THREAD_PREFIX}-http"
+        super().setup()
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        if path == '/metrics':
+            self.reply(200, self.server.metrics.render(self.server.collect()))
+        elif path == '/metrics/connections':
+            self.reply(200, self.server.collect_connections())
+        elif path == '/profile':
+            self.reply(200, self.server.metrics.profiler.collapsed())
+        else:
+            self.reply(404, "not found\n")
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        profiler = self.server.metrics.profiler
+        if url.path == '/profile/start':
+            try:
+                interval = float(parse_qs(url.query).get('interval', [DEFAULT_PROFILE_INTERVAL])[0])
+            except ValueError:
+                self.reply(400, "bad interval\n")
+                return
+            profiler.start(max(interval, 0.001))
+            self.reply(200, "profiling\n")
+        elif url.path == '/profile/stop':
+            profiler.stop()
+            self.reply(200, f"stopped, {sum(profiler.samples.values())} samples\n")
+        else:
+            self.reply(404, "not found\n")
+
+    def reply(self, status, body):
+        data = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass  # scrapes would flood the server's output
+
+
+def serve_metrics(metrics, collect, collect_connections, host=METRICS_HOST, port=0):
+    """
+    Start the HTTP endpoint on a daemon thread and return the HTTP server.
+    `collect` returns the gauges for render(); `collect_connections`
+    returns the per-connection exposition text.
+    """
+    httpd = ThreadingHTTPServer((host, port), MetricsHandler)
+    httpd.daemon_threads = True
+    httpd.metrics = metrics
+    httpd.collect = collect
+    httpd.collect_connections = collect_connections
+    thread = threading.Thread(target=httpd.serve_forever, name=f"{METRICS_THREAD_PREFIX}-server", daemon=True)
+    thread.start()
+    return httpd
@@ -0,0 +1,211 @@
+"""
+Server-side voice mixing for rooms where several users talk at once.
+
+In a mixed room the server does not relay each talker's frames. It
+decodes them into a per-talker FIFO at one sample rate, and on a fixed
+tick takes one tick of audio from every talker, sums them with NumPy and
+clips the result to 16 bits. Every listener then gets a single stream,
+whatever the number of talkers:
+
+    listeners        the mix of every talker, encoded once per codec
+    each talker      the mix without their own voice, i.e. the total
+                     minus their row, computed for all talkers at once
+
+Only stateless codecs are produced (mu-law for clients that offered it,
+PCM otherwise), so listeners can be moved between the shared mix and
+their own without an encoder to keep in step. Opus input is decoded
+when this process can (see codec.py) and dropped otherwise. Comfort noise
+descriptors add nothing to the mix.
+
+NumPy is needed only here; server.py imports this module when mixing
+is switched on.
+"""
+import threading
+
+import numpy as np
+
+from codec import (
+    CODEC_IDS, ComfortNoiseCodec, PCMCodec, ULawCodec, codec_is_available, create_codec, ulaw_tables
+)
+
+MIX_RATE = PCMCodec.sample_rate
+# Every codec's rate gives a whole number of samples per 20 ms tick
+MIX_TICK = 0.02  # seconds
+# A talker is mixed in once this much of their audio is buffered, which
+# absorbs network jitter and senders whose frames are not one tick long
+PREFILL_TICKS = 2
+# Oldest audio is dropped beyond this, to bound the delay a talker can build up
+MAX_BACKLOG_TICKS = 10
+# A talker whose buffer stayed empty this long is forgotten
+IDLE_TICKS = 50
+SAMPLE_MIN, SAMPLE_MAX = -32768, 32767
+
+
+class Stream:
+    """
+    One talker's decoded audio waiting to be mixed, in a ring buffer.
+    """
+    __slots__ = ('buffer', 'start', 'size', 'primed', 'idle', 'decoder')
+
+    def __init__(self, capacity):
+        self.buffer = np.zeros(capacity, np.float32)
+        self.start = 0
+        self.size = 0
+        self.primed = False  # mixed in from the next tick on
+        self.idle = 0  # ticks since audio last arrived
+        self.decoder = None  # codec object, for codecs NumPy cannot decode
+
+    def write(self, samples):
+        capacity = len(self.buffer)
+        if len(samples) >= capacity:
+            samples = samples[-capacity:]
+        overflow = self.size + len(samples) - capacity
+        if overflow > 0:
+            # Drop the oldest audio, not the newest
+            self.start = (self.start + overflow) % capacity
+            self.size -= overflow
+        end = (self.start + self.size) % capacity
+        first = min(len(samples), capacity - end)
+        self.buffer[end:end + first] = samples[:first]
+        self.buffer[:len(samples) - first] = samples[first:]
+        self.size += len(samples)
+
+    def read_into(self, out):
+        """
+        Move up to len(out) samples into `out`, zero-filling the rest.
+        Returns the number of samples read.
+        """
+        count = min(len(out), self.size)
+        capacity = len(self.buffer)
+        first = min(count, capacity - self.start)
+        out[:first] = self.buffer[self.start:self.start + first]
+        out[first:count] = self.buffer[:count - first]
+        out[count:] = 0
+        self.start = (self.start + count) % capacity
+        self.size -= count
+        return count
+
+
+class Mixer:
+    """
+    The talkers of one room. push() may be called from any thread, mix()
+    from the one ticking thread or task.
+    """
+
+    def __init__(self, rate=MIX_RATE, tick=MIX_TICK):
+        self.rate = rate
+        self.tick_samples = round(rate * tick)
+        self.seq = 0  # frames produced, numbering every output stream of the room
+        self.dropped = 0  # frames that could not be decoded
+        self._streams = {}  # source -> Stream
+        self._lock = threading.Lock()
+        encode, decode = ulaw_tables()
+        self._ulaw_encode = np.frombuffer(encode, np.uint8)
+        self._ulaw_decode = np.array(decode, np.float32)
+        self._positions = {}  # (input length, rate) -> sample positions at the mix rate
+
+    def __len__(self):
+        return len(self._streams)
+
+    def frame_samples(self, codec_id):
+        """
+        Samples in one output frame of a codec, i.e. its timestamp step.
+        """
+        return self.tick_samples * CODEC_IDS[codec_id].sample_rate // self.rate
+
+    def push(self, source, codec_id, audio):
+        """
+        Queue one encoded frame from a talker, identified by any hashable
+        `source`. Returns False if the frame could not be decoded.
+        """
+        if codec_id == ComfortNoiseCodec.codec_id:
+            # The talker went silent; their buffer runs out and they drop out of the mix
+            return True
+        with self._lock:
+            stream = self._streams.get(source)
+            if stream is None:
+                stream = self._streams[source] = Stream(self.tick_samples * MAX_BACKLOG_TICKS)
+            samples = self._decode(stream, codec_id, audio)
+            if samples is None:
+                self.dropped += 1
+                return False
+            stream.write(samples)
+            stream.idle = 0
+            return True
+
+    def remove(self, source):
+        with self._lock:
+            self._streams.pop(source, None)
+
+    def _decode(self, stream, codec_id, audio):
+        codec = CODEC_IDS.get(codec_id)
+        if codec is None:
+            return None
+        if codec_id == PCMCodec.codec_id:
+            samples = np.frombuffer(audio, np.int16, len(audio) // 2).astype(np.float32)
+        elif codec_id == ULawCodec.codec_id:
+            samples = self._ulaw_decode[np.frombuffer(audio, np.uint8)]
+        else:
+            if stream.decoder is None:
+                if not codec_is_available(codec):
+                    return None
+                stream.decoder = create_codec(codec_id)
+            pcm = stream.decoder.decode(audio)
+            samples = np.frombuffer(pcm, np.int16, len(pcm) // 2).astype(np.float32)
+        if codec.sample_rate != self.rate:
+            samples = self._resample(samples, codec.sample_rate, self.rate)
+        return samples
+
+    def _resample(self, samples, from_rate, to_rate):
+        """
+        Linear interpolation; enough for speech, and free of state.
+        """
+        key = (len(samples), from_rate, to_rate)
+        positions = self._positions.get(key)
+        if positions is None:
+            count = round(len(samples) * to_rate / from_rate)
+            positions = self._positions[key] = np.arange(count) * (from_rate / to_rate)
+        return np.interp(positions, np.arange(len(samples)), samples).astype(np.float32)
+
+    def mix(self):
+        """
+        Take one tick of audio from every primed talker. Returns None when
+        nobody is talking, else (mix, personal): the int16 mix of every
+        talker, and for each talker the mix without them. A lone talker
+        gets silence, which keeps every listener's frames numbered without
+        gaps for the jitter buffer.
+        """
+        with self._lock:
+            ready = []
+            for source, stream in list(self._streams.items()):
+                stream.idle += 1
+                if not stream.primed and stream.size:
+                    # Start once prefilled, or play out the tail of a talker who stopped
+                    stream.primed = (stream.size >= self.tick_samples * PREFILL_TICKS
+                                     or stream.idle > PREFILL_TICKS)
+                if stream.primed:
+                    ready.append((source, stream))
+                elif stream.idle >= IDLE_TICKS:
+                    del self._streams[source]
+            if not ready:
+                return None
+            rows = np.empty((len(ready), self.tick_samples), np.float32)
+            for row, (source, stream) in zip(rows, ready):
+                if stream.read_into(row) < self.tick_samples:
+                    # Ran dry: wait for a full prefill again rather than stutter
+                    stream.primed = False
+        total = rows.sum(axis=0)
+        mix = np.clip(total, SAMPLE_MIN, SAMPLE_MAX).astype(np.int16)
+        self.seq += 1
+        others = np.clip(total - rows, SAMPLE_MIN, SAMPLE_MAX).astype(np.int16)
+        return mix, {source: row for (source, _), row in zip(ready, others)}
+
+    def encode(self, samples, codec_id):
+        """
+        Encode one tick of int16 samples as a PCM or mu-law frame.
+        """
+        if codec_id == ULawCodec.codec_id:
+            samples = self._resample(samples, self.rate, ULawCodec.sample_rate)
+            samples = np.clip(samples, SAMPLE_MIN, SAMPLE_MAX).astype(np.int16)
+            return self._ulaw_encode[samples.view(np.uint16)].tobytes()
+        return samples.astype('<i2').tobytes()
@@ -0,0 +1,332 @@
+"""
+Voice playback engine for the client.
+
+Voice frames go from the network thread straight into a JitterBuffer,
+never through the Qt event queue. A dedicated playback thread pulls one
+frame per audio period, decodes it and writes it to the output stream;
+the blocking write paces the thread at the sound card's clock.
+
+The jitter buffer reorders frames by sequence number, drops frames that
+arrive after their playout time, conceals single lost frames, and adapts
+its target depth to the measured network jitter (RFC 3550 estimator).
+
+A talker whose client suppresses silence (see vad.py) sends a comfort
+noise descriptor instead of silent frames. Running dry after one is the
+expected pause, not an underrun, and the engine plays noise at the
+described level until voice resumes, so the line does not go dead.
+"""
+import math
+import threading
+import time
+from array import array
+
+from codec import CODEC_IDS, ComfortNoiseCodec, create_codec
+from protocol import SEQUENCE_MODULO
+
+# Adaptive depth bounds, in frames
+MIN_DEPTH = 2
+MAX_DEPTH = 15
+INITIAL_DEPTH = 3
+# Frames kept beyond the target before the oldest is discarded
+OVERFLOW_MARGIN = 10
+# A sequence jump larger than this starts a new stream (e.g. another talker)
+RESET_GAP = 100
+# A frame arriving within this long after the buffer ran dry counts as an underrun
+UNDERRUN_WINDOW = 0.5
+# Lost frames in a row that are concealed by repeating the last one, fading out
+MAX_CONCEALED = 3
+# Comfort noise stops this long after the last descriptor, e.g. once the
+# talker let go of the talk button; senders refresh it more often
+COMFORT_NOISE_HOLD = 1.5  # seconds
+
+# get() results
+FRAME = 'frame'
+LOST = 'lost'
+
+
+def _seq_diff(a, b):
+    """
+    Signed distance from sequence number b to a, allowing for wrap-around.
+    """
+    diff = (a - b) % SEQUENCE_MODULO
+    return diff - SEQUENCE_MODULO if diff >= SEQUENCE_MODULO // 2 else diff
+
+
+class JitterBuffer:
+    """
+    Thread-safe reordering buffer between the network and playback threads.
+    """
+
+    def __init__(self, min_depth=MIN_DEPTH, max_depth=MAX_DEPTH, initial_depth=INITIAL_DEPTH):
+        self.min_depth = min_depth
+        self.max_depth = max_depth
+        self.target_depth = initial_depth
+        self.jitter = 0.0  # seconds
+        self.frame_duration = 0.02  # seconds, updated from incoming frames
+        self.counters = {
+            'received': 0, 'played': 0, 'late': 0, 'duplicate': 0,
+            'overflow': 0, 'lost': 0, 'underruns': 0, 'resets': 0,
+        }
+        self._frames = {}  # seq -> (codec_id, audio)
+        self._next_seq = None
+        self._playing = False  # False while (re)filling up to the target depth
+        self._dry_since = None
+        self._silent = False  # the last frame played was a comfort noise descriptor
+        self._last_transit = None
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+
+    def __len__(self):
+        return len(self._frames)
+
+    def put(self, seq, timestamp, codec_id, audio, sample_rate, frame_size, arrival=None):
+        """
+        Add one received frame. `timestamp` may be None when the sender
+        provided none (text protocol), which disables the jitter estimate.
+        """
+        if arrival is None:
+            arrival = time.monotonic()
+        with self._lock:
+            self.counters['received'] += 1
+            self.frame_duration = frame_size / sample_rate
+            if timestamp is not None:
+                self._update_jitter(arrival, timestamp / sample_rate)
+
+            if self._next_seq is None:
+                self._next_seq = seq
+            diff = _seq_diff(seq, self._next_seq)
+            if abs(diff) > RESET_GAP:
+                self._reset(seq)
+                diff = 0
+            elif diff < 0:
+                if self._playing:
+                    self.counters['late'] += 1
+                    return
+                self._next_seq = seq  # still filling: an earlier frame moves the start back
+
+            if self._dry_since is not None:
+                if arrival - self._dry_since < UNDERRUN_WINDOW:
+                    self.counters['underruns'] += 1
+                self._dry_since = None
+
+            if seq in self._frames:
+                self.counters['duplicate'] += 1
+                return
+            self._frames[seq] = (codec_id, audio)
+
+            if len(self._frames) > self.target_depth + OVERFLOW_MARGIN:
+                # Playback fell behind: skip ahead to the oldest frame we still hold
+                oldest = min(self._frames, key=lambda s: _seq_diff(s, self._next_seq))
+                del self._frames[oldest]
+                self._next_seq = (oldest + 1) % SEQUENCE_MODULO
+                self.counters['overflow'] += 1
+            self._ready.notify()
+
+    def _update_jitter(self, arrival, media_time):
+        transit = arrival - media_time
+        if self._last_transit is not None:
+            delta = abs(transit - self._last_transit)
+            if delta < 1.0:  # ignore timestamp wraps and talker changes
+                self.jitter += (delta - self.jitter) / 16
+        self._last_transit = transit
+        depth = math.ceil(2 * self.jitter / self.frame_duration) + 1
+        self.target_depth = max(self.min_depth, min(self.max_depth, depth))
+
+    def _reset(self, seq):
+        self._frames.clear()
+        self._next_seq = seq
+        self._playing = False
+        self._last_transit = None
+        self.counters['resets'] += 1
+
+    def get(self, timeout=None):
+        """
+        Return the next frame to play as (FRAME, (codec_id, audio)), or
+        (LOST, None) if that frame is missing but later ones are here.
+        While the buffer is filling, waits up to `timeout` seconds and
+        returns None if playback should not start yet.
+        """
+        with self._lock:
+            if not self._playing:
+                if len(self._frames) < self.target_depth:
+                    self._ready.wait(timeout)
+                    if len(self._frames) < self.target_depth:
+                        return None
+                self._playing = True
+
+            frame = self._frames.pop(self._next_seq, None)
+            self._next_seq = (self._next_seq + 1) % SEQUENCE_MODULO
+            if frame is not None:
+                self.counters['played'] += 1
+                self._silent = frame[0] == ComfortNoiseCodec.codec_id
+                return FRAME, frame
+            if self._frames:
+                self.counters['lost'] += 1
+                return LOST, None
+            # Ran dry: refill before playing again
+            self._playing = False
+            if not self._silent:
+                # After a descriptor the talker is silent on purpose
+                self._dry_since = time.monotonic()
+            return None
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats.update(
+                depth=len(self._frames),
+                target_depth=self.target_depth,
+                jitter_ms=self.jitter * 1000,
+            )
+            return stats
+
+
+class PlaybackEngine:
+    """
+    Owns the jitter buffer, the decoders and the playback thread.
+    `open_stream(rate, frames_per_buffer)` returns an output stream with
+    blocking write(), stop_stream() and close() (a PyAudio stream).
+    """
+
+    def __init__(self, open_stream, jitter_buffer=None):
+        self.open_stream = open_stream
+        self.buffer = jitter_buffer if jitter_buffer is not None else JitterBuffer()
+        self.decoders = {}  # codec id -> decoder
+        self.stream = None
+        self.stream_rate = None
+        self.running = False
+        self.thread = None
+        self.concealed = 0  # lost frames replaced by a faded repeat
+        self.comfort_noise = 0  # frames of comfort noise played
+        self._comfort = ComfortNoiseCodec()
+        self._comfort_level = None  # level of the last descriptor while it holds
+        self._comfort_until = 0.0
+        self._voice_codec = None  # codec of the last voice frame, whose clock descriptors use
+        self._last_pcm = None
+        self._concealed_run = 0
+        self._text_seq = 0
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self._close_stream()
+
+    def push(self, codec_id, seq, timestamp, audio):
+        """
+        Queue one received frame. Called from the network thread.
+        """
+        codec = CODEC_IDS[codec_id]
+        if codec is ComfortNoiseCodec:
+            # Stamped with the talker's voice clock, not the descriptor's nominal one
+            if self._voice_codec is None:
+                timestamp = None
+            else:
+                codec = self._voice_codec
+        else:
+            self._voice_codec = codec
+        self.buffer.put(seq, timestamp, codec_id, bytes(audio), codec.sample_rate, codec.frame_size)
+
+    def push_unsequenced(self, codec_id, audio):
+        """
+        Queue a frame from the text protocol, which carries no sequence
+        numbers; arrival order is used instead.
+        """
+        seq = self._text_seq
+        self._text_seq = (seq + 1) % SEQUENCE_MODULO
+        codec = CODEC_IDS[codec_id]
+        self.buffer.put(seq, None, codec_id, audio, codec.sample_rate, codec.frame_size)
+
+    def stats(self):
+        stats = self.buffer.stats()
+        stats['concealed'] = self.concealed
+        stats['comfort_noise'] = self.comfort_noise
+        return stats
+
+    def _decoder(self, codec_id):
+        decoder = self.decoders.get(codec_id)
+        if decoder is None:
+            decoder = self.decoders[codec_id] = create_codec(codec_id)
+        return decoder
+
+    def _conceal(self):
+        """
+        Stand-in for a lost frame: the last frame played, fading out.
+        """
+        if self._last_pcm is None or self._concealed_run >= MAX_CONCEALED:
+            return None
+        self._concealed_run += 1
+        self.concealed += 1
+        samples = array('h')
+        samples.frombytes(self._last_pcm)
+        scale = 1 - self._concealed_run / (MAX_CONCEALED + 1)
+        return array('h', (int(s * scale) for s in samples)).tobytes()
+
+    def _noise(self, decoder):
+        """
+        One frame of comfort noise for the stream `decoder` plays at, or
+        None once the last descriptor stopped holding.
+        """
+        if self._comfort_level is None or time.monotonic() > self._comfort_until:
+            self._comfort_level = None
+            return None
+        self.comfort_noise += 1
+        return self._comfort.comfort_noise(self._comfort_level, decoder.frame_size)
+
+    def _close_stream(self):
+        if self.stream is not None:
+            self.stream.stop_stream()
+            self.stream.close()
+            self.stream = None
+            self.stream_rate = None
+
+    def _write(self, pcm, decoder):
+        if self.stream is not None and self.stream_rate != decoder.sample_rate:
+            # The talker uses a different codec; reopen at its sample rate
+            self._close_stream()
+        if self.stream is None:
+            self.stream = self.open_stream(decoder.sample_rate, decoder.frame_size)
+            self.stream_rate = decoder.sample_rate
+        self.stream.write(pcm)
+
+    def _run(self):
+        decoder = None
+        while self.running:
+            # While comfort noise plays, the blocking write paces the loop
+            result = self.buffer.get(timeout=0 if self._comfort_level is not None else 0.1)
+            try:
+                if result is None:
+                    pcm = self._noise(decoder or self._comfort)
+                    if pcm is not None:
+                        self._write(pcm, decoder or self._comfort)
+                    continue
+                kind, frame = result
+                if kind == FRAME:
+                    codec_id, audio = frame
+                    if codec_id == ComfortNoiseCodec.codec_id:
+                        self._comfort_level = self._comfort.decode(audio)
+                        self._comfort_until = time.monotonic() + COMFORT_NOISE_HOLD
+                        self._last_pcm = None  # nothing to conceal with after silence
+                        pcm = self._noise(decoder or self._comfort)
+                        self._write(pcm, decoder or self._comfort)
+                        continue
+                    self._comfort_level = None
+                    decoder = self._decoder(codec_id)
+                    pcm = decoder.decode(audio)
+                    self._last_pcm = pcm
+                    self._concealed_run = 0
+                else:
+                    pcm = self._conceal()
+                    if pcm is None or decoder is None:
+                        continue
+                self._write(pcm, decoder)
+            except Exception as e:
+                print(f"Error playing audio data: {e}")
@@ -0,0 +1,97 @@
+"""
+Client-side model of the users in the current room.
+
+The model is built from a PRESENCE:SNAPSHOT and then kept current by
+applying the JOIN, LEAVE and TALK deltas that follow it (see protocol.py),
+so a join or leave costs O(1) instead of a rebuild of the whole list.
+It holds no GUI state and is only touched from one thread.
+"""
+from protocol import ProtocolError, parse_presence
+
+# Kinds of change reported by PresenceModel.apply()
+SNAPSHOT = 'snapshot'
+JOIN = 'join'
+LEAVE = 'leave'
+START = 'start'
+STOP = 'stop'
+
+
+class PresenceModel:
+    """
+    Indexed set of nicknames with the current talker.
+    The same nickname can be connected more than once (on different
+    cluster nodes, for instance); it is listed until its last connection
+    leaves.
+    """
+
+    def __init__(self):
+        self.version = None  # None until a snapshot arrives
+        self.users = {}  # nickname -> connections using it, in join order
+        self.talker = None
+
+    def __contains__(self, nickname):
+        return nickname in self.users
+
+    def __iter__(self):
+        return iter(self.users)
+
+    def __len__(self):
+        return len(self.users)
+
+    def reset(self, users, talker=None, version=None):
+        """
+        Replace the whole model, e.g. from a snapshot or a legacy USERLIST.
+        """
+        self.users = {}
+        for nickname in users:
+            self.users[nickname] = self.users.get(nickname, 0) + 1
+        self.talker = talker
+        self.version = version
+
+    def apply(self, message):
+        """
+        Apply one PRESENCE message and return what changed, as a list of
+        (kind, nickname) pairs: SNAPSHOT (rebuild everything), JOIN and
+        LEAVE when a nickname appears or disappears, and STOP and START
+        when the talker changes.
+
+        Returns None when a delta does not follow the last version seen,
+        or a message cannot be parsed; the caller should then send
+        PRESENCE:SYNC. Deltas are ignored until the next snapshot arrives.
+        """
+        try:
+            kind, version, nickname, users = parse_presence(message)
+        except ProtocolError:
+            self.version = None
+            return None
+        if kind == 'SNAPSHOT':
+            self.reset(users, nickname, version)
+            return [(SNAPSHOT, None)]
+        if self.version is None:
+            return []  # waiting for a snapshot
+        if version != self.version + 1:
+            self.version = None
+            return None
+        self.version = version
+
+        if kind == 'JOIN':
+            count = self.users.get(nickname, 0)
+            self.users[nickname] = count + 1
+            return [] if count else [(JOIN, nickname)]
+        if kind == 'LEAVE':
+            count = self.users.get(nickname, 0)
+            if count > 1:
+                self.users[nickname] = count - 1
+                return []
+            if not count:
+                return []
+            del self.users[nickname]
+            return [(LEAVE, nickname)]
+        # TALK
+        changes = []
+        if self.talker is not None and self.talker != nickname:
+            changes.append((STOP, self.talker))
+        if nickname is not None and nickname != self.talker:
+            changes.append((START, nickname))
+        self.talker = nickname
+        return changes
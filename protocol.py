@@ -0,0 +1,357 @@
+"""
+Wire protocol shared by the server and the client.
+
+Version 1 is the original text protocol: the client sends its nickname on
+the first line, and every message after that is a newline-terminated UTF-8
+line (MSG:, STATUS:, VOICE:<base64>, USERLIST:, SERVER:).
+
+The binary protocol is negotiated by sending
+
+    HELLO:<version>:<codec>,<codec>,...:<nickname>
+
+as the first line instead, listing the voice codecs the client can decode
+(see codec.py). The server answers HELLO:<version>:<codec> with the codec
+the client should send with, and from then on both directions carry
+length-prefixed binary frames:
+
+    +--------+-----------------+------------------+
+    | type   | length          | payload          |
+    | 1 byte | 4 bytes, big-e. | `length` bytes   |
+    +--------+-----------------+------------------+
+
+TEXT frames carry one text protocol message as UTF-8 (without the newline).
+VOICE frames carry a 7-byte voice header followed by one encoded audio
+frame, with no base64 step:
+
+    +----------+-----------------+----------------------------+
+    | codec id | sequence number | timestamp                  |
+    | 1 byte   | 2 bytes, wraps  | 4 bytes, in samples, wraps |
+    +----------+-----------------+----------------------------+
+
+The sequence number and timestamp let the receiver's jitter buffer
+reorder frames and detect losses. A HELLO:1 answer means the server only
+speaks text.
+
+Versions 2 and 3 had shorter voice headers; clients asking for them are
+served the text protocol. Version 5 to 8 frames are the same as version
+4's; version 5 clients get presence deltas instead of USERLIST: messages,
+version 6 servers answer history requests, version 7 servers media
+channel requests and version 8 servers let a dropped client resume.
+
+Other clients get the whole USERLIST: again on every join and leave,
+unless they ask for deltas by sending PRESENCE:SYNC. A client getting
+deltas is first sent
+
+    PRESENCE:SNAPSHOT:<version>:<talker>:<user>,<user>,...
+
+and from then on one message per change in its room, each carrying the
+room's next version number:
+
+    PRESENCE:JOIN:<version>:<nickname>
+    PRESENCE:LEAVE:<version>:<nickname>
+    PRESENCE:TALK:<version>:<nickname, or empty when nobody talks>
+
+A client that sees a version out of sequence sends PRESENCE:SYNC for a
+new snapshot. A snapshot also follows registration and every room change.
+
+Chat messages are numbered per room when the server keeps history. A
+client asks for the backlog of its current room with HISTORY:LAST:<count>
+or HISTORY:SINCE:<id>, and gets, in one burst, every stored message sent
+before it entered the room
+
+    HISTORY:<id>:<unix time>:<message as originally sent, e.g. MSG:...>
+
+followed by HISTORY:END:<id of the first message it received live>.
+
+Version 7 servers started with a media port can carry voice over UDP, so a
+lost packet delays only its own frame instead of every frame and chat
+message queued behind it on the TCP stream. A binary client asks with
+MEDIA:UDP and is answered MEDIA:OFFER:<port>:<token in hex>, or
+MEDIA:NONE. It then sends datagrams to that port on the server's host:
+
+    +--------+---------+-------------------------------------------+
+    | type   | token   | payload                                   |
+    | 1 byte | 8 bytes | VOICE: a VOICE frame payload; PROBE: none |
+    +--------+---------+-------------------------------------------+
+
+The server answers every PROBE with a PROBE carrying the same token and
+remembers the address it came from. Once answered, the client sends
+MEDIA:ON over TCP, and from then on the server sends it voice as VOICE
+datagrams, which have no token, instead of frames. MEDIA:OFF switches
+back to TCP. Chat and STATUS: messages always stay on TCP.
+
+Version 8 servers may send SESSION:<token in hex> after registration. If
+the connection drops, the client can connect again and send
+
+    RESUME:<token>:<offset>
+
+as its first line instead of a HELLO, <offset> being the number of bytes
+it read from the server up to its last complete message, counted from the
+HELLO reply's first byte. The server answers RESUME:OK, in the text
+protocol, and the stream continues from that offset as if nothing had
+happened; or RESUME:EXPIRED, and closes the connection. A client leaving
+for good sends SESSION:CLOSE first, so the others see it leave at once
+instead of after the grace period. See session.py.
+"""
+import struct
+
+TEXT_PROTOCOL_VERSION = 1
+# First version with binary frames in their current form
+BINARY_PROTOCOL_VERSION = 4
+# First version that gets presence deltas from the start
+PRESENCE_PROTOCOL_VERSION = 5
+# First version whose server understands HISTORY: requests
+HISTORY_PROTOCOL_VERSION = 6
+# First version whose server understands MEDIA: requests
+MEDIA_PROTOCOL_VERSION = 7
+# First version whose server issues session tokens and accepts RESUME lines
+SESSION_PROTOCOL_VERSION = 8
+PROTOCOL_VERSION = 8
+
+HELLO_PREFIX = "HELLO:"
+PRESENCE_PREFIX = "PRESENCE:"
+PRESENCE_SYNC = "PRESENCE:SYNC"
+PRESENCE_KINDS = ('SNAPSHOT', 'JOIN', 'LEAVE', 'TALK')
+HISTORY_PREFIX = "HISTORY:"
+HISTORY_END = "HISTORY:END:"
+MEDIA_PREFIX = "MEDIA:"
+MEDIA_REQUEST = "MEDIA:UDP"
+MEDIA_OFFER = "MEDIA:OFFER:"
+MEDIA_NONE = "MEDIA:NONE"
+MEDIA_ON = "MEDIA:ON"
+MEDIA_OFF = "MEDIA:OFF"
+SESSION_PREFIX = "SESSION:"
+SESSION_CLOSE = "SESSION:CLOSE"
+RESUME_PREFIX = "RESUME:"
+RESUME_OK = "RESUME:OK"
+RESUME_EXPIRED = "RESUME:EXPIRED"
+
+FRAME_TEXT = 1
+FRAME_VOICE = 2
+FRAME_TYPES = (FRAME_TEXT, FRAME_VOICE)
+
+FRAME_HEADER = struct.Struct('!BI')
+# Prefix of every VOICE payload: codec id, sequence number, timestamp
+VOICE_HEADER = struct.Struct('!BHI')
+SEQUENCE_MODULO = 1 << 16
+TIMESTAMP_MODULO = 1 << 32
+# Largest payload accepted from the wire; protects against bogus lengths
+MAX_FRAME_SIZE = 1024 * 1024
+
+# Media channel datagram types
+DATAGRAM_PROBE = 1
+DATAGRAM_VOICE = 2
+MEDIA_TOKEN_SIZE = 8
+# Largest UDP payload over IPv4
+MAX_DATAGRAM_SIZE = 65507
+
+
+class ProtocolError(ValueError):
+    """
+    Raised when the peer sends data that does not follow the protocol.
+    """
+
+
+def hello_line(nickname, codecs, version=PROTOCOL_VERSION):
+    """
+    Build the client's first line requesting the binary protocol.
+    """
+    return f"{HELLO_PREFIX}{version}:{','.join(codecs)}:{nickname}\n".encode('utf-8')
+
+def parse_hello(line):
+    """
+    Parse the client's first line.
+    Returns (version, nickname, codecs); version is None for a bare nickname
+    from a text protocol client that did not negotiate.
+    """
+    if line.startswith(HELLO_PREFIX):
+        parts = line.split(':', 3)
+        if len(parts) == 4 and parts[1].isdigit():
+            codecs = [name for name in parts[2].split(',') if name]
+            return int(parts[1]), parts[3].strip(), codecs
+        if len(parts) == 3 and parts[1].isdigit():
+            return int(parts[1]), parts[2].strip(), []
+    return None, line.strip(), []
+
+def negotiate_version(requested):
+    """
+    Pick the protocol version to speak with a client that asked for `requested`.
+    """
+    if requested >= BINARY_PROTOCOL_VERSION:
+        return min(requested, PROTOCOL_VERSION)
+    return TEXT_PROTOCOL_VERSION
+
+def hello_reply(version, codec=None):
+    """
+    Build the server's answer to a HELLO line.
+    """
+    if codec is None:
+        return f"{HELLO_PREFIX}{version}\n".encode('utf-8')
+    return f"{HELLO_PREFIX}{version}:{codec}\n".encode('utf-8')
+
+def parse_hello_reply(line):
+    """
+    Parse the server's HELLO answer.
+    Returns (version, codec name or None), or None if `line` is not one.
+    """
+    if line.startswith(HELLO_PREFIX):
+        version, _, codec = line[len(HELLO_PREFIX):].strip().partition(':')
+        if version.isdigit():
+            return int(version), codec or None
+    return None
+
+def resume_line(token, offset):
+    """
+    Build a reconnecting client's first line, resuming its session.
+    """
+    return f"{RESUME_PREFIX}{token}:{offset}\n".encode('ascii')
+
+def parse_resume(line):
+    """
+    Parse a client's first line as a RESUME line.
+    Returns (token, offset), or None if `line` is not one.
+    """
+    if not line.startswith(RESUME_PREFIX):
+        return None
+    token, _, offset = line[len(RESUME_PREFIX):].strip().partition(':')
+    if not token or not offset.isdigit():
+        raise ProtocolError(f"malformed resume line {line!r}")
+    return token, int(offset)
+
+def resume_reply(resumed):
+    """
+    Build the server's answer to a RESUME line.
+    """
+    return f"{RESUME_OK if resumed else RESUME_EXPIRED}\n".encode('ascii')
+
+def presence_snapshot(version, talker, users):
+    return f"{PRESENCE_PREFIX}SNAPSHOT:{version}:{talker or ''}:{','.join(users)}"
+
+def presence_delta(kind, version, nickname):
+    return f"{PRESENCE_PREFIX}{kind}:{version}:{nickname or ''}"
+
+def parse_presence(message):
+    """
+    Parse a PRESENCE message from the server.
+    Returns (kind, version, nickname, users): users is the list of every
+    user for a SNAPSHOT, whose nickname is the talker, and None otherwise.
+    The nickname is None for an empty field.
+    """
+    parts = message.split(':', 3)
+    if len(parts) != 4 or parts[1] not in PRESENCE_KINDS or not parts[2].isdigit():
+        raise ProtocolError(f"malformed presence message {message!r}")
+    _, kind, version, rest = parts
+    users = None
+    if kind == 'SNAPSHOT':
+        rest, _, user_list = rest.partition(':')
+        users = [user for user in user_list.split(',') if user]
+    return kind, int(version), rest or None, users
+
+def history_message(msg_id, timestamp, message):
+    """
+    Build one backlog entry from a stored message (bytes), as UTF-8 bytes
+    without the newline.
+    """
+    return b"%s%d:%d:%s" % (HISTORY_PREFIX.encode('ascii'), msg_id, int(timestamp), message)
+
+def parse_history(message):
+    """
+    Parse a backlog entry. Returns (id, unix time, original message), or
+    None for the HISTORY:END marker.
+    """
+    if message.startswith(HISTORY_END):
+        return None
+    parts = message.split(':', 3)
+    if len(parts) != 4 or not parts[1].isdigit() or not parts[2].isdigit():
+        raise ProtocolError(f"malformed history message {message!r}")
+    return int(parts[1]), int(parts[2]), parts[3]
+
+def media_offer(port, token):
+    return f"{MEDIA_OFFER}{port}:{token.hex()}"
+
+def parse_media_offer(message):
+    """
+    Parse the server's answer to MEDIA:UDP. Returns (port, token), or
+    None for MEDIA:NONE.
+    """
+    if not message.startswith(MEDIA_OFFER):
+        return None
+    port, _, token = message[len(MEDIA_OFFER):].partition(':')
+    try:
+        token = bytes.fromhex(token)
+    except ValueError:
+        token = b""
+    if not port.isdigit() or len(token) != MEDIA_TOKEN_SIZE:
+        raise ProtocolError(f"malformed media offer {message!r}")
+    return int(port), token
+
+def media_datagram(kind, payload=b"", token=b""):
+    """
+    Build one media datagram; only those sent by clients carry a token.
+    """
+    return bytes([kind]) + token + payload
+
+def parse_media_datagram(data):
+    """
+    Split a datagram sent by a client into (type, token, payload).
+    """
+    if len(data) < 1 + MEDIA_TOKEN_SIZE:
+        raise ProtocolError("truncated media datagram")
+    return data[0], bytes(data[1:1 + MEDIA_TOKEN_SIZE]), data[1 + MEDIA_TOKEN_SIZE:]
+
+def encode_frame(frame_type, payload):
+    """
+    Serialize one binary frame.
+    """
+    return FRAME_HEADER.pack(frame_type, len(payload)) + payload
+
+def text_frame(message):
+    return encode_frame(FRAME_TEXT, message.encode('utf-8'))
+
+def voice_frame(codec_id, audio, seq=0, timestamp=0):
+    header = VOICE_HEADER.pack(codec_id, seq % SEQUENCE_MODULO, timestamp % TIMESTAMP_MODULO)
+    return FRAME_HEADER.pack(FRAME_VOICE, VOICE_HEADER.size + len(audio)) + header + audio
+
+def parse_voice(payload):
+    """
+    Split a VOICE payload into (codec id, sequence number, timestamp, encoded audio).
+    """
+    if len(payload) < VOICE_HEADER.size:
+        raise ProtocolError("truncated voice frame")
+    codec_id, seq, timestamp = VOICE_HEADER.unpack_from(payload)
+    return codec_id, seq, timestamp, payload[VOICE_HEADER.size:]
+
+
+class FrameDecoder:
+    """
+    Incremental decoder for binary frames.
+    Feed it whatever recv() returned; it returns complete (type, payload)
+    frames. Each payload is a memoryview into an immutable bytes object
+    holding the whole frame, header included (payload.obj), so a relay can
+    forward the frame without serializing it again.
+    """
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        self.buffer += data
+        frames = []
+        offset = 0
+        header_size = FRAME_HEADER.size
+        while len(self.buffer) - offset >= header_size:
+            frame_type, length = FRAME_HEADER.unpack_from(self.buffer, offset)
+            if frame_type not in FRAME_TYPES:
+                raise ProtocolError(f"unknown frame type {frame_type}")
+            if length > self.max_frame_size:
+                raise ProtocolError(f"frame of {length} bytes exceeds limit of {self.max_frame_size}")
+            end = offset + header_size + length
+            if len(self.buffer) < end:
+                break
+            frame = bytes(self.buffer[offset:end])
+            frames.append((frame_type, memoryview(frame)[header_size:]))
+            offset = end
+        if offset:
+            del self.buffer[:offset]
+        return frames
@@ -0,0 +1,166 @@
+"""
+Per-connection flood protection for the server.
+
+Every client gets a RateLimiter holding a token bucket for each kind of
+message it may send:
+
+    MSG       chat lines
+    VOICE     voice frames and VOICE: lines
+    DATAGRAM  voice over the media channel, which is read on a thread of
+              its own (see media.py) and so has a bucket of its own
+    CONTROL   STATUS, ROOM, HISTORY, MEDIA, PRESENCE and SESSION requests,
+              sharing one bucket
+
+A message is let through if its bucket holds a token and dropped if not;
+kinds not listed are always dropped. A bucket refills continuously at
+its rate up to its burst, so checking one is a dictionary lookup and a
+little arithmetic, with no timer and no lock: each bucket is only
+touched by one thread, the one reading the connection (or the event
+loop) or, for DATAGRAM, the media thread.
+
+Dropped messages drain an abuse bucket of their own. Once a client has
+had more dropped than that allows, it gets a strike: the reader stops
+reading from it for a backoff that doubles with every strike, so a
+flooding client is pushed back by TCP flow control instead of costing
+the server anything. A client still flooding after MAX_STRIKES strikes
+is disconnected. Strikes are forgotten after STRIKE_RESET seconds of
+good behaviour. This bookkeeping is shared by every kind, so it takes a
+lock; it only runs for messages that are dropped anyway.
+"""
+import threading
+import time
+
+# Messages per second and burst of each kind of message a client may send
+DEFAULT_LIMITS = {
+    'MSG': (10.0, 30),
+    'VOICE': (100.0, 200),  # 20 ms frames come 50 a second
+    'DATAGRAM': (100.0, 200),
+    'CONTROL': (10.0, 30),
+}
+# Message prefixes (the text before the first ':') counted as each kind
+KIND_PREFIXES = {
+    'MSG': ('MSG',),
+    'VOICE': ('VOICE',),
+    'DATAGRAM': ('DATAGRAM',),
+    'CONTROL': ('STATUS', 'ROOM', 'HISTORY', 'MEDIA', 'PRESENCE', 'SESSION'),
+}
+# Dropped messages a client may send per second, and in a burst, before a strike
+ABUSE_RATE = 5.0
+ABUSE_BURST = 50
+# Seconds the first strike stops reading from a client; doubled for each further strike
+INITIAL_BACKOFF = 0.5
+MAX_BACKOFF = 8.0
+# Strikes after which a client that still floods is disconnected
+MAX_STRIKES = 5
+# Seconds without a strike after which earlier strikes are forgotten
+STRIKE_RESET = 60.0
+
+
+class FloodError(ConnectionError):
+    """
+    Raised for a client that kept flooding after its last backoff.
+    """
+
+
+def parse_limit(value):
+    """
+    Parse a KIND=RATE[/BURST] command line argument into
+    (kind, (rate, burst)). The burst defaults to one second's worth.
+    """
+    kind, _, limit = value.partition('=')
+    kind = kind.upper()
+    if kind not in KIND_PREFIXES:
+        raise ValueError(f"unknown message kind {kind!r}; expected one of {', '.join(KIND_PREFIXES)}")
+    rate, _, burst = limit.partition('/')
+    rate = float(rate)
+    burst = int(burst) if burst else max(1, round(rate))
+    if rate <= 0 or burst < 1:
+        raise ValueError(f"bad limit {value!r}")
+    return kind, (rate, burst)
+
+
+class TokenBucket:
+    """
+    `rate` tokens a second, holding at most `burst`.
+    """
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.stamp = now
+
+    def take(self, now):
+        """
+        Take one token if there is one. Returns whether there was.
+        """
+        tokens = self.tokens + (now - self.stamp) * self.rate
+        if tokens > self.burst:
+            tokens = self.burst
+        self.stamp = now
+        if tokens >= 1.0:
+            self.tokens = tokens - 1.0
+            return True
+        self.tokens = tokens
+        return False
+
+
+class RateLimiter:
+    """
+    The buckets of one connection. Each kind must only be checked from
+    one thread, but different kinds may be checked from different threads.
+    """
+
+    def __init__(self, limits=DEFAULT_LIMITS):
+        now = time.monotonic()
+        self.buckets = {}  # message prefix -> TokenBucket, shared by the prefixes of a kind
+        for kind, (rate, burst) in limits.items():
+            bucket = TokenBucket(rate, burst, now)
+            for prefix in KIND_PREFIXES[kind]:
+                self.buckets[prefix] = bucket
+        self.dropped = 0  # messages over their limit, or of an unknown kind
+        self.unknown = 0  # messages of an unknown kind
+        self.strikes = 0
+        self.pause = 0.0  # seconds the reader should stop reading, set by a strike
+        self._abuse = TokenBucket(ABUSE_RATE, ABUSE_BURST, now)
+        self._last_strike = now
+        self._lock = threading.Lock()  # guards the counters, strikes and abuse bucket
+
+    @property
+    def exceeded(self):
+        return self.strikes > MAX_STRIKES
+
+    def allow(self, kind):
+        """
+        Count one message of a kind: the text before the first ':' of a
+        text protocol message. Returns False if it should be dropped.
+        """
+        bucket = self.buckets.get(kind)
+        now = time.monotonic()
+        if bucket is not None and bucket.take(now):
+            return True
+        with self._lock:
+            if bucket is None:
+                self.unknown += 1
+            self.dropped += 1
+            if not self._abuse.take(now) and not self.pause:
+                # One strike per backoff, however much of the flood was read at once
+                self._strike(now)
+        return False
+
+    def _strike(self, now):
+        if now - self._last_strike > STRIKE_RESET:
+            self.strikes = 0
+        self.strikes += 1
+        self._last_strike = now
+        self.pause = min(MAX_BACKOFF, INITIAL_BACKOFF * 2 ** (self.strikes - 1))
+
+    def take_pause(self):
+        """
+        The backoff a strike asked for, once.
+        """
+        with self._lock:
+            pause = self.pause
+            self.pause = 0.0
+        return pause
@@ -0,0 +1,165 @@
+"""
+Bounded per-client outbound queues.
+
+broadcast() only enqueues; a writer owned by each connection drains its
+queue onto the socket. A slow receiver therefore backs up its own queue
+instead of stalling delivery to everyone else.
+"""
+import threading
+from collections import deque
+
+# Soft limits: above these, droppable frames (voice) are discarded oldest first
+DEFAULT_MAX_BYTES = 256 * 1024
+DEFAULT_MAX_MESSAGES = 512
+# Hard limit: a client whose backlog of undroppable messages grows past this is disconnected
+DEFAULT_DISCONNECT_BYTES = 1024 * 1024
+
+# Message types that may be dropped under backpressure. Everything else is kept.
+DROPPABLE_PREFIXES = (b"VOICE:",)
+
+
+class QueueOverflow(ConnectionError):
+    """
+    Raised when a client's queue passes its disconnect threshold or was closed.
+    """
+
+
+def is_droppable(data):
+    """
+    Return True if a serialized message may be dropped when the queue is full.
+    """
+    return data.startswith(DROPPABLE_PREFIXES)
+
+
+class SendQueue:
+    """
+    Thread-safe FIFO of serialized messages with byte and message caps.
+
+    Droppable entries are also tracked in a side deque so the oldest one
+    can be discarded in O(1); discarded entries are blanked in place and
+    skipped by the reader.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, max_messages=DEFAULT_MAX_MESSAGES,
+                 disconnect_bytes=DEFAULT_DISCONNECT_BYTES, wakeup=None):
+        self.max_bytes = max_bytes
+        self.max_messages = max_messages
+        self.disconnect_bytes = max(disconnect_bytes, max_bytes)
+        self.wakeup = wakeup  # Optional callback run after each successful put
+        self.dropped = 0
+        self.closed = False
+        self._items = deque()      # entries are [data] lists; data is None once dropped
+        self._droppable = deque()  # the subset of entries that may be dropped
+        self._bytes = 0
+        self._count = 0
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def nbytes(self):
+        return self._bytes
+
+    def _over_soft_limit(self, extra):
+        return self._bytes + extra > self.max_bytes or self._count + 1 > self.max_messages
+
+    def _drop_oldest(self):
+        """
+        Discard the oldest droppable entry still queued. Caller holds the lock.
+        """
+        while self._droppable:
+            entry = self._droppable.popleft()
+            if entry[0] is not None:
+                self._bytes -= len(entry[0])
+                self._count -= 1
+                entry[0] = None
+                self.dropped += 1
+                return True
+        return False
+
+    def put(self, data, droppable=None):
+        """
+        Queue one serialized message.
+        Returns False if a droppable message was discarded instead of queued.
+        Raises QueueOverflow if the client should be disconnected.
+        """
+        if droppable is None:
+            droppable = is_droppable(data)
+        size = len(data)
+        with self._lock:
+            if self.closed:
+                raise QueueOverflow("send queue is closed")
+            # Make room by shedding voice, whatever kind of message is arriving
+            while self._over_soft_limit(size) and self._drop_oldest():
+                pass
+            if droppable and self._over_soft_limit(size):
+                self.dropped += 1
+                return False
+            if not droppable and self._bytes + size > self.disconnect_bytes:
+                self.closed = True
+                self._ready.notify_all()
+                raise QueueOverflow(f"send queue exceeded {self.disconnect_bytes} bytes")
+            entry = [data]
+            self._items.append(entry)
+            if droppable:
+                self._droppable.append(entry)
+            self._bytes += size
+            self._count += 1
+            self._ready.notify()
+        if self.wakeup is not None:
+            self.wakeup()
+        return True
+
+    def _take_all(self):
+        batch = []
+        while self._items:
+            data = self._items.popleft()[0]
+            if data is not None:
+                batch.append(data)
+        self._droppable.clear()
+        self._bytes = 0
+        self._count = 0
+        # Wake anyone pacing their puts in wait_empty()
+        self._ready.notify_all()
+        return batch
+
+    def pop_batch(self):
+        """
+        Remove and return every queued message without blocking.
+        """
+        with self._lock:
+            return self._take_all()
+
+    def get_batch(self):
+        """
+        Block until messages are queued and return all of them.
+        Returns None once the queue is closed and empty.
+        """
+        with self._lock:
+            while not self._count and not self.closed:
+                self._ready.wait()
+            if not self._count:
+                return None
+            return self._take_all()
+
+    def wait_empty(self):
+        """
+        Block until the reader has taken everything queued.
+        Returns False if the queue was closed instead.
+        """
+        with self._lock:
+            while self._count and not self.closed:
+                self._ready.wait()
+            return not self.closed
+
+    def close(self):
+        """
+        Stop accepting messages and wake any blocked reader.
+        """
+        with self._lock:
+            self.closed = True
+            self._ready.notify_all()
+        if self.wakeup is not None:
+            self.wakeup()
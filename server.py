@@ -1,146 +1,1693 @@
+import argparse
+import asyncio
+import base64
+import binascii
+import os
+import re
+import secrets
 import socket
 import threading
+import time
+from collections import Counter, deque
+from itertools import chain, islice
+
+from protocol import (
+    BINARY_PROTOCOL_VERSION, PRESENCE_PROTOCOL_VERSION, FRAME_HEADER, FRAME_TEXT, FRAME_VOICE, FRAME_TYPES, PRESENCE_SYNC, HISTORY_PREFIX, HISTORY_END, MEDIA_PREFIX,
+    MEDIA_REQUEST, MEDIA_NONE, MEDIA_ON, MEDIA_OFF, DATAGRAM_VOICE, MEDIA_TOKEN_SIZE, SESSION_PROTOCOL_VERSION,
+    SESSION_PREFIX, SESSION_CLOSE, ProtocolError,
+    parse_hello, negotiate_version, hello_reply, encode_frame, text_frame, voice_frame, parse_voice,
+    presence_snapshot, presence_delta, history_message, media_offer, media_datagram, parse_resume, resume_reply
+)
+from codec import CODEC_NAMES, ComfortNoiseCodec, PCMCodec, ULawCodec, choose_codec
+from framing import Receiver
+from cluster import SocketBus, format_bus_address
+from media import MediaRelay
+import workers
+from history import HistoryStore, DEFAULT_SEGMENT_BYTES, DEFAULT_MAX_AGE, DEFAULT_MAX_BYTES as DEFAULT_HISTORY_BYTES
+from session import RESUME_GRACE, REPLAY_BYTES, SESSION_TOKEN_SIZE, SentLog
+from ratelimit import DEFAULT_LIMITS, FloodError, RateLimiter, parse_limit
+from metrics import METRICS_HOST, Metrics, serve_metrics, message_type, label_value
+from sendqueue import (
+    SendQueue, DEFAULT_MAX_BYTES, DEFAULT_MAX_MESSAGES, DEFAULT_DISCONNECT_BYTES
+)
 
 HOST = '0.0.0.0'  # Server's public IP address
 PORT = 5050            # Updated port number
 
-# Dictionary to store client sockets and their nicknames
+# Server engine used when none is given on the command line
+DEFAULT_ENGINE = 'threaded'
+ENGINES = ('threaded', 'asyncio')
+
+# Limits for each client's outbound queue (see sendqueue.py)
+queue_limits = {
+    'max_bytes': DEFAULT_MAX_BYTES,
+    'max_messages': DEFAULT_MAX_MESSAGES,
+    'disconnect_bytes': DEFAULT_DISCONNECT_BYTES,
+}
+
+# Per-connection message rate limits (see ratelimit.py); None turns them off
+rate_limits = dict(DEFAULT_LIMITS)
+
+# Longest line or frame payload accepted from a client. Larger frames are
+# refused as soon as their header is parsed, before any payload is read
+DEFAULT_MAX_MESSAGE_SIZE = 64 * 1024
+max_message_size = DEFAULT_MAX_MESSAGE_SIZE
+
+# Voice codecs clients may be told to send with (see codec.py); the server
+# relays every codec without decoding it
+allowed_codecs = list(CODEC_NAMES)
+
+# Most buffers handed to one sendmsg() call (the usual IOV_MAX)
+MAX_IOV = 1024
+
+# Room every client starts in; it is never deleted
+DEFAULT_ROOM = 'lobby'
+ROOM_NAME = re.compile(r'^[A-Za-z0-9_-]{1,32}$')
+
+# Dictionary to store client connections and their nicknames
 clients = {}
+# Clients that may resume after their connection drops, by session token;
+# guarded by clients_lock (see session.py)
+sessions = {}
+# Seconds a dropped client's session is kept; 0 turns resumption off
+session_grace = RESUME_GRACE
+# Rooms by name; clients_lock also guards room membership
+rooms = {}
 clients_lock = threading.Lock()
 
-# Variable to track the current talker
-talking_user = None
+# Guards the talking_user of every room
 talking_lock = threading.Lock()
 
-def broadcast(message, exclude_client=None):
+# Chat history on disk (see history.py), when enabled with --history-dir
+history_store = None
+
+# Instrumentation (see metrics.py), when enabled with --metrics-port
+metrics = None
+
+# Rooms where several users may talk at once and the server mixes their
+# voice instead of relaying it (see mixer.py), set with --mix-rooms; '*'
+# mixes every room
+mixed_rooms = frozenset()
+
+# UDP socket carrying voice for clients that asked for it (see media.py),
+# when enabled with --media-port
+media_relay = None
+
+# Connection to the other nodes when running clustered (see cluster.py).
+# The bus hub then owns every talk floor and talking_user mirrors it.
+cluster_bus = None
+
+
+class Room:
     """
-    Send a message to all connected clients except the excluded one.
-    Each message is terminated with a newline character.
+    A named channel with its own members, talk floor and user list.
+    Broadcasts only ever touch the members of one room.
     """
-    with clients_lock:
-        for client in clients:
-            if client != exclude_client:
+
+    def __init__(self, name):
+        self.name = name
+        self.members = {}  # connection -> nickname
+        self.remote_members = {}  # cluster node -> its users in this room
+        # Immutable snapshot of the members, replaced on every join or leave
+        # so broadcasts can iterate it without taking clients_lock
+        self.recipients = ()
+        self.talking_user = None
+        self.mixer = None  # a Mixer in rooms where everyone may talk at once
+        # Bumped on every change to the users or the talker; see _presence_changed()
+        self.version = 0
+
+    def add(self, client, nickname):
+        self.members[client] = nickname
+        self.recipients = tuple(self.members)
+
+    def remove(self, client):
+        self.members.pop(client, None)
+        self.recipients = tuple(self.members)
+
+    def is_empty(self):
+        return not self.members and not self.remote_members
+
+
+class Outgoing:
+    """
+    A message on its way to one or more clients.
+    It is serialized lazily and at most once per wire format, and the
+    resulting bytes are shared by every recipient's queue, so the cost of
+    encoding does not grow with the number of listeners.
+    """
+    __slots__ = ('text', 'audio', 'codec', 'seq', 'timestamp', 'droppable', '_line', '_frame', '_datagram')
+
+    def __init__(self, text=None, audio=None, codec=None, seq=0, timestamp=0, voice_line=None, frame=None):
+        self.text = text
+        self.audio = audio  # encoded voice, without the voice header
+        self.codec = codec  # codec id of voice messages, None for text
+        self.seq = seq  # voice sequence number and timestamp, for frames built here
+        self.timestamp = timestamp
+        self.droppable = text is None  # voice may be shed under backpressure
+        self._line = voice_line
+        self._frame = frame  # a frame received from a binary client is forwarded as is
+        self._datagram = None
+
+    def line(self):
+        """
+        Serialized form for text protocol clients, or None for voice they
+        cannot play (anything but PCM).
+        """
+        if self._line is None:
+            if self.text is not None:
+                self._line = (self.text + '\n').encode('utf-8')
+            elif self.codec == PCMCodec.codec_id:
+                self._line = b"VOICE:" + base64.b64encode(self.audio) + b"\n"
+        return self._line
+
+    def frame(self):
+        """
+        Serialized form for binary protocol clients, or None if a text
+        client's voice line could not be decoded.
+        """
+        if self._frame is None:
+            if self.text is not None:
+                self._frame = text_frame(self.text)
+            else:
+                if self.audio is None:
+                    try:
+                        self.audio = base64.b64decode(self._line[len(b"VOICE:"):].strip())
+                    except binascii.Error:
+                        return None
+                self._frame = voice_frame(self.codec, self.audio, self.seq, self.timestamp)
+        return self._frame
+
+    def datagram(self):
+        """
+        Voice as a media channel datagram, or None like frame().
+        """
+        if self._datagram is None:
+            frame = self.frame()
+            if frame is not None:
+                self._datagram = media_datagram(DATAGRAM_VOICE, memoryview(frame)[FRAME_HEADER.size:])
+        return self._datagram
+
+
+class Connection:
+    """
+    A connected client, independent of the engine serving it.
+    send() only enqueues onto the client's bounded queue; a writer owned by
+    the engine drains it, so a slow client never blocks the sender.
+    """
+    binary = False  # True once the client negotiated the binary protocol
+    codecs = frozenset([PCMCodec.codec_id])  # codec ids this client can play
+    voice_seq = 0  # frames received as VOICE: lines, numbered for binary listeners
+    room = None  # the Room the client is in once registered
+    presence = False  # True once the client asked for PRESENCE deltas instead of USERLIST
+    history_end = 0  # id of the first chat message the client got live in its room
+    media_token = None  # identifies the client's datagrams once it asked for the media channel
+    media_address = None  # where its voice goes as datagrams instead of frames, once it switched
+    sent_log = None  # what was written, kept for replay once the client can resume (see session.py)
+    session = None  # token of the session the client may resume, once issued
+    suspended = False  # True while a client with a session has no connection
+    resumes = 0  # times the client resumed, so a stale expiry can tell; changed under clients_lock
+
+    def __init__(self, address):
+        self.address = address
+        self.limiter = RateLimiter(rate_limits) if rate_limits is not None else None
+        # Traffic counters, kept only while metrics are enabled; out is what was written
+        self.messages_in = 0
+        self.bytes_in = 0
+        self.messages_out = 0
+        self.bytes_out = 0
+
+    def send(self, data, droppable=None):
+        """
+        Queue serialized data for this client.
+        Raises QueueOverflow if the client fell too far behind.
+        """
+        self.queue.put(data, droppable)
+
+    def deliver(self, out):
+        """
+        Queue an Outgoing message in this client's wire format and return
+        the number of bytes queued. Voice in a codec the client did not
+        offer is skipped, and voice for a client on the media channel is
+        sent as a datagram instead.
+        """
+        if out.codec is not None and out.codec not in self.codecs:
+            return 0
+        if out.droppable and self.suspended:
+            return 0  # voice would be stale by the time the client resumes
+        address = self.media_address
+        if out.codec is not None and address is not None:
+            data = out.datagram()
+            if data is None:
+                return 0
+            media_relay.send(data, address)
+            if metrics is not None:
+                self.messages_out += 1
+                self.bytes_out += len(data)
+            return len(data)
+        data = out.frame() if self.binary else out.line()
+        if data is None:
+            return 0
+        self.send(data, out.droppable)
+        return len(data)
+
+    def send_text(self, message):
+        out = Outgoing(text=message)
+        size = self.deliver(out)
+        if metrics is not None:
+            metrics.sent(outgoing_type(out), size)
+
+    def serialize_text(self, message):
+        out = Outgoing(text=message)
+        return out.frame() if self.binary else out.line()
+
+    def replay(self, chunks):
+        """
+        Send a backlog, an iterable of serialized chunks that may read from
+        disk, without holding up live traffic to this or other clients.
+        """
+        raise NotImplementedError
+
+    def detach(self, connection):
+        """
+        Stop writing to `connection` (the engine's socket or stream writer)
+        after it dropped, keeping everything queued for a resume. Returns
+        False if the client already moved on to another connection.
+        Caller holds clients_lock.
+        """
+        raise NotImplementedError
+
+    def attach(self, connection, offset):
+        """
+        Switch the client over to a new connection, replacing any other.
+        Returns what was written from stream `offset` on, to be replayed
+        with resume(), or None if the sent log does not reach back that far.
+        Caller holds clients_lock, so this must not block.
+        """
+        raise NotImplementedError
+
+    def resume(self, connection, replay):
+        """
+        Answer RESUME:OK on the connection attached, replay what the client
+        missed, and carry on with the queue.
+        """
+        raise NotImplementedError
+
+    def call_later(self, delay, callback, *args):
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+
+class ThreadedConnection(Connection):
+    """
+    Client served by a reader thread and a writer thread over a blocking socket.
+    """
+
+    def __init__(self, client_socket, address):
+        super().__init__(address)
+        self.socket = client_socket  # None while suspended
+        self.queue = SendQueue(**queue_limits)
+        # Guards socket and sent_log; the writer waits on it while suspended or resuming
+        self.socket_ready = threading.Condition()
+        self._resuming = False
+        self.writer_thread = threading.Thread(target=self._write_loop, daemon=True)
+        self.writer_thread.start()
+
+    def _write_loop(self):
+        """
+        Drain the send queue onto the socket, one gathered write per batch.
+        While the client is suspended, batches wait for it to resume.
+        """
+        try:
+            while True:
+                batch = self.queue.get_batch()
+                if batch is None:
+                    break
+                with self.socket_ready:
+                    while (self.socket is None or self._resuming) and not self.queue.closed:
+                        self.socket_ready.wait()
+                    sock = self.socket
+                    if sock is None or self.queue.closed:
+                        break
+                    if self.sent_log is not None:
+                        self.sent_log.extend(batch)
                 try:
-                    client.sendall((message + '\n').encode('utf-8'))
-                except:
-                    # If sending fails, remove the client
-                    remove_client(client)
+                    send_buffers(sock, batch)
+                except OSError:
+                    if self.session is None:
+                        raise
+                    # The reader sees the drop and suspends the client; the
+                    # batch is in the sent log, to be replayed when it resumes
+                    _shutdown(sock)
+                    continue
+                if metrics is not None:
+                    count_sent(self, batch)
+        except OSError:
+            pass
+        finally:
+            self.close()
+
+    def detach(self, connection):
+        with self.socket_ready:
+            if self.socket is not connection:
+                return False
+            self.socket = None
+            self.suspended = True
+        _shutdown(connection)
+        return True
+
+    def attach(self, connection, offset):
+        with self.socket_ready:
+            replay = self.sent_log.since(offset)
+            if replay is None:
+                return None
+            old = self.socket
+            self.socket = connection
+            self.suspended = False
+            # Nothing else is written until the replay is
+            self._resuming = True
+        if old is not None:
+            # The client came back before its old connection was seen to drop
+            _shutdown(old)
+        return replay
+
+    def resume(self, connection, replay):
+        try:
+            send_buffers(connection, [resume_reply(True)] + replay)
+            if metrics is not None:
+                count_sent(self, replay)
+        finally:
+            with self.socket_ready:
+                self._resuming = False
+                self.socket_ready.notify_all()
+
+    def call_later(self, delay, callback, *args):
+        timer = threading.Timer(delay, callback, args)
+        timer.daemon = True
+        timer.start()
+
+    def replay(self, chunks):
+        """
+        Runs on the client's reader thread. Each chunk is queued only once
+        the writer has taken the previous one, so a backlog never fills the
+        queue and crowds out live messages.
+        """
+        for chunk in chunks:
+            if not self.queue.wait_empty():
+                break
+            self.send(chunk)
+
+    def close(self):
+        self.queue.close()
+        with self.socket_ready:
+            self.socket_ready.notify_all()
+            sock = self.socket
+        if sock is not None:
+            _shutdown(sock)
+
+
+class AsyncConnection(Connection):
+    """
+    Client served by coroutines on the asyncio event loop.
+    While the transport keeps up, data is written straight through. Once its
+    buffer passes the high-water mark, messages go to the send queue and a
+    writer task feeds them in as the transport drains, so only this client's
+    queue grows while it is slow.
+    """
+
+    def __init__(self, writer, address):
+        super().__init__(address)
+        self.writer = writer  # the last one, closed while suspended
+        self._high_water = writer.transport.get_write_buffer_limits()[1]
+        self._ready = asyncio.Event()
+        self.queue = SendQueue(**queue_limits, wakeup=self._ready.set)
+        self.writer_task = asyncio.ensure_future(self._write_loop())
+
+    def send(self, data, droppable=None):
+        transport = self.writer.transport
+        if not len(self.queue) and transport.get_write_buffer_size() < self._high_water:
+            if self.queue.closed:
+                raise ConnectionError("connection is closing")
+            if not transport.is_closing():
+                if self.sent_log is not None:
+                    self.sent_log.append(data)
+                self.writer.write(data)
+                if metrics is not None:
+                    self.messages_out += 1
+                    self.bytes_out += len(data)
+                return
+            if self.session is None:
+                raise ConnectionError("connection is closing")
+            # Dropped, but it may resume: queue until it does
+        self.queue.put(data, droppable)
+
+    async def _write_loop(self):
+        """
+        Drain the send queue into the transport, one batch per wakeup.
+        While the client is suspended, the queue fills until it resumes.
+        """
+        try:
+            while True:
+                await self._ready.wait()
+                self._ready.clear()
+                writer = self.writer
+                if self.session is None or not writer.transport.is_closing():
+                    batch = self.queue.pop_batch()
+                    if batch:
+                        if self.sent_log is not None:
+                            self.sent_log.extend(batch)
+                        writer.writelines(batch)
+                        if metrics is not None:
+                            count_sent(self, batch)
+                        try:
+                            await writer.drain()
+                        except (ConnectionError, OSError):
+                            if self.session is None:
+                                raise
+                            # The reader sees the drop and suspends the client
+                            writer.close()
+                if self.queue.closed:
+                    break
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.close()
+
+    def detach(self, connection):
+        if self.writer is not connection:
+            return False
+        self.suspended = True
+        connection.close()
+        return True
+
+    def attach(self, connection, offset):
+        replay = self.sent_log.since(offset)
+        if replay is None:
+            return None
+        old = self.writer
+        self.writer = connection
+        self.suspended = False
+        # The client came back before its old connection was seen to drop
+        old.close()
+        return replay
+
+    def resume(self, connection, replay):
+        # On the event loop, so nothing is written in between
+        connection.write(resume_reply(True))
+        connection.writelines(replay)
+        if metrics is not None:
+            count_sent(self, replay)
+        self._ready.set()
+
+    def call_later(self, delay, callback, *args):
+        asyncio.get_running_loop().call_later(delay, callback, *args)
+
+    def replay(self, chunks):
+        asyncio.ensure_future(self._replay(iter(chunks)))
+
+    async def _replay(self, chunks):
+        """
+        Read each chunk in the default executor, off the event loop, and
+        wait for the transport to drain before reading the next.
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                chunk = await loop.run_in_executor(None, next, chunks, None)
+                if chunk is None:
+                    break
+                self.send(chunk)
+                await self.writer.drain()
+        except (ConnectionError, OSError):
+            pass
+
+    def close(self):
+        self.queue.close()
+        self.writer.close()
+
+
+def _shutdown(sock):
+    try:
+        # Wakes the reader thread blocked in recv()
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+def send_buffers(sock, buffers):
+    """
+    Write a list of buffers to a blocking socket using scatter-gather
+    sendmsg() calls, so queued frames are batched into one syscall without
+    first being copied into a single bytes object.
+    """
+    if not hasattr(sock, 'sendmsg'):
+        # Windows has no sendmsg()
+        sock.sendall(b''.join(buffers))
+        return
+    views = deque(memoryview(buf) for buf in buffers)
+    while views:
+        sent = sock.sendmsg(list(islice(views, MAX_IOV)))
+        # Drop what was fully written and trim a partially written buffer
+        while sent:
+            head = views[0]
+            if sent >= len(head):
+                sent -= len(head)
+                views.popleft()
+            else:
+                views[0] = head[sent:]
+                sent = 0
+
+def outgoing_type(out):
+    return 'VOICE' if out.text is None else message_type(out.text)
+
+def count_received(client, kind, size):
+    """
+    Count one message read from a client. Only called while metrics are enabled.
+    """
+    metrics.received(kind, size)
+    client.messages_in += 1
+    client.bytes_in += size
+
+def count_sent(client, batch):
+    """
+    Count a batch written to a client, on its writer rather than on the
+    broadcasting thread. Only called while metrics are enabled.
+    """
+    client.messages_out += len(batch)
+    client.bytes_out += sum(map(len, batch))
+
+def broadcast(room, message, exclude_client=None, recipients=None):
+    """
+    Send a message to all members of a room except the excluded one.
+    `message` is either a text protocol string or an Outgoing; either way
+    it is serialized once and the same bytes are queued for every member.
+    `recipients` overrides the room's current members (see record_chat()).
+    """
+    out = message if isinstance(message, Outgoing) else Outgoing(text=message)
+    start = time.perf_counter() if metrics is not None else 0.0
+    if recipients is None:
+        recipients = room.recipients
+    failed = []
+    sent = 0
+    for client in recipients:
+        if client is exclude_client:
+            continue
+        try:
+            sent += client.deliver(out)
+        except Exception:
+            failed.append(client)
+    if metrics is not None:
+        metrics.broadcast_done(outgoing_type(out), sent, len(recipients), time.perf_counter() - start)
+    # Remove failed clients only after the loop, outside clients_lock
+    for client in failed:
+        remove_client(client)
+
+def publish(room, message, exclude_client=None, recipients=None):
+    """
+    Broadcast to a room on this node and, when clustered, relay the message
+    to the same room on every other node.
+    """
+    out = message if isinstance(message, Outgoing) else Outgoing(text=message)
+    broadcast(room, out, exclude_client, recipients)
+    bus = cluster_bus
+    if bus is None:
+        return
+    if out.text is not None:
+        bus.publish({'type': 'text', 'room': room.name, 'text': out.text})
+    else:
+        frame = out.frame()
+        if frame is not None:
+            bus.publish({'type': 'voice', 'room': room.name, 'body': frame})
+
+def _announce_member(room, change, nickname, notice=None):
+    """
+    Tell the other cluster nodes a user entered (JOIN) or left (LEAVE) a
+    room on this node, with the SERVER: notice their members get first.
+    Caller holds clients_lock, so changes reach the bus in order.
+    """
+    bus = cluster_bus
+    if bus is not None:
+        event = {'type': 'member', 'room': room.name, 'user': nickname, 'change': change}
+        if notice is not None:
+            event['notice'] = notice
+        bus.publish(event)
+
+def _notify_room(room, notice, exclude_client=None):
+    """
+    Queue a SERVER: notice for a room's members. Caller holds clients_lock.
+    """
+    out = Outgoing(text=notice)
+    for client in room.recipients:
+        if client is not exclude_client:
+            _deliver_or_close(client, out)
+
+def record_chat(room, message):
+    """
+    Append a chat message to the room's history, if kept, and return the
+    members that should get it live: exactly those who entered the room
+    before it was stored, so a client's backlog and its live messages
+    neither overlap nor leave a gap. Only its id is taken under
+    clients_lock; the history's writer thread puts it on disk.
+    """
+    history = open_history(room.name)
+    if history is None:
+        return room.recipients
+    with clients_lock:
+        history.stage(message.encode('utf-8'))
+        return room.recipients
+
+def open_history(name):
+    """
+    The history of a room, or None if none is kept or it cannot be
+    opened. Not to be called under clients_lock: the first call for a
+    room reads its segments from disk.
+    """
+    if history_store is None:
+        return None
+    try:
+        return history_store.room(name)
+    except OSError as e:
+        print(f"Failed to open the history of room {name}: {e}")
+        return None
+
+def _history_line(msg_id, timestamp, message):
+    return history_message(msg_id, timestamp, message) + b"\n"
+
+def _history_frame(msg_id, timestamp, message):
+    return encode_frame(FRAME_TEXT, history_message(msg_id, timestamp, message))
+
+def handle_history_request(client, room, message):
+    """
+    Answer HISTORY:LAST:<count> or HISTORY:SINCE:<id> with the room's
+    stored messages from before the client entered it, in batched chunks,
+    then HISTORY:END. Unknown requests get an empty backlog.
+    """
+    parts = message.split(':')
+    end = client.history_end
+    chunks = ()
+    history = open_history(room.name)
+    if history is not None and len(parts) == 3 and parts[2].isdigit():
+        if parts[1] == "LAST":
+            start = end - int(parts[2])
+        elif parts[1] == "SINCE":
+            start = int(parts[2]) + 1
+        else:
+            start = end
+        encode = _history_frame if client.binary else _history_line
+        chunks = history.replay(start, end, encode)
+    client.replay(chain(chunks, [client.serialize_text(f"{HISTORY_END}{end}")]))
+
+def valid_room_name(name):
+    return bool(ROOM_NAME.match(name))
+
+def room_users(room):
+    """
+    Nicknames in a room, including users on other cluster nodes.
+    Caller holds clients_lock.
+    """
+    users = list(room.members.values())
+    for node in sorted(room.remote_members):
+        users.extend(room.remote_members[node])
+    return users
+
+def _deliver_or_close(client, out):
+    try:
+        size = client.deliver(out)
+        if metrics is not None:
+            metrics.sent(outgoing_type(out), size)
+    except Exception:
+        # The client's reader sees the closed connection and removes it
+        client.close()
+
+def _presence_changed(room, kind, nickname, legacy=None, exclude_client=None):
+    """
+    Record a change to a room's users (JOIN, LEAVE) or talker (TALK) and
+    queue it for the members: a versioned PRESENCE delta for clients that
+    asked for them, `legacy` (by default the whole USERLIST) for the rest.
+    Caller holds clients_lock, so every member gets changes in version order.
+    """
+    room.version += 1
+    delta = Outgoing(text=presence_delta(kind, room.version, nickname))
+    for client in room.recipients:
+        if client is exclude_client:
+            continue
+        if client.presence:
+            _deliver_or_close(client, delta)
+        else:
+            if legacy is None:
+                legacy = Outgoing(text=f"USERLIST:{','.join(room_users(room))}")
+            _deliver_or_close(client, legacy)
+
+def send_presence(client, room):
+    """
+    Send a client the full state of its room: a snapshot if it takes
+    PRESENCE deltas, else USERLIST and the current talker.
+    Caller holds clients_lock.
+    """
+    with talking_lock:
+        talker = room.talking_user
+    if client.presence:
+        _deliver_or_close(client, Outgoing(text=presence_snapshot(room.version, talker, room_users(room))))
+        return
+    _deliver_or_close(client, Outgoing(text=f"USERLIST:{','.join(room_users(room))}"))
+    if talker is not None:
+        _deliver_or_close(client, Outgoing(text=f"STATUS:START:{talker}"))
+
+def announce_talker(room, legacy_message):
+    """
+    Tell a room its talker changed: `legacy_message` (STATUS:START or
+    STATUS:STOP) for USERLIST clients, a TALK delta for the others.
+    """
+    with clients_lock:
+        with talking_lock:
+            talker = room.talking_user
+        _presence_changed(room, 'TALK', talker, legacy=Outgoing(text=legacy_message))
+
+def new_room(name):
+    """
+    Create a room, mixed if configured so. Caller holds clients_lock.
+    """
+    room = rooms[name] = Room(name)
+    if name in mixed_rooms or '*' in mixed_rooms:
+        from mixer import Mixer
+        room.mixer = Mixer()
+    return room
+
+def _enter_room(client, nickname, name, history, notice=None):
+    """
+    Put a client into the named room, creating it if needed, tell the
+    members (`notice` first, if given, as text clients always got it) and
+    send the client the room's state. `history` is the room's (see
+    open_history()). Caller holds clients_lock.
+    """
+    room = rooms.get(name)
+    if room is None:
+        room = new_room(name)
+    room.add(client, nickname)
+    client.room = room
+    _announce_member(room, 'JOIN', nickname, notice)
+    client.history_end = history.next_id if history is not None else 0
+    if notice is not None:
+        _notify_room(room, notice, exclude_client=client)
+    _presence_changed(room, 'JOIN', nickname, exclude_client=client)
+    send_presence(client, room)
+    return room
+
+def _leave_room(client, notice=None):
+    """
+    Take a client out of its room and tell the members (`notice` first,
+    if given), deleting the room once empty (except the default room).
+    Caller holds clients_lock. Returns the room left.
+    """
+    room = client.room
+    if room is not None:
+        nickname = room.members.get(client)
+        room.remove(client)
+        _announce_member(room, 'LEAVE', nickname, notice)
+        if room.mixer is not None:
+            room.mixer.remove(client)
+        if notice is not None:
+            _notify_room(room, notice)
+        _presence_changed(room, 'LEAVE', nickname)
+        if room.is_empty() and room.name != DEFAULT_ROOM:
+            del rooms[room.name]
+        client.room = None
+    return room
+
+def add_client(client, nickname, room_name=DEFAULT_ROOM, announce=False):
+    """
+    Add a client to the clients dictionary and to a room, with a
+    "has joined" notice to the room if `announce`.
+    """
+    history = open_history(room_name)
+    with clients_lock:
+        clients[client] = nickname
+        notice = f"SERVER: {nickname} has joined the chatroom." if announce else None
+        return _enter_room(client, nickname, room_name, history, notice)
+
+def discard_client(client, announce=False):
+    """
+    Remove a client from the clients dictionary and from its room, with
+    a "has left" notice to the room if `announce`.
+    Returns (nickname, room), or (None, None) if it was not registered.
+    """
+    with clients_lock:
+        nickname = clients.pop(client, None)
+        if nickname is None:
+            return None, None
+        if client.session is not None:
+            sessions.pop(client.session, None)
+        notice = f"SERVER: {nickname} has left the chatroom." if announce else None
+        return nickname, _leave_room(client, notice)
+
+def register_client(client, nickname):
+    """
+    Add a client to the clients dictionary and notify others.
+    """
+    add_client(client, nickname, announce=True)
+    print(f"{nickname} connected from {client.address}.")
 
 def remove_client(client):
     """
     Remove a client from the clients dictionary and notify others.
     """
-    global talking_user
+    nickname, room = discard_client(client, announce=True)
+    if nickname is None:
+        return
+    if media_relay is not None:
+        media_relay.forget(client)
+    client.close()
+    print(f"{nickname} has disconnected.")
+    release_floor(room, nickname)
+
+def open_session(client):
+    """
+    Issue a session token to a newly registered client that can resume.
+    """
+    if client.sent_log is None:
+        return
+    token = secrets.token_hex(SESSION_TOKEN_SIZE)
+    with clients_lock:
+        if client not in clients:
+            return
+        sessions[token] = client
+        client.session = token
+    client.send_text(f"{SESSION_PREFIX}{token}")
+
+def close_session(client):
+    """
+    Handle SESSION:CLOSE: the client is leaving for good, so its
+    connection closing removes it at once.
+    """
+    with clients_lock:
+        if client.session is not None:
+            sessions.pop(client.session, None)
+            client.session = None
+
+def suspend_client(client, connection):
+    """
+    Keep a client whose connection dropped registered, in its room and
+    holding any talk floor, for session_grace seconds, so that it can
+    resume without anyone seeing it leave. Returns False if it cannot
+    resume and should be removed.
+    """
+    with clients_lock:
+        nickname = clients.get(client)
+        if client.session is None or nickname is None or client.queue.closed:
+            return False
+        if not client.detach(connection):
+            return True  # it already resumed on another connection
+        resumes = client.resumes
+    print(f"{nickname} dropped; keeping the session for {session_grace:g} s.")
+    client.call_later(session_grace, expire_session, client, resumes)
+    return True
+
+def expire_session(client, resumes):
+    """
+    Remove a suspended client that did not resume in time.
+    """
+    with clients_lock:
+        if client.resumes != resumes or not client.suspended:
+            return
+        # It can no longer resume from here on
+        sessions.pop(client.session, None)
+    remove_client(client)
+
+def resume_session(token, offset, connection, address):
+    """
+    Move a suspended client, or one whose old connection has not been
+    seen to drop yet, onto a new connection and replay what it missed.
+    Returns (client, nickname), or (None, None) if there is no session to
+    resume: it expired, or the client missed more than was kept, and then
+    it is removed, to log in afresh.
+    """
     with clients_lock:
-        if client in clients:
-            nickname = clients[client]
-            del clients[client]
-            print(f"{nickname} has disconnected.")
-            broadcast(f"SERVER: {nickname} has left the chatroom.")
-            update_user_list()
+        client = sessions.get(token)
+        if client is None or client.queue.closed:
+            return None, None
+        nickname = clients[client]
+        replay = client.attach(connection, offset)
+        if replay is not None:
+            client.resumes += 1
+            client.address = address
+            if media_relay is not None:
+                # Its old UDP socket is gone; voice goes over TCP until it asks for the channel again
+                media_relay.forget(client)
+    if replay is None:
+        remove_client(client)
+        return None, None
+    client.resume(connection, replay)
+    print(f"{nickname} resumed from {address}.")
+    return client, nickname
 
-    # If the disconnected client was talking, reset talking_user
+def request_floor(client, room, nickname):
+    """
+    Give `nickname` the room's talk floor if it is free and tell the room;
+    answer BUSY if someone else holds it. When clustered the bus hub
+    decides, and the outcome arrives through handle_bus_event().
+    """
+    bus = cluster_bus
+    if bus is not None:
+        bus.publish({'type': 'floor-request', 'room': room.name, 'user': nickname})
+        return
     with talking_lock:
-        if talking_user == nickname:
-            talking_user = None
-            broadcast(f"STATUS:STOP:{nickname}")
+        granted = room.talking_user is None
+        if granted:
+            room.talking_user = nickname
+        busy = not granted and nickname != room.talking_user
+    if granted:
+        announce_talker(room, f"STATUS:START:{nickname}")
+    elif busy:
+        # Send BUSY status to the requester
+        try:
+            client.send_text("STATUS:BUSY")
+        except Exception:
+            remove_client(client)
+
+def release_floor(room, nickname):
+    """
+    If `nickname` holds the room's talk floor, free it and tell the room.
+    """
+    bus = cluster_bus
+    if bus is not None:
+        bus.publish({'type': 'floor-release', 'room': room.name, 'user': nickname})
+        return
+    with talking_lock:
+        was_talking = room.talking_user == nickname
+        if was_talking:
+            room.talking_user = None
+    if was_talking:
+        announce_talker(room, f"STATUS:STOP:{nickname}")
+
+def move_client(client, nickname, room_name):
+    """
+    Move a client to another room, notifying both rooms.
+    """
+    if not valid_room_name(room_name):
+        client.send_text(f"ROOM:ERROR:invalid room name {room_name}")
+        return
+    history = open_history(room_name)
+    with clients_lock:
+        if client not in clients:
+            return
+        # Queued first so the client resets before the new room's state arrives
+        _deliver_or_close(client, Outgoing(text=f"ROOM:JOINED:{room_name}"))
+        old_room = client.room
+        if old_room is not None and old_room.name == room_name:
+            send_presence(client, old_room)
+            return
+        _leave_room(client, f"SERVER: {nickname} has left the room.")
+        _enter_room(client, nickname, room_name, history, f"SERVER: {nickname} has joined the room.")
+    if old_room is not None:
+        release_floor(old_room, nickname)
+
+def list_rooms(client):
+    """
+    Send the client every room with its member count.
+    """
+    with clients_lock:
+        listing = ','.join(f"{room.name}={len(room.members) + sum(map(len, room.remote_members.values()))}"
+                           for room in rooms.values())
+    client.send_text(f"ROOMS:{listing}")
+
+def handle_room_command(client, nickname, message):
+    """
+    Handle ROOM:JOIN:<name>, ROOM:LEAVE and ROOM:LIST.
+    """
+    parts = message.split(':', 2)
+    action = parts[1] if len(parts) > 1 else ''
+    if action == "JOIN" and len(parts) == 3:
+        move_client(client, nickname, parts[2].strip())
+    elif action == "LEAVE":
+        move_client(client, nickname, DEFAULT_ROOM)
+    elif action == "LIST":
+        list_rooms(client)
+    else:
+        client.send_text(f"ROOM:ERROR:unknown command {action}")
+
+def handle_bus_event(event):
+    """
+    Apply one event from the cluster bus to this node's clients.
+    """
+    kind = event['type']
+    with clients_lock:
+        room = rooms.get(event['room'])
+        if kind == 'member':
+            if room is None:
+                room = new_room(event['room'])
+            nickname, node = event['user'], event['node']
+            users = room.remote_members.setdefault(node, [])
+            if 'notice' in event:
+                _notify_room(room, event['notice'])
+            if event['change'] == 'JOIN':
+                users.append(nickname)
+                _presence_changed(room, 'JOIN', nickname)
+            elif nickname in users:
+                users.remove(nickname)
+                _presence_changed(room, 'LEAVE', nickname)
+            if not users:
+                del room.remote_members[node]
+            if room.is_empty() and room.name != DEFAULT_ROOM:
+                del rooms[room.name]
+            return
+        if kind == 'presence':
+            # A node's whole membership, when it joins or leaves the cluster
+            if room is None:
+                room = new_room(event['room'])
+            before = Counter(room.remote_members.get(event['node'], ()))
+            after = Counter(event['users'])
+            if event['users']:
+                room.remote_members[event['node']] = event['users']
+            else:
+                room.remote_members.pop(event['node'], None)
+            for nickname in (before - after).elements():
+                _presence_changed(room, 'LEAVE', nickname)
+            for nickname in (after - before).elements():
+                _presence_changed(room, 'JOIN', nickname)
+            if room.is_empty() and room.name != DEFAULT_ROOM:
+                del rooms[room.name]
+            return
+    if room is None:
+        return  # nobody in this room anywhere
+    if kind == 'text':
+        text = event['text']
+        # Each node keeps its own copy of the history
+        broadcast(room, text, recipients=record_chat(room, text) if text.startswith("MSG:") else None)
+    elif kind == 'voice':
+        # The body is the complete frame as a binary client sent it
+        frame = event['body']
+        codec_id, seq, timestamp, audio = parse_voice(memoryview(frame)[FRAME_HEADER.size:])
+        if room.mixer is not None:
+            # Each remote talker is a stream of its own in this node's mix
+            room.mixer.push(('bus', event.get('user')), codec_id, audio)
+            return
+        broadcast(room, Outgoing(audio=audio, codec=codec_id, seq=seq, timestamp=timestamp, frame=frame))
+    elif kind == 'floor-granted':
+        with talking_lock:
+            room.talking_user = event['user']
+        announce_talker(room, f"STATUS:START:{event['user']}")
+    elif kind == 'floor-released':
+        with talking_lock:
+            released = room.talking_user == event['user']
+            if released:
+                room.talking_user = None
+        if released:
+            announce_talker(room, f"STATUS:STOP:{event['user']}")
+    elif kind == 'floor-busy':
+        with clients_lock:
+            requesters = [client for client, nickname in room.members.items() if nickname == event['user']]
+        for client in requesters:
+            try:
+                client.send_text("STATUS:BUSY")
+            except Exception:
+                remove_client(client)
+
+def collect_gauges():
+    """
+    Gauges computed when the metrics endpoint is scraped, so keeping them
+    costs nothing in between.
+    """
+    with clients_lock:
+        connections = list(clients)
+        members = [(name, len(room.members)) for name, room in rooms.items()]
+        mixers = [room.mixer for room in rooms.values() if room.mixer is not None]
+    relay = media_relay
+    queue_bytes = [client.queue.nbytes for client in connections]
+    queue_messages = [len(client.queue) for client in connections]
+    return [
+        ('clients', "Connected clients.", [('', len(connections))]),
+        ('room_members', "Clients on this node in each room.",
+         [(f'room="{label_value(name)}"', count) for name, count in members]),
+        ('queue_bytes', "Bytes waiting in client send queues.",
+         [('stat="total"', sum(queue_bytes)), ('stat="max"', max(queue_bytes, default=0))]),
+        ('queue_messages', "Messages waiting in client send queues.",
+         [('stat="total"', sum(queue_messages)), ('stat="max"', max(queue_messages, default=0))]),
+        ('voice_dropped', "Voice frames dropped for connected clients that fell behind.",
+         [('', sum(client.queue.dropped for client in connections))]),
+        ('mixer_streams', "Talkers being mixed, over all mixed rooms.", [('', sum(map(len, mixers)))]),
+        ('mixer_undecodable', "Voice frames a mixer could not decode.",
+         [('', sum(mixer.dropped for mixer in mixers))]),
+        ('rate_limited', "Messages from connected clients dropped by their rate limits or as unknown.",
+         [('', sum(client.limiter.dropped for client in connections if client.limiter is not None))]),
+        ('sessions_suspended', "Clients whose connection dropped, kept for them to resume.",
+         [('', sum(1 for client in connections if client.suspended))]),
+        ('media_clients', "Clients receiving voice over the UDP media channel.",
+         [('', sum(1 for client in connections if client.media_address is not None))]),
+        ('media_datagrams', "Datagrams on the UDP media channel since the start.",
+         [('direction="in"', relay.received), ('direction="out"', relay.sent),
+          ('direction="dropped"', relay.dropped)] if relay is not None else []),
+    ]
+
+def collect_connections():
+    """
+    Per-connection counters and queue depths in the Prometheus text format.
+    """
+    with clients_lock:
+        connections = list(clients.items())
+    series = (
+        ('connection_messages_received_total', 'counter', lambda client: client.messages_in),
+        ('connection_bytes_received_total', 'counter', lambda client: client.bytes_in),
+        ('connection_messages_sent_total', 'counter', lambda client: client.messages_out),
+        ('connection_bytes_sent_total', 'counter', lambda client: client.bytes_out),
+        ('connection_queue_bytes', 'gauge', lambda client: client.queue.nbytes),
+        ('connection_queue_messages', 'gauge', lambda client: len(client.queue)),
+        ('connection_voice_dropped', 'gauge', lambda client: client.queue.dropped),
+        ('connection_rate_limited', 'gauge',
+         lambda client: client.limiter.dropped if client.limiter is not None else 0),
+    )
+    lines = []
+    for name, kind, value in series:
+        lines.append(f"# TYPE chat_{name} {kind}")
+        for client, nickname in connections:
+            host, port = client.address[:2]
+            room = client.room.name if client.room is not None else ''
+            labels = f'nickname="{label_value(nickname)}",peer="{host}:{port}",room="{label_value(room)}"'
+            lines.append(f"chat_{name}{{{labels}}} {value(client)}")
+    return '\n'.join(lines) + '\n'
+
+def enable_metrics(host=METRICS_HOST, port=0):
+    """
+    Start counting and serve the metrics endpoint. Must run before the
+    server accepts clients, since it swaps the locks for timed ones.
+    Returns the HTTP server.
+    """
+    global metrics, clients_lock, talking_lock
+    metrics = Metrics()
+    clients_lock = metrics.timed_lock('clients_lock', clients_lock)
+    talking_lock = metrics.timed_lock('talking_lock', talking_lock)
+    httpd = serve_metrics(metrics, collect_gauges, collect_connections, host, port)
+    print(f"Metrics on http://{host}:{httpd.server_address[1]}/metrics")
+    return httpd
+
+def join_cluster(address, node_id, loop=None):
+    """
+    Connect this node to the cluster bus hub at (host, port), or at the
+    path of its Unix socket.
+    Bus events are handled on the bus thread, or on `loop` for the asyncio
+    engine, whose connections may only be written from the loop's thread.
+    """
+    global cluster_bus
+    handler = handle_bus_event
+    if loop is not None:
+        handler = lambda event: loop.call_soon_threadsafe(handle_bus_event, event)
+    try:
+        bus = SocketBus(address, node_id, handler, on_close=leave_cluster)
+    except OSError as e:
+        print(f"Failed to join cluster bus at {format_bus_address(address)}: {e}")
+        return False
+    with clients_lock:
+        # From here on every change is published as it happens
+        cluster_bus = bus
+        for room in rooms.values():
+            if room.members:
+                bus.publish({'type': 'presence', 'room': room.name, 'users': list(room.members.values())})
+    print(f"Joined cluster bus at {format_bus_address(address)} as node {node_id}")
+    return True
+
+def leave_cluster():
+    """
+    Carry on as a standalone server after losing the bus hub: forget
+    other nodes' users and the floors the hub was arbitrating.
+    """
+    global cluster_bus
+    if cluster_bus is None:
+        return
+    cluster_bus = None
+    print("Lost connection to the cluster bus hub; continuing standalone.")
+    with clients_lock:
+        current = list(rooms.values())
+        for room in current:
+            room.remote_members.clear()
+    with talking_lock:
+        for room in current:
+            room.talking_user = None
+
+def handle_message(client, nickname, message):
+    """
+    Dispatch a single protocol line received from a client.
+    Shared by all server engines.
+    """
+    room = client.room
+    if room is None:
+        return
+    limiter = client.limiter
+    if limiter is not None and not limiter.allow(message.partition(':')[0]):
+        return
+    if message.startswith("STATUS:"):
+        parts = message.split(':', 2)
+        if len(parts) >= 3:
+            _, action, user = parts
+            if room.mixer is not None:
+                if action in ("START", "STOP"):
+                    # There is no floor to take, so only the requester hears back
+                    client.send_text(f"STATUS:{action}:{user}")
+            elif action == "START":
+                request_floor(client, room, user)
+            elif action == "STOP":
+                release_floor(room, user)
+    elif message.startswith("MSG:"):
+        # Broadcast the message with the sender's nickname
+        msg_content = message[len("MSG:"):].strip()
+        text = f"MSG:{nickname}: {msg_content}"
+        publish(room, text, exclude_client=None, recipients=record_chat(room, text))  # Broadcast to all, including sender
+    elif message.startswith("VOICE:"):
+        if room.mixer is not None:
+            try:
+                audio = base64.b64decode(message[len("VOICE:"):])
+            except binascii.Error:
+                return
+            mix_voice(client, room, PCMCodec.codec_id, audio)
+            return
+        # Broadcast voice data as is to text clients, decoded once for binary clients
+        seq = client.voice_seq
+        client.voice_seq += 1
+        publish(room, Outgoing(codec=PCMCodec.codec_id, seq=seq, timestamp=seq * PCMCodec.frame_size,
+                               voice_line=(message + '\n').encode('utf-8')),
+                exclude_client=None)
+    elif message.startswith("ROOM:"):
+        handle_room_command(client, nickname, message)
+    elif message.startswith(HISTORY_PREFIX):
+        handle_history_request(client, room, message)
+    elif message.startswith(MEDIA_PREFIX):
+        handle_media_command(client, message)
+    elif message == PRESENCE_SYNC:
+        # Switch to PRESENCE deltas, starting from a snapshot
+        with clients_lock:
+            client.presence = True
+            send_presence(client, room)
+    elif message == SESSION_CLOSE:
+        close_session(client)
+    # Anything else is dropped; relayed as is, it would reach the whole room unchecked
+
+def handle_media_command(client, message):
+    """
+    Handle MEDIA:UDP, which asks for the media channel, and MEDIA:ON and
+    MEDIA:OFF, which move the client's incoming voice to datagrams and
+    back. Chat and control messages stay on the connection either way.
+    """
+    relay = media_relay
+    if message == MEDIA_REQUEST:
+        if relay is None or not client.binary:
+            client.send_text(MEDIA_NONE)
+        else:
+            client.send_text(media_offer(relay.port, relay.register(client)))
+    elif message == MEDIA_ON:
+        if relay is not None:
+            # Where its probes came from; stays on TCP if none got through
+            client.media_address = relay.peer(client)
+    elif message == MEDIA_OFF:
+        client.media_address = None
+
+def handle_media_voice(client, payload):
+    """
+    Relay a voice datagram like a VOICE frame. Called by the media relay.
+    """
+    if metrics is not None:
+        count_received(client, 'VOICE', 1 + MEDIA_TOKEN_SIZE + len(payload))
+    limiter = client.limiter
+    if limiter is not None and not limiter.allow('DATAGRAM'):
+        return
+    handle_voice(client, payload)
+
+def enable_media(host, port, loss=0.0):
+    """
+    Open the UDP media socket. Returns False if it cannot be bound.
+    """
+    global media_relay
+    try:
+        media_relay = MediaRelay(host, port, handle_media_voice, loss)
+    except OSError as e:
+        print(f"Failed to bind media channel on {host}:{port}: {e}")
+        return False
+    print(f"Media channel on UDP {host}:{media_relay.port}")
+    return True
+
+def handle_voice(client, payload, frame=None):
+    """
+    Relay a binary voice frame without decoding the audio. Binary clients
+    that can play its codec get the received frame as is; text clients get
+    PCM as a single base64 VOICE: line shared by all of them.
+    """
+    room = client.room
+    if room is None:
+        return
+    codec_id, seq, timestamp, audio = parse_voice(payload)
+    if room.mixer is not None:
+        mix_voice(client, room, codec_id, audio, frame)
+        return
+    publish(room, Outgoing(audio=audio, codec=codec_id, seq=seq, timestamp=timestamp, frame=frame),
+            exclude_client=None)
+
+def mix_voice(client, room, codec_id, audio, frame=None):
+    """
+    Feed a talker's voice to the mixer of their room instead of relaying
+    it, and to the other cluster nodes, which mix it for their own members.
+    """
+    room.mixer.push(client, codec_id, audio)
+    bus = cluster_bus
+    if bus is not None:
+        if frame is None:
+            frame = voice_frame(codec_id, audio)
+        bus.publish({'type': 'voice', 'room': room.name, 'body': frame,
+                     'user': room.members.get(client)})
+
+def send_mix(room):
+    """
+    Run one tick of a mixed room's mixer: every member gets one frame,
+    the mix of all talkers but themselves, encoded once per codec for
+    everyone who is not talking.
+    """
+    mixer = room.mixer
+    result = mixer.mix()
+    if result is None:
+        return
+    mix, personal = result
+
+    def frame(samples, codec_id):
+        return Outgoing(audio=mixer.encode(samples, codec_id), codec=codec_id,
+                        seq=mixer.seq, timestamp=mixer.seq * mixer.frame_samples(codec_id))
 
-def update_user_list():
+    shared = {}  # codec id -> (Outgoing, recipients)
+    for client in room.recipients:
+        codec_id = ULawCodec.codec_id if client.binary and ULawCodec.codec_id in client.codecs \
+            else PCMCodec.codec_id
+        samples = personal.get(client)
+        if samples is not None:
+            broadcast(room, frame(samples, codec_id), recipients=(client,))
+            continue
+        if codec_id not in shared:
+            shared[codec_id] = (frame(mix, codec_id), [])
+        shared[codec_id][1].append(client)
+    for out, recipients in shared.values():
+        broadcast(room, out, recipients=recipients)
+
+def mix_rooms():
     """
-    Send the updated list of online users to all clients.
+    Run one mixing tick in every mixed room.
     """
     with clients_lock:
-        user_list = ','.join(clients.values())
-    broadcast(f"USERLIST:{user_list}")
+        mixed = [room for room in rooms.values() if room.mixer is not None]
+    for room in mixed:
+        try:
+            send_mix(room)
+        except Exception as e:
+            print(f"Error mixing room {room.name}: {e}")
+
+def run_mixer():
+    """
+    Mix on a fixed tick, on a thread of its own (threaded engine).
+    A late tick is made up at once; one later than a whole tick is skipped.
+    """
+    from mixer import MIX_TICK
+    next_tick = time.monotonic()
+    while True:
+        mix_rooms()
+        next_tick += MIX_TICK
+        delay = next_tick - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        elif delay < -MIX_TICK:
+            next_tick = time.monotonic()
+
+async def run_mixer_async():
+    """
+    Mix on a fixed tick on the event loop (asyncio engine), like run_mixer().
+    """
+    from mixer import MIX_TICK
+    next_tick = time.monotonic()
+    while True:
+        mix_rooms()
+        next_tick += MIX_TICK
+        delay = next_tick - time.monotonic()
+        if delay < -MIX_TICK:
+            next_tick = time.monotonic()
+        await asyncio.sleep(max(delay, 0))
+
+def enable_mixing(names):
+    """
+    Mix the voice of the named rooms ('*' for all). Returns False if
+    NumPy is missing.
+    """
+    global mixed_rooms
+    try:
+        import mixer  # imports NumPy
+    except ImportError:
+        return False
+    mixed_rooms = frozenset(names)
+    return True
+
+def handle_frame(client, nickname, frame_type, payload):
+    """
+    Dispatch a single binary frame received from a client.
+    """
+    if metrics is not None:
+        count_received(client, 'VOICE' if frame_type == FRAME_VOICE else message_type(payload),
+                       FRAME_HEADER.size + len(payload))
+    if frame_type == FRAME_VOICE:
+        limiter = client.limiter
+        if limiter is not None and not limiter.allow('VOICE'):
+            return
+        # The payload is a view into the complete received frame
+        handle_voice(client, payload, frame=payload.obj)
+    elif frame_type == FRAME_TEXT:
+        message = str(payload, 'utf-8', errors='ignore').strip()
+        if message:
+            handle_message(client, nickname, message)
+
+def flood_pause(client):
+    """
+    Seconds to stop reading from a client after what was just read from
+    it, 0 unless it was flooding (see ratelimit.py). Raises FloodError once
+    it kept flooding after its last backoff.
+    """
+    limiter = client.limiter
+    if limiter is None or not limiter.pause:
+        return 0.0
+    pause = limiter.take_pause()
+    if limiter.exceeded:
+        raise FloodError(f"still flooding after {limiter.strikes - 1} backoffs; disconnected")
+    client.send_text(f"SERVER:You are sending too fast. Nothing you send is read for {pause:g} s.")
+    return pause
+
+def accept_hello(client, line):
+    """
+    Parse the client's first line and answer a protocol negotiation,
+    including the voice codec the client should send with.
+    Returns the nickname, or an empty string if none was given.
+    """
+    version, nickname, offered = parse_hello(line)
+    if version is not None:
+        version = negotiate_version(version)
+        client.binary = version >= BINARY_PROTOCOL_VERSION
+        # Deltas from the start, so a reconnect wave never sends this client a full USERLIST
+        client.presence = version >= PRESENCE_PROTOCOL_VERSION
+        if version >= SESSION_PROTOCOL_VERSION and session_grace:
+            # From the reply on, so stream offsets count from its first byte
+            client.sent_log = SentLog(REPLAY_BYTES)
+        codec = None
+        if client.binary:
+            codec = choose_codec(offered, allowed_codecs)
+            codec_ids = [PCMCodec.codec_id] + [CODEC_NAMES[name].codec_id for name in offered if name in CODEC_NAMES]
+            if ComfortNoiseCodec.name in offered:
+                # Not a codec to send with, but the client can play silence descriptors
+                codec_ids.append(ComfortNoiseCodec.codec_id)
+            client.codecs = frozenset(codec_ids)
+        # The reply is queued before anything else, in the text protocol
+        client.send(hello_reply(version, codec.name if codec else None))
+    return nickname
 
 def handle_client(client_socket, address):
     """
-    Handle communication with a connected client.
+    Handle communication with a connected client (threaded engine).
     """
-    global talking_user
-    buffer = ""
+    client = None
+    dropped = False
+    receiver = Receiver(client_socket, max_size=max_message_size)
     try:
-        # Receive the nickname
-        while '\n' not in buffer:
-            data = client_socket.recv(1024)
-            if not data:
+        # Receive the nickname, protocol negotiation or session to resume
+        line = receiver.line()
+        while line is None:
+            if not receiver.fill():
                 client_socket.close()
                 return
-            buffer += data.decode('utf-8')
-        nickname, buffer = buffer.split('\n', 1)
-        nickname = nickname.strip()
-        if not nickname:
-            client_socket.close()
-            return
+            line = receiver.line()
+        line = str(line, 'utf-8')
+        resume = parse_resume(line)
+        if resume is not None:
+            client, nickname = resume_session(*resume, client_socket, address)
+            if client is None:
+                client_socket.sendall(resume_reply(False))
+                client_socket.close()
+                return
+        else:
+            client = ThreadedConnection(client_socket, address)
+            nickname = accept_hello(client, line)
+            if not nickname:
+                client_socket.close()
+                return
+            register_client(client, nickname)
+            open_session(client)
 
-        with clients_lock:
-            clients[client_socket] = nickname
-        print(f"{nickname} connected from {address}.")
-        broadcast(f"SERVER: {nickname} has joined the chatroom.", exclude_client=client_socket)
-        update_user_list()
+        # Whatever arrived along with the first line is still in the receiver
+        if client.binary:
+            receive_frames(receiver, client, nickname)
+        else:
+            receive_lines(receiver, client, nickname)
+        dropped = True
 
-        while True:
-            data = client_socket.recv(4096)
-            if not data:
-                break  # Client disconnected
-            buffer += data.decode('utf-8', errors='ignore')
-            while '\n' in buffer:
-                message, buffer = buffer.split('\n', 1)
-                message = message.strip()
+    except Exception as e:
+        print(f"Error handling client {address}: {e}")
+        # A broken connection, unlike one closed for misbehaving, may be resumed
+        dropped = isinstance(e, OSError) and not isinstance(e, FloodError)
+    finally:
+        if client is not None and not (dropped and suspend_client(client, client_socket)):
+            remove_client(client)
+            client.close()
+        client_socket.close()
+
+def receive_lines(receiver, client, nickname):
+    """
+    Read newline-terminated text protocol messages until the client disconnects.
+    Only complete lines are decoded, so a character split across two reads
+    survives.
+    """
+    while True:
+        if metrics is not None:
+            start = time.perf_counter()
+            lines = receiver.lines()
+            metrics.parse_seconds.observe(time.perf_counter() - start)
+        else:
+            lines = receiver.lines()
+        for line in lines:
+            message = line.strip()
+            if not message:
+                continue
+            if metrics is not None:
+                count_received(client, message_type(message), len(line.encode('utf-8')) + 1)
+            handle_message(client, nickname, message)
+        pause = flood_pause(client)
+        if pause:
+            time.sleep(pause)
+        if not receiver.fill():
+            break  # Client disconnected
+
+def receive_frames(receiver, client, nickname):
+    """
+    Read binary protocol frames until the client disconnects.
+    """
+    while True:
+        if metrics is not None:
+            start = time.perf_counter()
+            frames = receiver.frames()
+            metrics.parse_seconds.observe(time.perf_counter() - start)
+        else:
+            frames = receiver.frames()
+        for frame_type, payload in frames:
+            handle_frame(client, nickname, frame_type, payload)
+        pause = flood_pause(client)
+        if pause:
+            time.sleep(pause)
+        if not receiver.fill():
+            break  # Client disconnected
+
+async def handle_client_async(reader, writer):
+    """
+    Handle communication with a connected client (asyncio engine).
+    """
+    address = writer.get_extra_info('peername')
+    client = None
+    dropped = False
+    try:
+        # Receive the nickname, protocol negotiation or session to resume
+        line = (await reader.readline()).decode('utf-8')
+        resume = parse_resume(line)
+        if resume is not None:
+            client, nickname = resume_session(*resume, writer, address)
+            if client is None:
+                writer.write(resume_reply(False))
+                writer.close()
+                return
+        else:
+            client = AsyncConnection(writer, address)
+            nickname = accept_hello(client, line)
+            if not nickname:
+                writer.close()
+                return
+            register_client(client, nickname)
+            open_session(client)
+
+        if client.binary:
+            while True:
+                try:
+                    header = await reader.readexactly(FRAME_HEADER.size)
+                    start = time.perf_counter() if metrics is not None else 0.0
+                    frame_type, length = FRAME_HEADER.unpack(header)
+                    if frame_type not in FRAME_TYPES or length > max_message_size:
+                        raise ProtocolError(f"bad frame header type={frame_type} length={length}")
+                    if metrics is not None:
+                        metrics.parse_seconds.observe(time.perf_counter() - start)
+                    frame = header + await reader.readexactly(length)
+                except asyncio.IncompleteReadError:
+                    break  # Client disconnected
+                handle_frame(client, nickname, frame_type, memoryview(frame)[FRAME_HEADER.size:])
+                pause = flood_pause(client)
+                if pause:
+                    await asyncio.sleep(pause)
+        else:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break  # Client disconnected
+                if metrics is not None:
+                    start = time.perf_counter()
+                    message = line.decode('utf-8', errors='ignore').strip()
+                    metrics.parse_seconds.observe(time.perf_counter() - start)
+                    if message:
+                        count_received(client, message_type(message), len(line))
+                else:
+                    message = line.decode('utf-8', errors='ignore').strip()
                 if not message:
                     continue
-                # Handle different message types
-                if message.startswith("STATUS:"):
-                    parts = message.split(':', 2)
-                    if len(parts) >= 3:
-                        _, action, user = parts
-                        if action == "START":
-                            with talking_lock:
-                                if talking_user is None:
-                                    talking_user = user
-                                    broadcast(f"STATUS:START:{user}")
-                                else:
-                                    if user != talking_user:
-                                        # Send BUSY status to the requester
-                                        try:
-                                            client_socket.sendall("STATUS:BUSY\n".encode('utf-8'))
-                                        except:
-                                            remove_client(client_socket)
-                        elif action == "STOP":
-                            with talking_lock:
-                                if talking_user == user:
-                                    talking_user = None
-                                    broadcast(f"STATUS:STOP:{user}")
-                elif message.startswith("MSG:"):
-                    # Broadcast the message with the sender's nickname
-                    msg_content = message[len("MSG:"):].strip()
-                    broadcast(f"MSG:{nickname}: {msg_content}", exclude_client=None)  # Broadcast to all, including sender
-                elif message.startswith("VOICE:"):
-                    # Broadcast voice data as is
-                    broadcast(message, exclude_client=None)
-                else:
-                    # For any other messages, broadcast as is
-                    broadcast(message, exclude_client=None)
+                handle_message(client, nickname, message)
+                pause = flood_pause(client)
+                if pause:
+                    await asyncio.sleep(pause)
+        dropped = True
 
     except Exception as e:
         print(f"Error handling client {address}: {e}")
+        # A broken connection, unlike one closed for misbehaving, may be resumed
+        dropped = isinstance(e, OSError) and not isinstance(e, FloodError)
     finally:
-        remove_client(client_socket)
-        client_socket.close()
+        if client is not None and not (dropped and suspend_client(client, writer)):
+            remove_client(client)
+            client.close()
 
-def start_server():
+def start_server(host=HOST, port=PORT, cluster=None, reuse_port=False):
     """
-    Initialize and start the chat server.
+    Initialize and start the chat server, one thread per client.
+    `cluster` is an optional (bus hub address, node id) pair to join.
+    With `reuse_port`, other processes may listen on the same port (see
+    workers.py).
     """
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if reuse_port:
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     try:
-        server.bind((HOST, PORT))
+        server.bind((host, port))
     except Exception as e:
-        print(f"Failed to bind server on {HOST}:{PORT}: {e}")
+        print(f"Failed to bind server on {host}:{port}: {e}")
         return
 
     server.listen()
-    print(f"Chat server started on {HOST}:{PORT}")
+    print(f"Chat server started on {host}:{port}")
+    if cluster is not None and not join_cluster(*cluster):
+        server.close()
+        return
+    if mixed_rooms:
+        threading.Thread(target=run_mixer, name="mixer", daemon=True).start()
+    if media_relay is not None:
+        threading.Thread(target=media_relay.serve, name="media", daemon=True).start()
 
     try:
         while True:
@@ -153,5 +1700,166 @@ def start_server():
     finally:
         server.close()
 
+async def serve_async(host=HOST, port=PORT, cluster=None, reuse_port=False):
+    """
+    Run the asyncio engine until cancelled.
+    All clients share a single event loop thread.
+    """
+    try:
+        # Longer lines make readline() fail, which disconnects the client
+        server = await asyncio.start_server(handle_client_async, host, port, backlog=1024, limit=max_message_size,
+                                            reuse_port=reuse_port or None)
+    except Exception as e:
+        print(f"Failed to bind server on {host}:{port}: {e}")
+        return
+
+    print(f"Chat server started on {host}:{port} (asyncio)")
+    if cluster is not None and not join_cluster(*cluster, loop=asyncio.get_running_loop()):
+        server.close()
+        return
+    # Referenced for as long as the server runs, so neither is collected
+    mixing = asyncio.ensure_future(run_mixer_async()) if mixed_rooms else None
+    media = await media_relay.serve_async() if media_relay is not None else None
+    async with server:
+        await server.serve_forever()
+
+def start_async_server(host=HOST, port=PORT, cluster=None, reuse_port=False):
+    """
+    Initialize and start the chat server on an asyncio event loop.
+    """
+    try:
+        asyncio.run(serve_async(host, port, cluster, reuse_port))
+    except KeyboardInterrupt:
+        print("\nShutting down the server.")
+
+def parse_address(value):
+    """
+    Parse a HOST:PORT command line argument.
+    """
+    host, _, port = value.rpartition(':')
+    if not host or not port.isdigit():
+        raise argparse.ArgumentTypeError(f"expected HOST:PORT, got {value!r}")
+    return host, int(port)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Chat server with exclusive voice.")
+    parser.add_argument('--host', default=HOST, help="Address to listen on.")
+    parser.add_argument('--port', type=int, default=PORT, help="Port to listen on.")
+    parser.add_argument('--engine', choices=ENGINES, default=DEFAULT_ENGINE,
+                        help="Connection handling model: one thread per client, or a single asyncio event loop.")
+    parser.add_argument('--queue-bytes', type=int, default=DEFAULT_MAX_BYTES,
+                        help="Per-client queue size above which the oldest voice frames are dropped.")
+    parser.add_argument('--queue-messages', type=int, default=DEFAULT_MAX_MESSAGES,
+                        help="Per-client queue length above which the oldest voice frames are dropped.")
+    parser.add_argument('--disconnect-bytes', type=int, default=DEFAULT_DISCONNECT_BYTES,
+                        help="Disconnect a client once this many bytes of chat and status messages are waiting for it.")
+    parser.add_argument('--rate-limit', nargs='+', metavar='KIND=RATE[/BURST]', default=[],
+                        help="Messages per second (and burst) each client may send of a kind: "
+                             "MSG, VOICE, DATAGRAM or CONTROL (see ratelimit.py).")
+    parser.add_argument('--no-rate-limits', action='store_true',
+                        help="Let clients send as fast as they like. Unknown messages are still dropped.")
+    parser.add_argument('--max-message-bytes', type=int, default=DEFAULT_MAX_MESSAGE_SIZE,
+                        help="Disconnect a client that sends a longer line or frame.")
+    parser.add_argument('--resume-grace', type=float, default=RESUME_GRACE,
+                        help="Seconds a client whose connection dropped is kept, unseen by the others, "
+                             "to resume its session (see session.py); 0 removes it at once.")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Serve from this many processes sharing the port, joined by a local cluster bus "
+                             "(see workers.py); needs fork() and SO_REUSEPORT.")
+    parser.add_argument('--codecs', nargs='+', choices=list(CODEC_NAMES), default=list(CODEC_NAMES),
+                        help="Voice codecs clients may be asked to send with. PCM is always allowed.")
+    parser.add_argument('--cluster', metavar='HOST:PORT', type=parse_address,
+                        help="Join the cluster bus hub at this address (see cluster.py).")
+    parser.add_argument('--node-id', help="Name of this node in the cluster. Defaults to <hostname>:<port>.")
+    parser.add_argument('--history-dir',
+                        help="Keep chat history in this directory so clients can fetch a backlog.")
+    parser.add_argument('--history-max-bytes', type=int, default=DEFAULT_HISTORY_BYTES,
+                        help="History kept per room before the oldest segments are deleted.")
+    parser.add_argument('--history-max-days', type=float, default=DEFAULT_MAX_AGE / 86400,
+                        help="Age after which history segments are deleted.")
+    parser.add_argument('--history-segment-bytes', type=int, default=DEFAULT_SEGMENT_BYTES,
+                        help="Size of each history segment file.")
+    parser.add_argument('--metrics-port', type=int,
+                        help="Serve Prometheus metrics and the profiler toggle on this port (see metrics.py).")
+    parser.add_argument('--metrics-host', default=METRICS_HOST, help="Address of the metrics endpoint.")
+    parser.add_argument('--mix-rooms', nargs='+', metavar='ROOM', default=[],
+                        help="Rooms where everyone may talk at once, mixed by the server (needs NumPy); "
+                             "'*' for every room.")
+    parser.add_argument('--media-port', type=int,
+                        help="Carry voice over UDP on this port for clients that ask for it, "
+                             "0 for any free port (see media.py).")
+    parser.add_argument('--media-loss', type=float, default=0.0,
+                        help="Drop this share of media datagrams at random, to test voice under packet loss.")
+    args = parser.parse_args(argv)
+
+    reuse_port = False
+    if args.workers > 1:
+        if not workers.supported():
+            parser.error("--workers needs fork() and SO_REUSEPORT (Linux, macOS or a BSD)")
+        # Only the workers come back from here; the supervisor returns when they are gone
+        worker = workers.supervise(args.workers, local_hub=args.cluster is None)
+        if worker is None:
+            return
+        index, hub_path = worker
+        # Each worker is a cluster node of its own, with its own copy of
+        # the history and its own metrics and media ports. The pid tells a
+        # restarted worker from its predecessor, which the hub may not have
+        # seen leave yet and would not let it join under the same name.
+        args.node_id = f"{args.node_id or f'{socket.gethostname()}:{args.port}'}/{index}.{os.getpid()}"
+        if hub_path is not None:
+            args.cluster = hub_path
+        if args.history_dir:
+            args.history_dir = os.path.join(args.history_dir, f"worker{index}")
+        if args.metrics_port:
+            args.metrics_port += index
+        if args.media_port:
+            args.media_port += index
+        reuse_port = True
+
+    if args.media_port is not None and not enable_media(args.host, args.media_port, args.media_loss):
+        return
+
+    if args.mix_rooms and not enable_mixing(args.mix_rooms):
+        parser.error("--mix-rooms needs NumPy")
+
+    if args.metrics_port is not None:
+        enable_metrics(args.metrics_host, args.metrics_port)
+
+    global history_store
+    if args.history_dir:
+        history_store = HistoryStore(args.history_dir, segment_bytes=args.history_segment_bytes,
+                                     max_bytes=args.history_max_bytes, max_age=args.history_max_days * 86400)
+
+    allowed_codecs[:] = args.codecs
+
+    global rate_limits, max_message_size, session_grace
+    try:
+        rate_limits.update(parse_limit(value) for value in args.rate_limit)
+    except ValueError as e:
+        parser.error(f"--rate-limit: {e}")
+    if args.no_rate_limits:
+        rate_limits = None
+    max_message_size = args.max_message_bytes
+    session_grace = args.resume_grace
+
+    queue_limits.update(
+        max_bytes=args.queue_bytes,
+        max_messages=args.queue_messages,
+        disconnect_bytes=args.disconnect_bytes,
+    )
+
+    cluster = None
+    if args.cluster is not None:
+        cluster = (args.cluster, args.node_id or f"{socket.gethostname()}:{args.port}")
+
+    try:
+        if args.engine == 'asyncio':
+            start_async_server(args.host, args.port, cluster, reuse_port)
+        else:
+            start_server(args.host, args.port, cluster, reuse_port)
+    finally:
+        if history_store is not None:
+            history_store.close()  # writes what is still staged
+
 if __name__ == "__main__":
-    start_server()
+    main()
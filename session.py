@@ -0,0 +1,82 @@
+"""
+Session resumption: a client whose connection drops gets its place back.
+
+A client that negotiated version 8 is sent SESSION:<token> once it is
+registered. If its connection breaks, the server keeps it registered, in
+its room, holding its talk floor, for RESUME_GRACE seconds: its send
+queue keeps filling with everything it misses (voice excepted, which
+would be stale by the time it could be played), and nobody is told it
+left. The client reconnects and, instead of a HELLO, sends
+
+    RESUME:<token>:<offset>
+
+where <offset> counts the bytes of the server's stream it had read up to
+the last complete message, from the first byte of the HELLO reply on. The
+server answers RESUME:OK and carries on from exactly that offset: what was
+written to the old connection but never read is replayed from a SentLog,
+and the queue is drained after it. If the session ended, or the offset
+is further back than the log reaches, the answer is RESUME:EXPIRED and the
+client logs in afresh.
+
+A SentLog keeps references to the buffers written, which are mostly the
+broadcast bytes every recipient shares, so keeping one per connection
+costs little memory.
+"""
+from collections import deque
+
+# Seconds a dropped client's session is kept for it to resume
+RESUME_GRACE = 10.0
+# Most bytes a connection keeps for replay after they were written
+REPLAY_BYTES = 256 * 1024
+# Random bytes in a session token
+SESSION_TOKEN_SIZE = 16
+
+
+class SentLog:
+    """
+    The last buffers written to a connection, by offset in its stream.
+    Not thread-safe.
+    """
+
+    def __init__(self, max_bytes=REPLAY_BYTES):
+        self.max_bytes = max_bytes
+        self.offset = 0  # stream offset just past the last buffer written
+        self.start = 0  # stream offset of the first buffer kept
+        self._buffers = deque()
+        # Trimmed only once twice as much is kept: writes are on the hot path
+        self._trim_at = 2 * max_bytes
+
+    def append(self, data):
+        self._buffers.append(data)
+        self.offset += len(data)
+        if self.offset - self.start > self._trim_at:
+            self._trim()
+
+    def extend(self, buffers):
+        self._buffers.extend(buffers)
+        self.offset += sum(map(len, buffers))
+        if self.offset - self.start > self._trim_at:
+            self._trim()
+
+    def _trim(self):
+        # Keep whole buffers, as long as at least max_bytes remain
+        buffers = self._buffers
+        while buffers and self.offset - self.start - len(buffers[0]) >= self.max_bytes:
+            self.start += len(buffers.popleft())
+
+    def since(self, offset):
+        """
+        The buffers written from a stream offset on, the first one sliced
+        if the offset falls inside it. None if the log does not reach back
+        that far, or the offset lies beyond what was written.
+        """
+        if offset < self.start or offset > self.offset:
+            return None
+        position = self.start
+        replay = []
+        for buf in self._buffers:
+            end = position + len(buf)
+            if end > offset:
+                replay.append(buf if position >= offset else memoryview(buf)[offset - position:])
+            position = end
+        return replay
@@ -0,0 +1,88 @@
+import os
+import socket
+import sys
+import threading
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cluster
+from cluster import Hub, SocketBus
+
+
+def request(hub, node, user, room='lobby'):
+    return hub.route(node, {'type': 'floor-request', 'room': room, 'user': user})
+
+
+def release(hub, node, user, room='lobby'):
+    return hub.route(node, {'type': 'floor-release', 'room': room, 'user': user})
+
+
+class FloorTest(unittest.TestCase):
+    def setUp(self):
+        self.hub = Hub()
+        self.hub.join('node1')
+        self.hub.join('node2')
+
+    def test_grant_goes_to_every_node(self):
+        granted = {'type': 'floor-granted', 'room': 'lobby', 'user': 'alice'}
+        self.assertEqual(request(self.hub, 'node1', 'alice'), [('node1', granted), ('node2', granted)])
+
+    def test_busy_goes_to_the_requester(self):
+        request(self.hub, 'node1', 'alice')
+        self.assertEqual(request(self.hub, 'node2', 'bob'),
+                         [('node2', {'type': 'floor-busy', 'room': 'lobby', 'user': 'bob'})])
+
+    def test_same_nickname_on_another_node_is_busy(self):
+        request(self.hub, 'node1', 'alice')
+        self.assertEqual(request(self.hub, 'node2', 'alice'),
+                         [('node2', {'type': 'floor-busy', 'room': 'lobby', 'user': 'alice'})])
+        # Nor can it release the floor it does not hold
+        self.assertEqual(release(self.hub, 'node2', 'alice'), [])
+        self.assertEqual(self.hub.floors['lobby'], ('alice', 'node1'))
+
+    def test_holder_asking_again_changes_nothing(self):
+        request(self.hub, 'node1', 'alice')
+        self.assertEqual(request(self.hub, 'node1', 'alice'), [])
+
+    def test_release_frees_the_floor(self):
+        request(self.hub, 'node1', 'alice')
+        released = {'type': 'floor-released', 'room': 'lobby', 'user': 'alice'}
+        self.assertEqual(release(self.hub, 'node1', 'alice'), [('node1', released), ('node2', released)])
+        self.assertEqual(len(request(self.hub, 'node2', 'alice')), 2)
+
+    def test_leaving_node_releases_its_floors(self):
+        request(self.hub, 'node1', 'alice')
+        released = {'type': 'floor-released', 'room': 'lobby', 'user': 'alice'}
+        self.assertEqual(self.hub.leave('node1'), [('node2', released)])
+        self.assertNotIn('lobby', self.hub.floors)
+
+
+class SocketBusTest(unittest.TestCase):
+    def test_stalled_hub_is_dropped_without_raising(self):
+        # A hub that accepts the node and then never reads from it
+        listener = socket.create_server(('127.0.0.1', 0))
+        self.addCleanup(listener.close)
+        accepted = []
+        threading.Thread(target=lambda: accepted.append(listener.accept()[0]), daemon=True).start()
+        lost = threading.Event()
+        small_queue = lambda: cluster.SendQueue(max_bytes=4096, max_messages=64, disconnect_bytes=64 * 1024)
+        with mock.patch.object(cluster, '_bus_queue', small_queue), \
+                mock.patch('builtins.print'):
+            bus = SocketBus(listener.getsockname(), 'node1', lambda event: None, on_close=lost.set)
+            text = 'x' * 1000
+            for _ in range(20000):
+                bus.publish({'type': 'text', 'room': 'lobby', 'text': text})
+                if lost.is_set():
+                    break
+            self.assertTrue(lost.wait(5))
+            # Later events are dropped quietly
+            bus.publish({'type': 'text', 'room': 'lobby', 'text': text})
+        bus.close()
+        for sock in accepted:
+            sock.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
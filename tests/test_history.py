@@ -0,0 +1,187 @@
+import contextlib
+import errno
+import io
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from history import INDEX_ENTRY, RECORD_HEADER, HistoryStore, RoomHistory
+
+
+def encode(msg_id, timestamp, message):
+    return b"%d:%s\n" % (msg_id, bytes(message))
+
+
+def messages(history, start=0, end=1 << 62):
+    """
+    (id, message) of everything a replay returns.
+    """
+    lines = b''.join(history.replay(start, end, encode)).splitlines()
+    return [(int(msg_id), message) for msg_id, _, message in (line.partition(b':') for line in lines)]
+
+
+class FailingFile:
+    """
+    Wraps a file to fail its next `fail` writes, writing half of the data
+    first when `torn`.
+    """
+
+    def __init__(self, file, fail=1, torn=False):
+        self.file = file
+        self.fail = fail
+        self.torn = torn
+
+    def write(self, data):
+        if not self.fail:
+            return self.file.write(data)
+        self.fail -= 1
+        if self.torn:
+            return self.file.write(data[:len(data) // 2])
+        raise OSError(errno.ENOSPC, "No space left on device")
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+
+class RoomHistoryTest(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.directory = self._tmp.name
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def open(self, **limits):
+        limits.setdefault('segment_bytes', 1 << 20)
+        limits.setdefault('max_bytes', 1 << 30)
+        limits.setdefault('max_age', 3600)
+        return RoomHistory(self.directory, **limits)
+
+    def test_ids_survive_reopening(self):
+        history = self.open()
+        for i in range(5):
+            self.assertEqual(history.append(b"m%d" % i), i + 1)
+        history.close()
+        history = self.open()
+        self.assertEqual(history.next_id, 6)
+        self.assertEqual(messages(history), [(i + 1, b"m%d" % i) for i in range(5)])
+        history.close()
+
+    def test_staged_messages_are_counted_and_replayed(self):
+        history = self.open()
+        history.append(b"written")
+        self.assertEqual(history.stage(b"staged"), 2)
+        self.assertEqual(history.next_id, 3)
+        self.assertEqual(messages(history, 1, history.next_id), [(1, b"written"), (2, b"staged")])
+        history.close()
+
+    def test_crash_mid_record_drops_it(self):
+        history = self.open()
+        for i in range(3):
+            history.append(b"m%d" % i)
+        segment = history.segments[-1]
+        history.close()
+        # An index entry written, its record cut short
+        with open(segment.index_path, 'ab') as index:
+            index.write(INDEX_ENTRY.pack(segment.size))
+        with open(segment.log_path, 'ab') as log:
+            log.write(RECORD_HEADER.pack(4, time.time(), 100) + b"cut")
+        history = self.open()
+        self.assertEqual(history.next_id, 4)
+        self.assertEqual(os.path.getsize(segment.log_path), segment.size)
+        self.assertEqual(history.append(b"after"), 4)
+        self.assertEqual(messages(history)[-2:], [(3, b"m2"), (4, b"after")])
+        history.close()
+
+    def test_crash_before_index_entry_drops_record(self):
+        history = self.open()
+        history.append(b"kept")
+        segment = history.segments[-1]
+        history.close()
+        with open(segment.log_path, 'ab') as log:
+            log.write(RECORD_HEADER.pack(2, time.time(), 4) + b"lost")
+        history = self.open()
+        self.assertEqual(history.next_id, 2)
+        self.assertEqual(history.append(b"next"), 2)
+        self.assertEqual(messages(history), [(1, b"kept"), (2, b"next")])
+        history.close()
+
+    def test_retention_by_size_keeps_newest_segments(self):
+        history = self.open(segment_bytes=200, max_bytes=600)
+        for i in range(100):
+            history.append(b"message %03d" % i)
+        self.assertGreater(history.first_id, 1)
+        self.assertLessEqual(sum(segment.size for segment in history.segments[:-1]), 600)
+        replayed = messages(history)
+        self.assertEqual(replayed[0][0], history.first_id)
+        self.assertEqual([msg_id for msg_id, _ in replayed], list(range(history.first_id, 101)))
+        self.assertEqual(replayed[-1], (100, b"message 099"))
+        history.close()
+
+    def test_retention_by_age(self):
+        history = self.open(segment_bytes=100, max_age=60)
+        for i in range(10):
+            history.append(b"old message %d" % i)
+        old = time.time() - 120
+        for segment in history.segments:
+            os.utime(segment.log_path, (old, old))
+        newest = history.segments[-1]
+        history.close()
+        history = self.open(segment_bytes=100, max_age=60)
+        # Only the segment being written survives
+        self.assertEqual([segment.first_id for segment in history.segments], [newest.first_id])
+        self.assertEqual(history.next_id, 11)
+        history.close()
+
+    def test_failed_write_skips_its_id(self):
+        history = self.open()
+        history.append(b"one")
+        segment = history.segments[-1]
+        segment._log = FailingFile(segment._log)
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            self.assertEqual(history.append(b"lost"), 2)
+        self.assertIn("message 2 dropped", output.getvalue())
+        self.assertEqual(history.append(b"three"), 3)
+        self.assertEqual(history.next_id, 4)
+        self.assertEqual(messages(history), [(1, b"one"), (3, b"three")])
+        self.assertEqual(messages(history, 3), [(3, b"three")])
+        history.close()
+        history = self.open()
+        self.assertEqual(history.next_id, 4)
+        self.assertEqual(messages(history), [(1, b"one"), (3, b"three")])
+        history.close()
+
+    def test_torn_write_is_cut_back(self):
+        history = self.open()
+        history.append(b"one")
+        segment = history.segments[-1]
+        size = segment.size
+        segment._index = FailingFile(segment._index, torn=True)
+        with contextlib.redirect_stdout(io.StringIO()):
+            history.append(b"lost")
+        self.assertEqual(os.path.getsize(segment.log_path), size)
+        self.assertEqual(os.path.getsize(segment.index_path), INDEX_ENTRY.size)
+        history.append(b"three")
+        self.assertEqual(messages(history), [(1, b"one"), (3, b"three")])
+        history.close()
+
+
+class HistoryStoreTest(unittest.TestCase):
+    def test_writer_thread_stores_staged_messages(self):
+        with tempfile.TemporaryDirectory() as directory:
+            store = HistoryStore(directory)
+            for i in range(50):
+                store.stage('lobby', b"m%d" % i)
+            self.assertEqual(store.next_id('lobby'), 51)
+            store.close()
+            store = HistoryStore(directory)
+            self.assertEqual(messages(store.room('lobby')), [(i + 1, b"m%d" % i) for i in range(50)])
+            store.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,34 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from presence import JOIN, LEAVE, SNAPSHOT, PresenceModel
+
+
+class PresenceModelTest(unittest.TestCase):
+    def setUp(self):
+        self.model = PresenceModel()
+        self.model.apply("PRESENCE:SNAPSHOT:1::alice,bob")
+
+    def test_deltas_follow_the_snapshot(self):
+        self.assertEqual(self.model.apply("PRESENCE:JOIN:2:carol"), [(JOIN, 'carol')])
+        self.assertEqual(self.model.apply("PRESENCE:LEAVE:3:alice"), [(LEAVE, 'alice')])
+        self.assertEqual(list(self.model), ['bob', 'carol'])
+
+    def test_missing_delta_asks_for_a_snapshot(self):
+        self.assertIsNone(self.model.apply("PRESENCE:JOIN:3:carol"))
+        self.assertEqual(self.model.apply("PRESENCE:JOIN:4:dave"), [])
+        self.assertNotIn('dave', self.model)
+
+    def test_unreadable_message_asks_for_a_snapshot(self):
+        self.assertIsNone(self.model.apply("PRESENCE:JOIN:two:carol"))
+        # Deltas are ignored until the snapshot arrives
+        self.assertEqual(self.model.apply("PRESENCE:JOIN:2:carol"), [])
+        self.assertEqual(self.model.apply("PRESENCE:SNAPSHOT:5::alice,carol"), [(SNAPSHOT, None)])
+        self.assertEqual(list(self.model), ['alice', 'carol'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from session import SentLog
+
+
+def replayed(log, offset):
+    buffers = log.since(offset)
+    return None if buffers is None else b''.join(bytes(buf) for buf in buffers)
+
+
+class SentLogTest(unittest.TestCase):
+    def test_since_whole_and_sliced_buffers(self):
+        log = SentLog()
+        log.append(b"hello ")
+        log.extend([b"wide ", b"world"])
+        self.assertEqual(log.offset, 16)
+        self.assertEqual(replayed(log, 0), b"hello wide world")
+        self.assertEqual(replayed(log, 6), b"wide world")
+        self.assertEqual(replayed(log, 8), b"de world")
+        self.assertEqual(replayed(log, 15), b"d")
+
+    def test_since_the_end_is_empty(self):
+        log = SentLog()
+        log.append(b"abc")
+        self.assertEqual(log.since(3), [])
+
+    def test_since_beyond_the_end(self):
+        log = SentLog()
+        log.append(b"abc")
+        self.assertIsNone(log.since(4))
+
+    def test_trimming_keeps_at_least_max_bytes(self):
+        log = SentLog(max_bytes=100)
+        data = bytes(range(256)) * 4
+        for i in range(0, len(data), 10):
+            log.append(data[i:i + 10])
+        self.assertGreater(log.start, 0)
+        self.assertGreaterEqual(log.offset - log.start, 100)
+        self.assertLessEqual(log.offset - log.start, 200)
+        # Everything from where the log starts is still there, byte for byte
+        self.assertEqual(replayed(log, log.start), data[log.start:])
+        self.assertEqual(replayed(log, log.offset - 100), data[-100:])
+
+    def test_since_before_the_trimmed_start(self):
+        log = SentLog(max_bytes=10)
+        for _ in range(10):
+            log.append(b"x" * 7)
+        self.assertGreater(log.start, 0)
+        self.assertIsNone(log.since(log.start - 1))
+        self.assertIsNotNone(log.since(log.start))
+
+    def test_trimming_keeps_whole_buffers(self):
+        log = SentLog(max_bytes=10)
+        log.append(b"a" * 15)
+        log.append(b"b" * 15)
+        # Dropping the first buffer would leave 15 bytes, still enough
+        self.assertEqual(log.start, 15)
+        self.assertEqual(replayed(log, 20), b"b" * 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
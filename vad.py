@@ -0,0 +1,146 @@
+"""
+Voice activity detection and silence suppression for the client's
+microphone.
+
+Much of a push-to-talk transmission is not speech: the pauses between
+words and sentences, and the moments before and after the talker speaks.
+The detector classifies each captured chunk from two features, computed
+with NumPy over the whole chunk at once:
+
+    energy   RMS level in dB relative to full scale (dBFS)
+    ZCR      fraction of adjacent samples whose sign differs
+
+against a noise floor: the quietest chunk of the last FLOOR_WINDOW, which
+follows a changing background within that long, since speech always has
+pauses quieter than the words around them. A chunk is speech when it is
+well above the floor, or somewhat above it with the high zero-crossing
+rate of unvoiced consonants (s, f, sh), which carry little energy. A hangover keeps sending for a moment after the last
+speech chunk, so word endings and short pauses are not clipped.
+
+Silent chunks are not sent. The sender sends a comfort noise descriptor
+(see codec.py) when silence starts and every SID_INTERVAL after that,
+carrying the level of the noise floor, and receivers play noise at that
+level instead of dead air: discontinuous transmission as in RFC 3389.
+
+NumPy is needed only here; without it the client sends every chunk.
+"""
+import math
+from collections import deque
+
+import numpy as np
+
+# process() results
+VOICE = 'voice'  # send the chunk
+SID = 'sid'  # send a silence descriptor instead
+SILENT = 'silent'  # send nothing
+
+# A chunk this far above the noise floor is speech
+SPEECH_MARGIN_DB = 9.0
+# A chunk this far above the floor is speech if it is also this noisy
+FRICATIVE_MARGIN_DB = 4.0
+FRICATIVE_ZCR = 0.3
+# Chunks quieter than this are never speech, however quiet the room
+MIN_SPEECH_DB = -60.0
+FLOOR_WINDOW = 2.0  # seconds
+# Highest floor assumed until a whole window has been heard: a quieter
+# background is learned from the first chunk, and speech is louder
+INITIAL_FLOOR_DB = -45.0
+HANGOVER = 0.3  # seconds of chunks still sent after the last speech
+SID_INTERVAL = 0.5  # seconds between silence descriptors
+# Below this a chunk counts as digital silence, and noise levels are clamped
+SILENCE_FLOOR_DB = -127.0
+
+
+class VoiceActivityDetector:
+    """
+    Per-chunk speech/silence decisions for one capture stream of 16-bit
+    mono PCM at `sample_rate`, read `frame_size` samples at a time. Keep
+    one per client, so the noise floor it learned carries over from one
+    press of the talk button to the next.
+    """
+
+    def __init__(self, sample_rate, frame_size, hangover=HANGOVER, sid_interval=SID_INTERVAL):
+        self.sample_rate = sample_rate
+        self.frame_size = frame_size
+        self.hangover = hangover
+        self.sid_interval = sid_interval
+        self.floor = INITIAL_FLOOR_DB
+        self._energies = deque([INITIAL_FLOOR_DB], maxlen=math.ceil(FLOOR_WINDOW * sample_rate / frame_size))
+        self.frames = 0  # chunks classified
+        self.suppressed = 0  # chunks not sent as voice
+        self.descriptors = 0  # silence descriptors sent in their place
+        self._hangover_left = 0.0  # seconds
+        self._since_sid = None  # seconds since the last descriptor; None before the first of a silence
+
+    def start(self):
+        """
+        Start a new transmission: its first silent chunk sends a
+        descriptor, even if the last one ended in silence.
+        """
+        self._hangover_left = 0.0
+        self._since_sid = None
+
+    @property
+    def noise_level(self):
+        """
+        The noise floor in -dBov, the comfort noise descriptor's unit.
+        """
+        return min(-SILENCE_FLOOR_DB, max(0.0, -self.floor))
+
+    @property
+    def suppressed_fraction(self):
+        return self.suppressed / self.frames if self.frames else 0.0
+
+    def features(self, pcm):
+        """
+        (energy in dBFS, zero-crossing rate) of one chunk.
+        """
+        samples = np.frombuffer(pcm, '<i2', len(pcm) // 2).astype(np.float32)
+        if len(samples) < 2:
+            return SILENCE_FLOOR_DB, 0.0
+        power = float(np.dot(samples, samples)) / (len(samples) * 32768.0 * 32768.0)
+        energy = 10 * math.log10(power) if power > 0 else SILENCE_FLOOR_DB
+        signs = np.signbit(samples)
+        crossings = np.count_nonzero(signs[1:] != signs[:-1])
+        return max(energy, SILENCE_FLOOR_DB), crossings / (len(samples) - 1)
+
+    def is_speech(self, pcm):
+        """
+        Classify one chunk, updating the noise floor.
+        """
+        energy, zcr = self.features(pcm)
+        self._energies.append(energy)
+        self.floor = min(self._energies)
+        above = energy - self.floor
+        return energy > MIN_SPEECH_DB and (
+            above > SPEECH_MARGIN_DB or (above > FRICATIVE_MARGIN_DB and zcr > FRICATIVE_ZCR))
+
+    def process(self, pcm):
+        """
+        Decide what to send for one captured chunk: VOICE, SID or SILENT.
+        """
+        duration = len(pcm) / 2 / self.sample_rate
+        self.frames += 1
+        if self.is_speech(pcm):
+            self._hangover_left = self.hangover
+            self._since_sid = None
+            return VOICE
+        if self._hangover_left > 0:
+            self._hangover_left -= duration
+            return VOICE
+        self.suppressed += 1
+        if self._since_sid is None or self._since_sid + duration > self.sid_interval:
+            self._since_sid = 0.0
+            self.descriptors += 1
+            return SID
+        self._since_sid += duration
+        return SILENT
+
+    def stats(self):
+        return {
+            'frames': self.frames,
+            'suppressed': self.suppressed,
+            'descriptors': self.descriptors,
+            'suppressed_fraction': self.suppressed_fraction,
+            'noise_floor_db': self.floor,
+        }
@@ -0,0 +1,152 @@
+"""
+Pre-forked worker processes for the chat server (`server.py --workers N`).
+
+One server process is bound to one core by the GIL, however many threads
+it runs. With workers, the process started becomes a supervisor that
+forks:
+
+    a bus hub   cluster.BusServer on a Unix socket in a private directory,
+                unless the workers join an existing cluster instead
+    N workers   each a complete server, with either engine, listening on
+                the same port with SO_REUSEPORT so the kernel spreads new
+                connections over them
+
+Every worker joins the hub as a cluster node (see cluster.py), so chat,
+voice and presence reach clients on the other workers and the hub
+arbitrates each room's talk floor: clients share rooms as if they were on
+one server. A worker holds only the state of its own connections.
+
+The supervisor itself starts no threads, so it can fork safely at any
+time: it restarts a worker that exits, unless it exits within
+RESTART_GRACE of being started, which means it cannot start at all (its
+port is taken, say); then it shuts everything down. Every child exits
+when the supervisor does, however it ends: each watches a pipe that only
+the supervisor holds open.
+
+Needs fork() and SO_REUSEPORT: Linux, macOS or a BSD.
+"""
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+from cluster import BusServer
+
+# Seconds a worker must have run for to be restarted when it exits
+RESTART_GRACE = 2.0
+
+
+def supported():
+    return hasattr(os, 'fork') and hasattr(socket, 'SO_REUSEPORT')
+
+
+def _exit_with(fd):
+    """
+    Exit this child as soon as the supervisor's end of the pipe closes.
+    """
+    def watch():
+        try:
+            while os.read(fd, 1):
+                pass
+        except OSError:
+            pass
+        os._exit(0)
+    threading.Thread(target=watch, name="supervisor-watch", daemon=True).start()
+
+
+def _fork(watch_fd, hold_fd):
+    """
+    fork() with flushed output, so nothing buffered is written twice.
+    Returns the child's pid, or 0 in the child, which then watches the
+    supervisor.
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid == 0:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        os.close(hold_fd)
+        _exit_with(watch_fd)
+    return pid
+
+
+def _terminate(signum, frame):
+    raise KeyboardInterrupt
+
+
+def _stop(pids):
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+    for pid in pids:
+        try:
+            os.waitpid(pid, 0)
+        except OSError:
+            pass
+
+
+def supervise(count, local_hub=True):
+    """
+    Fork the bus hub (if `local_hub`) and `count` workers, then supervise
+    them. Returns in each worker, with (its index, the hub's Unix socket
+    path or None). Returns None in the supervisor once it has shut down.
+    """
+    watch_fd, hold_fd = os.pipe()
+    directory = hub_path = hub_pid = None
+    if local_hub:
+        directory = tempfile.mkdtemp(prefix='chat-bus-')
+        hub_path = os.path.join(directory, 'bus')
+        # Listening before any worker is forked, so none can get there first
+        hub = BusServer(path=hub_path)
+        hub_pid = _fork(watch_fd, hold_fd)
+        if hub_pid == 0:
+            try:
+                hub.serve_forever()
+            finally:
+                os._exit(0)
+        hub.close()
+    workers = {}  # pid -> index
+    started = {}  # index -> monotonic time
+    for index in range(count):
+        pid = _fork(watch_fd, hold_fd)
+        if pid == 0:
+            return index, hub_path
+        workers[pid] = index
+        started[index] = time.monotonic()
+    print(f"Supervising {count} workers" + (f", bus hub at {hub_path}" if local_hub else ""))
+    # Shut down cleanly on SIGTERM as on Ctrl-C
+    signal.signal(signal.SIGTERM, _terminate)
+    try:
+        while workers:
+            pid, status = os.wait()
+            if pid == hub_pid:
+                print("Bus hub exited; shutting down.")
+                break
+            index = workers.pop(pid, None)
+            if index is None:
+                continue
+            code = os.waitstatus_to_exitcode(status)
+            if time.monotonic() - started[index] < RESTART_GRACE:
+                print(f"Worker {index} exited with status {code} on startup; shutting down.")
+                break
+            print(f"Worker {index} exited with status {code}; restarting it.")
+            pid = _fork(watch_fd, hold_fd)
+            if pid == 0:
+                return index, hub_path
+            workers[pid] = index
+            started[index] = time.monotonic()
+    except KeyboardInterrupt:
+        print("\nShutting down the workers.")
+    # Already on the way out; a second signal must not cut the cleanup short
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    _stop(list(workers) + ([hub_pid] if hub_pid else []))
+    os.close(hold_fd)
+    if directory is not None:
+        shutil.rmtree(directory, ignore_errors=True)
+    return None